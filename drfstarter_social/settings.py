@@ -35,6 +35,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # first, so it times the whole stack
+    'utils.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -86,6 +88,34 @@ else:
         }
     }
 
+# PASSWORD_HASHER picks the calibrated hasher new passwords are hashed with ('pbkdf2_sha256', 'argon2' or
+# 'scrypt'), the others only verify existing hashes, which are upgraded on the next login
+CALIBRATED_PASSWORD_HASHERS = {
+    'pbkdf2_sha256': 'utils.hashers.CalibratedPBKDF2PasswordHasher',
+    'argon2': 'utils.hashers.CalibratedArgon2PasswordHasher',
+    'scrypt': 'utils.hashers.CalibratedScryptPasswordHasher',
+}
+PASSWORD_HASHER = os.getenv('PASSWORD_HASHER', 'pbkdf2_sha256')
+PASSWORD_HASHERS = [
+    CALIBRATED_PASSWORD_HASHERS[PASSWORD_HASHER],
+    *(path for algorithm, path in CALIBRATED_PASSWORD_HASHERS.items() if algorithm != PASSWORD_HASHER),
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+]
+
+# Hasher parameters picked by `manage.py calibratepasswordhashers --write`
+# MODE 'calibrated' uses FILE when it exists, 'default' keeps Django's parameters
+PASSWORD_HASHER_CALIBRATION = {
+    'MODE': os.getenv('PASSWORD_HASHER_CALIBRATION', 'calibrated'),
+    'FILE': BASE_DIR / 'password_hashers.json',
+    'TARGET_MS': 50,
+    'CONCURRENCY': os.cpu_count() or 1,
+}
+
+AUTHENTICATION_BACKENDS = [
+    'user.backends.PooledModelBackend',
+]
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -122,7 +152,7 @@ REST_FRAMEWORK = {
     'DEFAULT_RENDERER_CLASSES': DEFAULT_RENDERER_CLASSES,
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'rest_framework.authentication.SessionAuthentication',
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'user.authentication.CachedJWTAuthentication',
     )
 }
 
@@ -159,11 +189,84 @@ SIMPLE_JWT = {
     'SLIDING_TOKEN_REFRESH_LIFETIME': timedelta(days=1),
 }
 
+# Tiered cache (utils.cache.TieredCache): bounded in-process LRU in front of a cache shared by all processes.
+# The file based L2 is a local stand-in, point 'shared' at Redis or Memcached in production.
+CACHES = {
+    'default': {
+        'BACKEND': 'utils.cache.TieredCache',
+        'LOCATION': 'default',
+        'TIMEOUT': 300,
+        'OPTIONS': {
+            'L2': 'shared',
+            'L1_MAXSIZE': int(os.getenv('CACHE_L1_MAXSIZE', 10000)),
+            'L1_TTL': 5,  # seconds, how stale an entry changed by another process can be
+        },
+    },
+    'shared': {
+        'BACKEND': os.getenv('CACHE_L2_BACKEND', 'django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': os.getenv('CACHE_L2_LOCATION', str(BASE_DIR / '.cache')),
+        'TIMEOUT': 300,
+    },
+}
+
+# Cache of authenticated user principals (user.authentication.CachedJWTAuthentication)
+JWT_USER_CACHE = {
+    'CACHE': 'default',
+    'TTL': int(os.getenv('JWT_USER_CACHE_TTL', 60)),  # seconds
+}
+
+# In-memory index of blacklisted refresh tokens (user.revocation.RevocationIndex)
+TOKEN_REVOCATION_INDEX = {
+    'CAPACITY': int(os.getenv('TOKEN_REVOCATION_INDEX_CAPACITY', 1000000)),
+    'ERROR_RATE': 0.001,
+    'SYNC_INTERVAL': int(os.getenv('TOKEN_REVOCATION_INDEX_SYNC_INTERVAL', 30)),  # seconds
+    'RESCAN_ROWS': 1000,  # ids behind the last seen one that are read again, for rows committed late
+}
+
+# Write-behind buffer for User.last_login (user.last_login.LastLoginBuffer)
+LAST_LOGIN_BUFFER = {
+    'MAX_STALENESS': int(os.getenv('LAST_LOGIN_MAX_STALENESS', 60)),  # seconds
+    'MAX_SIZE': int(os.getenv('LAST_LOGIN_BUFFER_MAX_SIZE', 1000)),
+}
+
+# Process pool used for password hashing (utils.hashing.PasswordHashingService)
+# WORKERS=0 hashes inline on the request thread, the default shares the cores
+# between the WEB_CONCURRENCY web processes (as set for gunicorn) that each have a pool
+PASSWORD_HASHING_POOL = {
+    'WORKERS': int(os.getenv(
+        'PASSWORD_HASHING_WORKERS', max(1, (os.cpu_count() or 1) // int(os.getenv('WEB_CONCURRENCY', 1))))),
+    'MAX_PENDING': int(os.getenv('PASSWORD_HASHING_MAX_PENDING', 64)),
+    'TIMEOUT': 5,  # seconds
+}
+
+# Precomputed OpenAPI schema (utils.openapi.PrecomputedSchema)
+# VERSION defaults to a fingerprint of the python files under BASE_DIR
+OPENAPI_SCHEMA = {
+    'PATH': os.getenv('OPENAPI_SCHEMA_PATH', str(BASE_DIR / '.schema')),
+    'VERSION': os.getenv('RELEASE_VERSION', ''),
+    'MAX_AGE': 300,  # seconds, for the unversioned url
+}
+
+# Prometheus metrics served at /metrics (utils.metrics)
+# set PROMETHEUS_MULTIPROC_DIR in the environment of every worker to aggregate across processes
+METRICS = {
+    'TOKEN': os.getenv('METRICS_TOKEN', ''),  # bearer token required to scrape, if set
+    'PUBLIC': os.getenv('METRICS_PUBLIC', 'False') == 'True',  # without a token, scraping is refused unless set
+}
+
 STATIC_URL = '/static/'
 STATIC_ROOT = BASE_DIR / 'static'
 # STATICFILES_DIRS = [BASE_DIR / 'staticfiles', ]  # for collectstatic
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
+# content hashed names and .gz/.br variants, written by collectstatic
+STATICFILES_STORAGE = 'utils.static.CompressedManifestStaticFilesStorage'
+
+# Static and media file serving outside DEBUG (utils.static.serve)
+STATIC_SERVE = {
+    'MAX_AGE': int(os.getenv('STATIC_MAX_AGE', 3600)),  # seconds, for names without a content hash
+    'COMPRESS_MIN_SIZE': 256,  # bytes
+}
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
@@ -202,6 +305,52 @@ SUMMERNOTE_CONFIG = {
     'attachment_upload_to': 'summernote',
 }
 
+# Google ID token verification (utils.google.certs.CertStore)
+GOOGLE_CERTS = {
+    'URL': 'https://www.googleapis.com/oauth2/v1/certs',
+    'REFRESH_AHEAD': 300,  # seconds before expiry to refresh in the background
+    'DEFAULT_MAX_AGE': 3600,  # seconds, when the response has no Cache-Control max-age
+    'TIMEOUT': 5,  # seconds
+    'VERIFIED_TOKEN_CACHE_SIZE': 10000,
+    'CACHE': 'default',  # share fetched certificates between processes
+    'MIN_REFETCH_INTERVAL': 60,  # seconds between downloads forced by tokens with an unknown key id
+}
+
+# Facebook Graph API profile lookups (utils.facebook.Facebook)
+FACEBOOK_GRAPH = {
+    'POOL_SIZE': 10,
+    'CONNECT_TIMEOUT': 3,  # seconds
+    'READ_TIMEOUT': 5,  # seconds
+    'PROFILE_CACHE_SIZE': 10000,
+    'PROFILE_CACHE_TTL': 60,  # seconds
+}
+
+# Twitter OAuth1 API (utils.twitter.Twitter)
+TWITTER_API = {
+    'POOL_SIZE': 10,
+    'CONNECT_TIMEOUT': 3,  # seconds
+    'READ_TIMEOUT': 5,  # seconds
+    'REQUEST_TOKEN_POOL_SIZE': 5,
+    'REQUEST_TOKEN_TTL': 300,  # seconds a pre-fetched request token is handed out for
+}
+
+# Circuit breakers and bulkheads around the identity providers (utils.circuit_breaker.CircuitBreaker)
+CIRCUIT_BREAKERS = {
+    'DEFAULT': {
+        'FAILURE_THRESHOLD': 5,  # consecutive failures before the breaker opens
+        'RECOVERY_TIMEOUT': 30,  # seconds open before a trial call is let through
+        'MAX_CONCURRENT': 20,  # calls in flight per provider, the rest get a 503
+        'HALF_OPEN_MAX_CALLS': 1,
+        'SLOW_CALL_THRESHOLD': 4,  # seconds, slower successful calls count as failures
+    },
+    'google': {},
+    'facebook': {},
+    'twitter': {},
+}
+
+# Serve the social login endpoints with native async views (social_auth.views), run under ASGI
+SOCIAL_AUTH_ASYNC_VIEWS = os.getenv('SOCIAL_AUTH_ASYNC_VIEWS', 'False') == 'True'
+
 # Email Config
 EMAIL_BACKEND = os.getenv("EMAIL_BACKEND")
 EMAIL_HOST = os.getenv("EMAIL_HOST")
@@ -210,16 +359,55 @@ EMAIL_PORT = os.getenv("EMAIL_PORT")
 EMAIL_HOST_USER = os.getenv("EMAIL_HOST_USER")
 EMAIL_HOST_PASSWORD = os.getenv("EMAIL_HOST_PASSWORD")
 
+# Outgoing email worker pool (utils.email.EmailQueue)
+EMAIL_QUEUE = {
+    'WORKERS': int(os.getenv('EMAIL_QUEUE_WORKERS', 2)),  # 0 sends on the request thread
+    'MAX_SIZE': 1000,  # queued messages before senders have to wait
+    'BATCH_SIZE': 1000,  # messages taken off the queue at once, SendGrid messages among them go out together
+    'SMTP_BATCH_SIZE': 100,  # SMTP messages per send_messages() call, a failure retries or drops this many
+    'PUT_TIMEOUT': 2,  # seconds a sender waits for room before getting a 503
+    'IDLE_TIMEOUT': 30,  # seconds before an unused SMTP connection is closed
+}
+
+# Transactional email outbox, sent by `manage.py dispatchemails` (user.models.OutboxEmail)
+EMAIL_OUTBOX = {
+    'BATCH_SIZE': 100,  # emails claimed per round trip
+    'POLL_INTERVAL': 1,  # seconds between polls of an empty outbox
+    'LEASE': 300,  # seconds before emails claimed by a dead dispatcher are retried
+    'MAX_ATTEMPTS': 8,
+    'BACKOFF_BASE': 30,  # seconds, doubled after every failed attempt
+    'BACKOFF_MAX': 3600,  # seconds
+    'RETENTION': 7 * 24 * 3600,  # seconds sent and failed emails are kept before being deleted
+    'PURGE_INTERVAL': 3600,  # seconds between deletions of old emails
+}
+
+# Suppress repeated verification/password reset emails to the same user (utils.email.EmailCoalescer)
+EMAIL_COALESCING = {
+    'WINDOW': 300,  # seconds, 0 disables
+    'CACHE': 'default',  # must be shared between processes to coalesce across them
+}
+
 # Sendgrid Config
 SENDGRID_API_KEY = os.getenv("SENDGRID_API_KEY")
 SENDGRID_HOST_USER = os.getenv("SENDGRID_HOST_USER")
 
+# SendGrid v3 API (utils.email.SendGridClient)
+SENDGRID_API = {
+    'URL': 'https://api.sendgrid.com',
+    'MAX_PERSONALIZATIONS': 1000,  # recipients per mail/send call, SendGrid's limit
+    'CONNECT_TIMEOUT': 3,  # seconds
+    'READ_TIMEOUT': 10,  # seconds
+}
+
+# Log handling (utils.log): records are queued by the logging thread and written by a background thread
+# every worker process appends to logs/info.log, which is rotated by an external logrotate; the
+# WatchedFileHandler reopens it once moved, rotating from the processes themselves would race
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
     'loggers': {
         'django': {
-            'handlers': ['console', 'file', ],
+            'handlers': ['queue', ],
             'level': 'INFO',
             # 'level': 'WARNING',
             'propagate': False,
@@ -233,20 +421,40 @@ LOGGING = {
             'formatter': 'default'
         },
         'file': {
+            'class': 'logging.handlers.WatchedFileHandler',
             'level': 'INFO',
-            'class': 'logging.FileHandler',
-            'formatter': 'default',
+            'formatter': 'json',
             'filename': BASE_DIR / 'logs' / 'info.log',
+            'encoding': 'utf-8',
+        },
+        'queue': {
+            '()': 'utils.log.QueueListenerHandler',
+            'handlers': ['console', 'file'],
+            'maxsize': 10000,
+            'filters': ['sampling'],
+        },
+    },
+    'filters': {
+        # fraction of the records below WARNING kept for noisy loggers
+        'sampling': {
+            '()': 'utils.log.SamplingFilter',
+            'rates': {
+                'django.db.backends': 0.01,
+                'urllib3': 0.1,
+            },
         },
     },
     'formatters': {
         'default': {
             'format': '[Time: {asctime}] [{name} {levelname}] message: {message}',
             'style': '{',
-        }
+        },
+        'json': {
+            '()': 'utils.log.JSONFormatter',
+        },
     },
     'root': {
-        'handlers': ['console', 'file', ],
+        'handlers': ['queue', ],
         'level': 'DEBUG',
     },
 
@@ -2,9 +2,11 @@ import logging
 from django.contrib import admin
 from django.urls import path, re_path, include
 from django.conf import settings
-from django.conf.urls.static import static, serve
-from django.views.generic import TemplateView
-from rest_framework.schemas import get_schema_view
+from django.conf.urls.static import static
+
+from utils.metrics import metrics_view
+from utils.openapi import PrecomputedSchemaView, SchemaDocView
+from utils.static import serve
 
 
 # Get an instance of a logger
@@ -19,13 +21,15 @@ patterns = [
 
 extrapatterns = [
     # api docs
-    path('openapi', get_schema_view(title='Drf Starter',
-                                    description='DRF STARTER', version='1.0.0'), name='openapi'),
+    path('openapi', PrecomputedSchemaView.as_view(), name='openapi'),
+
+    # prometheus
+    path('metrics', metrics_view, name='metrics'),
 
-    path('docs/', TemplateView.as_view(template_name='api-doc.html',
+    path('docs/', SchemaDocView.as_view(template_name='api-doc.html',
          extra_context={'schema_url': 'openapi'})),
 
-    path('redoc/', TemplateView.as_view(template_name='redoc.html',
+    path('redoc/', SchemaDocView.as_view(template_name='redoc.html',
          extra_context={'schema_url': 'openapi'})),
 
     # django_summernote
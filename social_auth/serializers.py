@@ -14,29 +14,56 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 
 
+def google_identity(user_data):
+    """
+    Return (email, full_name) from a verified Google ID token
+    """
+    try:
+        user_data['sub']
+    except:
+        raise serializers.ValidationError(
+            'The token is invalid or expired. Please try again.'
+        )
+
+    if user_data['aud'] != os.getenv('GOOGLE_CLIENT_ID'):
+        raise AuthenticationFailed('oops, who are you?')
+
+    # user_id = user_data['sub']
+    return user_data['email'], user_data['name']
+
+
+def facebook_identity(user_data):
+    """
+    Return (email, full_name) from a Facebook Graph profile
+    """
+    if not user_data or 'email' not in user_data:
+        raise serializers.ValidationError(
+            'The token  is invalid or expired. Please try again.'
+        )
+    return user_data['email'], user_data.get('name', '')
+
+
+def twitter_identity(user_data):
+    """
+    Return (email, full_name) from a Twitter verify_credentials response
+    """
+    try:
+        # user_id = user_info['id_str']
+        return user_data['email'], user_data['name']
+    except:
+        raise serializers.ValidationError(
+            'The tokens are invalid or expired. Please try again.'
+        )
+
+
 class GoogleSocialAuthSerializer(serializers.Serializer):
     auth_token = serializers.CharField()
 
     @staticmethod
     def validate_auth_token(auth_token):
-        user_data = Google.validate(auth_token)
-        try:
-            user_data['sub']
-        except:
-            raise serializers.ValidationError(
-                'The token is invalid or expired. Please try again.'
-            )
-
-        if user_data['aud'] != os.getenv('GOOGLE_CLIENT_ID'):
-            raise AuthenticationFailed('oops, who are you?')
-
-        # user_id = user_data['sub']
-        email = user_data['email']
-        full_name = user_data['name']
-        provider = 'google'
-
+        email, full_name = google_identity(Google.validate(auth_token))
         return register_social_user(
-            provider=provider, email=email, full_name=full_name)
+            provider='google', email=email, full_name=full_name)
 
 
 class FacebookSocialAuthSerializer(serializers.Serializer):
@@ -44,21 +71,9 @@ class FacebookSocialAuthSerializer(serializers.Serializer):
 
     @staticmethod
     def validate_auth_token(auth_token):
-        user_data = Facebook.validate(auth_token)
-        try:
-            email = user_data['email']
-            full_name = user_data['name']
-            provider = 'facebook'
-            return register_social_user(
-                provider=provider,
-                email=email,
-                full_name=full_name
-            )
-        except Exception as identifier:
-            print("Exception")
-            raise serializers.ValidationError(
-                'The token  is invalid or expired. Please try again.'
-            )
+        email, full_name = facebook_identity(Facebook.validate(auth_token))
+        return register_social_user(
+            provider='facebook', email=email, full_name=full_name)
 
 
 class TwitterAuthSerializer(serializers.Serializer):
@@ -77,22 +92,11 @@ class TwitterAuthSerializer(serializers.Serializer):
         oauth_verifier = attrs.get('oauth_verifier')
 
         logger.debug("Hello I am from serializer validate twitter")
-        print("Hello I am from serializer validate twitter")
 
         access_token = Twitter.get_access_token(
             oauth_token, oauth_verifier)
         user_data = Twitter.get_user_data(access_token)
-        print(user_data)
-
-        try:
-            # user_id = user_info['id_str']
-            email = user_data['email']
-            full_name = user_data['name']
-            provider = 'twitter'
-        except:
-            raise serializers.ValidationError(
-                'The tokens are invalid or expired. Please try again.'
-            )
 
+        email, full_name = twitter_identity(user_data)
         return register_social_user(
-            provider=provider, email=email, full_name=full_name)
+            provider='twitter', email=email, full_name=full_name)
@@ -1,3 +1,331 @@
-from django.test import TestCase
+import json
+import os
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
+from unittest import mock
 
-# Create your tests here.
+import rsa
+from asgiref.sync import async_to_sync
+from cachetools import LRUCache, TTLCache
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from google.auth import crypt, jwt
+
+from rest_framework.exceptions import AuthenticationFailed
+
+from social_auth.views import facebook_social_auth, google_social_auth, twitter_social_auth
+from utils.circuit_breaker import OPEN, CircuitBreaker, ProviderUnavailable
+from utils.facebook import Facebook
+from utils.google import Google
+from utils.google.certs import CertStore
+from utils.social import USERNAME_ATTEMPTS, create_social_user, generate_username, register_social_user
+from utils.tests import TEST_CACHES
+
+User = get_user_model()
+
+PROVIDERS = ('google', 'facebook', 'twitter')
+
+
+@override_settings(CACHES=TEST_CACHES)
+class RegisterSocialUserTestCase(TestCase):
+
+    def test_new_user_queries(self):
+        for provider in PROVIDERS:
+            with self.subTest(provider=provider):
+                # email lookup, username allocation, SAVEPOINT, INSERT, RELEASE SAVEPOINT
+                with self.assertNumQueries(5):
+                    user = register_social_user(provider, f'{provider}@example.com', 'John Doe')
+                self.assertEqual(user.auth_provider, provider)
+                self.assertTrue(user.is_verified)
+                self.assertFalse(user.has_usable_password())
+
+        self.assertEqual(
+            sorted(User.objects.values_list('username', flat=True)), ['johndoe', 'johndoe1', 'johndoe2'])
+
+    def test_returning_user_queries(self):
+        for provider in PROVIDERS:
+            with self.subTest(provider=provider):
+                created = register_social_user(provider, f'{provider}@example.com', 'John Doe')
+                with self.assertNumQueries(1):
+                    user = register_social_user(provider, f'{provider}@example.com', 'John Doe')
+                self.assertEqual(user.pk, created.pk)
+
+    def test_no_password_is_hashed(self):
+        legacy = User.objects.create(
+            username='jane', email='jane@example.com', full_name='Jane Doe', auth_provider='google')
+        # accounts created before social logins stopped sharing a password secret
+        legacy.set_password('shared-secret')
+        legacy.save()
+        # make_password and check_password both look up a hasher, unusable passwords do not
+        with mock.patch('django.contrib.auth.hashers.get_hasher') as get_hasher:
+            register_social_user('google', 'john@example.com', 'John Doe')
+            user = register_social_user('google', 'jane@example.com', 'Jane Doe')
+        get_hasher.assert_not_called()
+        self.assertFalse(user.has_usable_password())
+        self.assertFalse(User.objects.get(pk=legacy.pk).has_usable_password())
+
+    def test_other_provider_is_rejected(self):
+        register_social_user('google', 'john@example.com', 'John Doe')
+        with self.assertRaises(AuthenticationFailed):
+            register_social_user('facebook', 'john@example.com', 'John Doe')
+
+
+@override_settings(CACHES=TEST_CACHES)
+class SocialUsernameTestCase(TestCase):
+
+    @staticmethod
+    def create(username, email=None):
+        return User.objects.create(username=username, email=email or f'{username}@example.com', full_name=username)
+
+    def test_next_suffix_ignores_other_names_with_the_prefix(self):
+        self.assertEqual(generate_username('John'), 'john')
+        for username in ('johnny', 'johnathan3'):
+            self.create(username)
+        self.assertEqual(generate_username('John'), 'john')
+        self.create('john')
+        self.assertEqual(generate_username('John'), 'john1')
+        self.create('john2')
+        self.assertEqual(generate_username('John'), 'john3')
+        self.create('john10')
+        self.assertEqual(generate_username('John'), 'john11')
+
+    def test_prefix_is_matched_literally(self):
+        self.create('a.b')
+        self.create('axb5')
+        self.assertEqual(generate_username('a.b'), 'a.b1')
+
+    def test_taken_username_is_allocated_again(self):
+        # a concurrent signup takes the name between the allocation and the INSERT
+        self.create('johndoe', 'other@example.com')
+        with mock.patch('utils.social.generate_username', side_effect=['johndoe', 'johndoe1']):
+            user = create_social_user('google', 'john@example.com', 'John Doe')
+        self.assertEqual(user.username, 'johndoe1')
+
+    def test_concurrent_signup_with_the_same_email(self):
+        self.create('johndoe', 'john@example.com')
+        with mock.patch('utils.social.generate_username', return_value='johndoe2'):
+            self.assertIsNone(create_social_user('google', 'john@example.com', 'John Doe'))
+        self.assertEqual(User.objects.filter(email='john@example.com').count(), 1)
+
+    def test_retries_are_bounded(self):
+        self.create('johndoe', 'other@example.com')
+        with mock.patch('utils.social.generate_username', return_value='johndoe') as generate:
+            with self.assertRaises(IntegrityError):
+                create_social_user('google', 'john@example.com', 'John Doe')
+        self.assertEqual(generate.call_count, USERNAME_ATTEMPTS)
+
+
+class CertHandler(BaseHTTPRequestHandler):
+    certs = {}
+    max_age = 3600
+    hits = 0
+
+    def do_GET(self):
+        type(self).hits += 1
+        body = json.dumps(self.certs).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Cache-Control', f'public, max-age={self.max_age}')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class GoogleValidateTestCase(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        public_key, private_key = rsa.newkeys(1024)
+        cls.signer = crypt.RSASigner.from_string(private_key.save_pkcs1().decode(), key_id='key-1')
+        cls.public_keys = {'key-1': public_key.save_pkcs1().decode()}
+        public_key, private_key = rsa.newkeys(1024)
+        cls.next_signer = crypt.RSASigner.from_string(private_key.save_pkcs1().decode(), key_id='key-2')
+        cls.public_keys['key-2'] = public_key.save_pkcs1().decode()
+        cls.server = HTTPServer(('127.0.0.1', 0), CertHandler)
+        Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        CertHandler.hits = 0
+        CertHandler.max_age = 3600
+        CertHandler.certs = {'key-1': self.public_keys['key-1']}
+        self.store = CertStore(f'http://127.0.0.1:{self.server.server_port}/certs', refresh_ahead=0)
+        for patcher in (mock.patch('utils.google.helper.google_certs', self.store),
+                        mock.patch('utils.google.helper._verified_tokens', LRUCache(maxsize=10))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def make_token(self, sub='1', exp_in=3600, signer=None):
+        now = int(time.time())
+        return jwt.encode(signer or self.signer, {
+            'iss': 'https://accounts.google.com', 'aud': 'client-id', 'sub': sub,
+            'email': f'{sub}@example.com', 'name': 'John Doe', 'iat': now, 'exp': now + exp_in,
+        }).decode()
+
+    def test_certs_are_fetched_once_within_max_age(self):
+        self.assertEqual(Google.validate(self.make_token('1'))['sub'], '1')
+        self.assertEqual(Google.validate(self.make_token('2'))['sub'], '2')
+        self.assertEqual(CertHandler.hits, 1)
+
+    def test_certs_are_refetched_after_max_age(self):
+        CertHandler.max_age = 0
+        Google.validate(self.make_token('1'))
+        Google.validate(self.make_token('2'))
+        self.assertEqual(CertHandler.hits, 2)
+
+    def test_verified_token_is_reused(self):
+        token = self.make_token('1')
+        Google.validate(token)
+        self.store.clear()
+        Google.validate(token)
+        self.assertEqual(CertHandler.hits, 1)
+
+    def test_rotated_key_is_fetched(self):
+        Google.validate(self.make_token('1'))
+        CertHandler.certs = self.public_keys
+        self.assertEqual(Google.validate(self.make_token('2', signer=self.next_signer))['sub'], '2')
+        self.assertEqual(CertHandler.hits, 2)
+
+    def test_unknown_key_refetches_at_most_once_per_interval(self):
+        Google.validate(self.make_token('1'))
+        for sub in ('2', '3', '4'):
+            self.assertIsInstance(Google.validate(self.make_token(sub, signer=self.next_signer)), str)
+        self.assertEqual(CertHandler.hits, 2)
+        self.store.min_refetch_interval = 0
+        self.assertIsInstance(Google.validate(self.make_token('5', signer=self.next_signer)), str)
+        self.assertEqual(CertHandler.hits, 3)
+
+    def test_invalid_token(self):
+        token = self.make_token('1')
+        self.assertIsInstance(Google.validate(token[:-4] + 'AAAA'), str)
+        self.assertIsInstance(Google.validate(self.make_token('2', exp_in=-60)), str)
+
+
+class GraphHandler(BaseHTTPRequestHandler):
+    hits = 0
+
+    def do_GET(self):
+        type(self).hits += 1
+        if 'access_token=valid' in self.path:
+            status, body = 200, {'id': '1', 'name': 'John Doe', 'email': 'john@example.com'}
+        elif 'access_token=outage' in self.path:
+            body = b'<html>Service Unavailable</html>'
+            self.send_response(500)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        else:
+            status, body = 400, {'error': {'message': 'Invalid OAuth access token.', 'code': 190}}
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FacebookValidateTestCase(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = HTTPServer(('127.0.0.1', 0), GraphHandler)
+        Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        GraphHandler.hits = 0
+        for patcher in (mock.patch('facebook.FACEBOOK_GRAPH_URL', f'http://127.0.0.1:{self.server.server_port}/'),
+                        mock.patch.object(Facebook, '_profiles', TTLCache(maxsize=10, ttl=60)),
+                        mock.patch.object(Facebook, 'breaker', CircuitBreaker(
+                            'facebook', failure_threshold=2, is_failure=Facebook.breaker.is_failure))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_profile_is_cached(self):
+        self.assertEqual(Facebook.validate('valid')['email'], 'john@example.com')
+        self.assertEqual(Facebook.validate('valid')['email'], 'john@example.com')
+        self.assertEqual(GraphHandler.hits, 1)
+
+    def test_invalid_token(self):
+        self.assertIsNone(Facebook.validate('invalid'))
+        self.assertIsNone(Facebook.validate('invalid'))
+        self.assertEqual(GraphHandler.hits, 2)
+
+    def test_outage_opens_breaker(self):
+        for _ in range(2):
+            with self.assertRaises(ProviderUnavailable):
+                Facebook.validate('outage')
+        self.assertEqual(Facebook.breaker.state, OPEN)
+        with self.assertRaises(ProviderUnavailable):
+            Facebook.validate('valid')
+        self.assertEqual(GraphHandler.hits, 2)
+
+
+@override_settings(CACHES=TEST_CACHES)
+@mock.patch('social_auth.views.last_login_buffer', mock.Mock())
+class AsyncSocialAuthViewTestCase(TestCase):
+    factory = RequestFactory()
+
+    def post(self, view, data, content_type='application/json'):
+        body = data if isinstance(data, str) else json.dumps(data)
+        response = async_to_sync(view)(self.factory.post('/', body, content_type=content_type))
+        return response.status_code, json.loads(response.content)
+
+    def test_google_login(self):
+        id_info = {'sub': '1', 'aud': 'client-id', 'email': 'john@example.com', 'name': 'John Doe'}
+        with mock.patch.dict(os.environ, {'GOOGLE_CLIENT_ID': 'client-id'}), \
+                mock.patch('social_auth.views.Google.avalidate', mock.AsyncMock(return_value=id_info)):
+            status, data = self.post(google_social_auth, {'auth_token': 'token'})
+        self.assertEqual(status, 200)
+        self.assertEqual(set(data), {'access', 'refresh'})
+        self.assertEqual(User.objects.get(email='john@example.com').auth_provider, 'google')
+
+    def test_invalid_provider_token(self):
+        with mock.patch('social_auth.views.Facebook.avalidate', mock.AsyncMock(return_value=None)):
+            status, data = self.post(facebook_social_auth, {'auth_token': 'expired'})
+        self.assertEqual(status, 400)
+        self.assertIn('auth_token', data)
+
+    def test_provider_outage(self):
+        unavailable = mock.AsyncMock(side_effect=ProviderUnavailable())
+        with mock.patch('social_auth.views.Twitter.aget_access_token', unavailable):
+            status, _ = self.post(twitter_social_auth, {'oauth_token': 'token', 'oauth_verifier': 'verifier'})
+        self.assertEqual(status, 503)
+
+    def test_form_data_is_accepted(self):
+        with mock.patch('social_auth.views.Facebook.avalidate', mock.AsyncMock(return_value=None)):
+            status, _ = self.post(facebook_social_auth, 'auth_token=expired', 'application/x-www-form-urlencoded')
+        self.assertEqual(status, 400)
+
+    def test_malformed_requests(self):
+        for body in ('[1, 2]', '"token"', '42', 'null'):
+            with self.subTest(body=body):
+                status, data = self.post(google_social_auth, body)
+                self.assertEqual(status, 400)
+                self.assertIn('non_field_errors', data)
+        self.assertEqual(self.post(google_social_auth, '{"auth_token"')[0], 400)
+        self.assertEqual(self.post(google_social_auth, {}), (400, {'auth_token': ['This field is required.']}))
+        response = async_to_sync(google_social_auth)(self.factory.get('/'))
+        self.assertEqual(response.status_code, 405)
@@ -1,12 +1,24 @@
+from django.conf import settings
 from django.urls import path
 
 from .views import GoogleSocialAuthView, FacebookSocialAuthView, TwitterSocialAuthView, TwitterOAuthTokenRequestView
+from .views import ProviderHealthView
+from .views import google_social_auth, facebook_social_auth, twitter_social_auth
+
+if getattr(settings, 'SOCIAL_AUTH_ASYNC_VIEWS', False):
+    google_view, facebook_view, twitter_view = google_social_auth, facebook_social_auth, twitter_social_auth
+else:
+    google_view = GoogleSocialAuthView.as_view()
+    facebook_view = FacebookSocialAuthView.as_view()
+    twitter_view = TwitterSocialAuthView.as_view()
 
 app_name = 'social_auth'
 urlpatterns = [
-    path('google/', GoogleSocialAuthView.as_view(), name='google'),
-    path('facebook/', FacebookSocialAuthView.as_view(), name='facebook'),
-    path('twitter/', TwitterSocialAuthView.as_view(), name='twitter'),
+    path('google/', google_view, name='google'),
+    path('facebook/', facebook_view, name='facebook'),
+    path('twitter/', twitter_view, name='twitter'),
 
     path('twitter/oauth/request_token/', TwitterOAuthTokenRequestView.as_view(), name='twitter_oauth_token'),
+
+    path('providers/health/', ProviderHealthView.as_view(), name='provider_health'),
 ]
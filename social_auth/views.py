@@ -1,21 +1,45 @@
-import os
+import json
 
-from django.utils.http import parse_qsl
+import requests
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
 from rest_framework import status
+from rest_framework.exceptions import APIException, ValidationError
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.generics import GenericAPIView
-from rest_framework.permissions import AllowAny
+from rest_framework.permissions import AllowAny, IsAdminUser
 
 from dotenv import load_dotenv
-from requests_oauthlib import OAuth1Session
 
-from .serializers import GoogleSocialAuthSerializer, FacebookSocialAuthSerializer, TwitterAuthSerializer
+from .serializers import (
+    GoogleSocialAuthSerializer, FacebookSocialAuthSerializer, TwitterAuthSerializer,
+    google_identity, facebook_identity, twitter_identity,
+)
+from user.last_login import last_login_buffer
+from utils.circuit_breaker import circuit_breakers
+from utils.facebook import Facebook
+from utils.google import Google
+from utils.social import register_social_user
 from utils.token import get_access_token, get_refresh_token
+from utils.twitter import Twitter
 
 load_dotenv()
 
 
+def token_response_data(user):
+    """
+    Issue a token pair for a social user and record the login
+    """
+    access = get_access_token(user)
+    refresh = get_refresh_token(user)
+    last_login_buffer.record(user)
+    return {
+        'access': str(access),
+        'refresh': str(refresh),
+    }
+
+
 class GoogleSocialAuthView(GenericAPIView):
     """
     Google Social Auth View
@@ -31,12 +55,7 @@ class GoogleSocialAuthView(GenericAPIView):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         user = serializer.validated_data['auth_token']
-        access = get_access_token(user)
-        refresh = get_refresh_token(user)
-        return Response({
-            'access': str(access),
-            'refresh': str(refresh),
-        }, status=status.HTTP_200_OK)
+        return Response(token_response_data(user), status=status.HTTP_200_OK)
 
 
 class FacebookSocialAuthView(GenericAPIView):
@@ -54,12 +73,7 @@ class FacebookSocialAuthView(GenericAPIView):
         serializer = self.serializer_class(data=request.data)
         serializer.is_valid(raise_exception=True)
         user = serializer.validated_data['auth_token']
-        access = get_access_token(user)
-        refresh = get_refresh_token(user)
-        return Response({
-            'access': str(access),
-            'refresh': str(refresh),
-        }, status=status.HTTP_200_OK)
+        return Response(token_response_data(user), status=status.HTTP_200_OK)
 
 
 class TwitterSocialAuthView(GenericAPIView):
@@ -68,25 +82,110 @@ class TwitterSocialAuthView(GenericAPIView):
     def post(self, request):
         serializer = self.serializer_class(data=request.data)
         serializer.is_valid(raise_exception=True)
-        return Response(serializer.validated_data, status=status.HTTP_200_OK)
+        user = serializer.validated_data
+        return Response(token_response_data(user), status=status.HTTP_200_OK)
 
 
 class TwitterOAuthTokenRequestView(APIView):
     @staticmethod
     def post(request):
-        # create an object of OAuth1Session
-        request_token = OAuth1Session(client_key=os.getenv("TWITTER_API_KEY"),
-                                      client_secret=os.getenv("TWITTER_API_KEY_SECRET"))
+        # request_token_key, request_token_secret and other details, usually from the pre-fetched pool
+        try:
+            response = Twitter.get_request_token()
+        except requests.RequestException:
+            return Response({'message': 'Could not reach Twitter, please try again.'},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
-        # twitter endpoint to get request token
-        url = "https://api.twitter.com/oauth/request_token"
+        return Response(response, status=status.HTTP_200_OK)
 
-        # get request_token_key, request_token_secret and other details
-        resp = request_token.post(url)
 
-        # convert resp to dict
-        response = dict(parse_qsl(resp.text))
-        print(resp.content)
-        print(response)
+class ProviderHealthView(APIView):
+    """
+    Circuit breaker state and counters of each identity provider in this process
+    """
+    permission_classes = [IsAdminUser, ]
 
-        return Response(response, status=status.HTTP_200_OK)
+    @staticmethod
+    def get(request):
+        return Response({name: breaker.metrics() for name, breaker in circuit_breakers.items()},
+                        status=status.HTTP_200_OK)
+
+
+# Native async variants of the social auth views, used instead of the views above when
+# SOCIAL_AUTH_ASYNC_VIEWS is enabled and the project is served over ASGI. Django 3.2 has no
+# async class-based views and DRF is sync only, so these are plain coroutine views that accept
+# the same payloads and return the same responses. Provider calls run on worker threads so the
+# event loop keeps serving other requests while they wait on the network.
+
+def _request_data(request, *fields):
+    if request.method != 'POST':
+        return None, JsonResponse({'detail': f'Method "{request.method}" not allowed.'},
+                                  status=status.HTTP_405_METHOD_NOT_ALLOWED)
+    if request.content_type == 'application/json':
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            return None, JsonResponse({'detail': 'JSON parse error.'}, status=status.HTTP_400_BAD_REQUEST)
+        if not isinstance(data, dict):
+            # same error as the serializers of the sync views
+            return None, JsonResponse(
+                {'non_field_errors': [f'Invalid data. Expected a dictionary, but got {type(data).__name__}.']},
+                status=status.HTTP_400_BAD_REQUEST)
+    else:
+        data = request.POST
+    missing = {field: ['This field is required.'] for field in fields if not data.get(field)}
+    if missing:
+        return None, JsonResponse(missing, status=status.HTTP_400_BAD_REQUEST)
+    return data, None
+
+
+def _error_response(exc, field=None):
+    if isinstance(exc, ValidationError):
+        detail = {field: exc.detail}
+    else:
+        detail = {'detail': exc.detail}
+    return JsonResponse(detail, status=exc.status_code)
+
+
+async def _social_login(provider, email, full_name):
+    user = await sync_to_async(register_social_user)(provider=provider, email=email, full_name=full_name)
+    return await sync_to_async(token_response_data)(user)
+
+
+async def google_social_auth(request):
+    data, error = _request_data(request, 'auth_token')
+    if error:
+        return error
+    try:
+        email, full_name = google_identity(await Google.avalidate(data['auth_token']))
+        return JsonResponse(await _social_login('google', email, full_name))
+    except APIException as exc:
+        return _error_response(exc, 'auth_token')
+
+
+async def facebook_social_auth(request):
+    data, error = _request_data(request, 'auth_token')
+    if error:
+        return error
+    try:
+        email, full_name = facebook_identity(await Facebook.avalidate(data['auth_token']))
+        return JsonResponse(await _social_login('facebook', email, full_name))
+    except APIException as exc:
+        return _error_response(exc, 'auth_token')
+
+
+async def twitter_social_auth(request):
+    data, error = _request_data(request, 'oauth_token', 'oauth_verifier')
+    if error:
+        return error
+    try:
+        access_token = await Twitter.aget_access_token(data['oauth_token'], data['oauth_verifier'])
+        email, full_name = twitter_identity(await Twitter.aget_user_data(access_token))
+        return JsonResponse(await _social_login('twitter', email, full_name))
+    except APIException as exc:
+        return _error_response(exc, 'non_field_errors')
+
+
+# csrf_exempt() would wrap the coroutines in a sync view on Django 3.2, so set the flag directly
+for view in (google_social_auth, facebook_social_auth, twitter_social_auth):
+    view.csrf_exempt = True
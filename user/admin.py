@@ -1,5 +1,7 @@
 from django.contrib import admin
 
-from .models import User
+from .models import User, RefreshTokenFamily, OutboxEmail
 
 admin.site.register(User)
+admin.site.register(RefreshTokenFamily)
+admin.site.register(OutboxEmail)
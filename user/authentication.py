@@ -0,0 +1,80 @@
+import copy
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.translation import gettext_lazy as _
+
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+USER_CACHE_CONFIG = getattr(settings, 'JWT_USER_CACHE', {})
+
+
+def user_cache():
+    return caches[USER_CACHE_CONFIG.get('CACHE', 'default')]
+
+
+def user_generation_key(user_id):
+    return f'jwt-user-generation:{user_id}'
+
+
+def user_generation_timeout():
+    # outlives every entry cached under the generation, and every access token issued while it was current
+    return USER_CACHE_CONFIG.get('TTL', 60) + int(api_settings.ACCESS_TOKEN_LIFETIME.total_seconds())
+
+
+def user_cache_key(user_id):
+    # a principal loaded before an invalidation is stored under the previous generation, where nobody looks
+    return f'jwt-user:{user_id}:{user_cache().get(user_generation_key(user_id), 0)}'
+
+
+def invalidate_cached_user(user_id):
+    """
+    Drop the cached principal for the given user id
+    """
+    cache = user_cache()
+    cache.delete(user_cache_key(user_id))
+    cache.set(user_generation_key(user_id), uuid.uuid4().hex, user_generation_timeout())
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWT authentication that caches user id -> user principal in the
+    JWT_USER_CACHE["CACHE"] cache (the tiered cache by default).
+
+    The token signature and expiry are still verified on every request, only
+    the user row fetch is skipped on a cache hit. The principal is loaded
+    without the `password` column and each request gets its own copy.
+    Entries are dropped by the `post_save`/`post_delete` signals on User
+    (see `user.signals`), which covers password changes as well, and the
+    user's cache generation is replaced, so a principal another process
+    loaded just before the change is stored under a key no longer read.
+    Other processes may keep serving their in-process copy for up to the
+    tiered cache's L1_TTL.
+
+    `request.user` is therefore a read-only snapshot: code that writes to
+    the user loads the row itself, or saves with `update_fields` limited
+    to the columns it changes, so stale values are never written back.
+    """
+
+    def get_user(self, validated_token):
+        try:
+            user_id = str(validated_token[api_settings.USER_ID_CLAIM])
+        except KeyError:
+            raise InvalidToken(_('Token contained no recognizable user identification'))
+
+        try:
+            user = user_cache().get_or_set(
+                user_cache_key(user_id),
+                lambda: self.user_model.objects.defer('password').get(**{api_settings.USER_ID_FIELD: user_id}),
+                USER_CACHE_CONFIG.get('TTL', 60),
+            )
+        except self.user_model.DoesNotExist:
+            raise AuthenticationFailed(_('User not found'), code='user_not_found')
+
+        if not user.is_active:
+            raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+
+        return copy.copy(user)
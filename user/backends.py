@@ -0,0 +1,31 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+
+from utils.hashing import password_hashing, password_needs_rehash
+
+User = get_user_model()
+
+
+class PooledModelBackend(ModelBackend):
+    """
+    Model backend that checks passwords on the password hashing pool
+    (`utils.hashing.password_hashing`) instead of the request thread, and
+    upgrades hashes made with other than the preferred hasher or parameters.
+    """
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        if username is None:
+            username = kwargs.get(User.USERNAME_FIELD)
+        if username is None or password is None:
+            return None
+        user = User._default_manager.filter(**{User.USERNAME_FIELD: username}).first()
+        if user is None:
+            # hash anyway so unknown emails take as long as wrong passwords
+            password_hashing.make_password(password)
+            return None
+        if not password_hashing.check_password(password, user.password) or not self.user_can_authenticate(user):
+            return None
+        if password_needs_rehash(user.password):
+            user.password = password_hashing.make_password(password)
+            user.save(update_fields=['password'])
+        return user
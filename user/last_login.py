@@ -0,0 +1,82 @@
+import atexit
+import logging
+from threading import Event, Lock, Thread
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connections
+from django.utils import timezone
+
+from rest_framework_simplejwt.settings import api_settings
+
+logger = logging.getLogger(__name__)
+
+LAST_LOGIN_BUFFER_CONFIG = getattr(settings, 'LAST_LOGIN_BUFFER', {})
+
+
+class LastLoginBuffer:
+    """
+    Write-behind buffer for `User.last_login`.
+
+    Logins only record the timestamp in memory, keyed by user id so repeated
+    logins of the same user coalesce into one row. A background thread writes
+    the pending timestamps with a single bulk UPDATE at least every
+    `max_staleness` seconds, or as soon as `max_size` users are pending.
+    Whatever is left is written when the worker exits.
+    """
+
+    def __init__(self, max_staleness=60, max_size=1000):
+        self.max_staleness = max_staleness
+        self.max_size = max_size
+        self._pending = {}
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._thread = None
+
+    def _ensure_started(self):
+        if self._thread is None:
+            self._thread = Thread(target=self._run, name='last-login-buffer', daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def record(self, user, when=None):
+        """
+        Record a login for the given user
+        """
+        if not api_settings.UPDATE_LAST_LOGIN:
+            return
+        with self._lock:
+            self._pending[user.pk] = when or timezone.now()
+            self._ensure_started()
+            if len(self._pending) >= self.max_size:
+                self._wakeup.set()
+
+    def flush(self):
+        """
+        Write every pending timestamp in one bulk UPDATE
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        User = get_user_model()
+        try:
+            User.objects.bulk_update(
+                [User(pk=pk, last_login=last_login) for pk, last_login in pending.items()],
+                ['last_login'],
+            )
+        except Exception as e:
+            logger.error(f'Could not flush last_login for {len(pending)} users: {e}')
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.max_staleness)
+            self._wakeup.clear()
+            self.flush()
+            connections.close_all()
+
+
+last_login_buffer = LastLoginBuffer(
+    max_staleness=LAST_LOGIN_BUFFER_CONFIG.get('MAX_STALENESS', 60),
+    max_size=LAST_LOGIN_BUFFER_CONFIG.get('MAX_SIZE', 1000),
+)
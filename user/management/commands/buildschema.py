@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from utils.openapi import openapi_schema
+
+
+class Command(BaseCommand):
+    help = 'Generates the OpenAPI schema and writes its compressed variants for the web processes to load'
+
+    def handle(self, *args, **kwargs):
+        files = openapi_schema.build()
+        for schema_format, schema_file in files.items():
+            sizes = f'{len(schema_file.identity)} bytes, gzip {len(schema_file.gzip)}'
+            if schema_file.br is not None:
+                sizes += f', brotli {len(schema_file.br)}'
+            self.stdout.write(f'{schema_format}: {sizes}')
+        if openapi_schema.path:
+            self.stdout.write(f'Written to {openapi_schema.path}')
@@ -0,0 +1,109 @@
+import json
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.hashers import get_hasher, get_hashers
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import import_string
+
+# algorithm -> (parameter, how the cost scales with the parameter, Django's default value)
+TUNABLE_PARAMS = {
+    'pbkdf2_sha256': ('iterations', 'linear', 260000),
+    'argon2': ('time_cost', 'linear', 2),
+    'scrypt': ('work_factor', 'power_of_two', 2 ** 14),
+}
+
+
+def time_hash(hasher_path, param, value, rounds):
+    """
+    Return the mean seconds per hash of the given hasher
+    """
+    hasher = import_string(hasher_path)()
+    if param:
+        setattr(hasher, param, value)
+    salt = hasher.salt()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        hasher.encode('calibration-password-1', salt)
+    return (time.perf_counter() - start) / rounds
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the configured PASSWORD_HASHERS and picks parameters that meet a latency budget'
+
+    def add_arguments(self, parser):
+        config = getattr(settings, 'PASSWORD_HASHER_CALIBRATION', {})
+        parser.add_argument('--target-ms', type=float, default=config.get('TARGET_MS', 50),
+                            help='Maximum milliseconds per hash while CONCURRENCY hashes run at once')
+        parser.add_argument('--concurrency', type=int, default=config.get('CONCURRENCY', os.cpu_count() or 1),
+                            help='Number of hashes running at the same time')
+        parser.add_argument('--rounds', type=int, default=3, help='Hashes per measurement')
+        parser.add_argument('--allow-weaker', action='store_true',
+                            help="Allow parameters below Django's defaults")
+        parser.add_argument('--write', action='store_true',
+                            help='Write the picked parameters to PASSWORD_HASHER_CALIBRATION["FILE"]')
+
+    def measure(self, pool, hasher_path, param, value, options):
+        concurrency = options['concurrency']
+        futures = [pool.submit(time_hash, hasher_path, param, value, options['rounds']) for _ in range(concurrency)]
+        return sum(future.result() for future in futures) / concurrency
+
+    def calibrate(self, pool, hasher_path, param, scaling, value, floor, options):
+        target = options['target_ms'] / 1000
+        for _ in range(3):
+            latency = self.measure(pool, hasher_path, param, value, options)
+            scaled = value * target / latency
+            if scaling == 'power_of_two':
+                scaled = 2 ** max(1, math.floor(math.log2(scaled)))
+            else:
+                scaled = max(1, int(scaled))
+            if not options['allow_weaker']:
+                scaled = max(scaled, floor)
+            if scaled == value:
+                break
+            value = scaled
+        return value, self.measure(pool, hasher_path, param, value, options)
+
+    def handle(self, *args, **options):
+        concurrency = options['concurrency']
+        self.stdout.write(f"Target: <= {options['target_ms']} ms per hash at {concurrency} concurrent workers\n")
+        results = {}
+        # only the first of PASSWORD_HASHERS makes new hashes, the others matter once it is switched to them
+        preferred = get_hasher('default').algorithm
+
+        with ProcessPoolExecutor(max_workers=concurrency) as pool:
+            for hasher in get_hashers():
+                hasher_path = f'{type(hasher).__module__}.{type(hasher).__qualname__}'
+                param, scaling, floor = TUNABLE_PARAMS.get(hasher.algorithm, (None, None, None))
+                value = getattr(hasher, param) if param else None
+                try:
+                    single = pool.submit(time_hash, hasher_path, param, value, options['rounds']).result()
+                except ValueError as e:
+                    self.stdout.write(f'{hasher.algorithm}: not available ({e})')
+                    continue
+
+                line = f'{hasher.algorithm}: {single * 1000:.1f} ms/hash, {1 / single:.1f} hashes/s per core'
+                if param:
+                    line += f' ({param}={value})'
+                if hasher.algorithm == preferred:
+                    line += ', hashes new passwords'
+                self.stdout.write(line)
+
+                if not param:
+                    continue
+                picked, latency = self.calibrate(pool, hasher_path, param, scaling, value, floor, options)
+                results[hasher.algorithm] = {param: picked}
+                status = 'ok' if latency * 1000 <= options['target_ms'] else 'over budget'
+                self.stdout.write(f'    picked {param}={picked}: {latency * 1000:.1f} ms/hash '
+                                  f'at {concurrency} concurrent ({status})')
+
+        path = getattr(settings, 'PASSWORD_HASHER_CALIBRATION', {}).get('FILE')
+        if options['write'] and path:
+            with open(path, 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Wrote {path}, passwords are rehashed on the next login'))
+        else:
+            self.stdout.write(json.dumps(results, indent=2))
@@ -0,0 +1,130 @@
+import random
+import signal
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from user.models import OutboxEmail
+from utils.email import Email
+
+EMAIL_OUTBOX_CONFIG = getattr(settings, 'EMAIL_OUTBOX', {})
+
+
+def pending_emails(now):
+    return OutboxEmail.objects.filter(
+        sent_at__isnull=True, failed_at__isnull=True, next_attempt_at__lte=now).order_by('next_attempt_at')
+
+
+def claim_batch(batch_size, lease):
+    """
+    Claim up to `batch_size` due emails for `lease` seconds and return them.
+    A dispatcher that dies mid-batch leaves its rows to be picked up again
+    once the lease runs out.
+    """
+    now = timezone.now()
+    claim = uuid.uuid4()
+    claimed = {'claim': claim, 'next_attempt_at': now + timedelta(seconds=lease), 'attempts': F('attempts') + 1}
+    with transaction.atomic():
+        if connection.features.has_select_for_update_skip_locked:
+            ids = list(pending_emails(now).select_for_update(skip_locked=True).values_list('id', flat=True)[:batch_size])
+            OutboxEmail.objects.filter(id__in=ids).update(**claimed)
+        else:
+            # no SKIP LOCKED (SQLite): writes are serialized, so a conditional UPDATE claims the rows atomically
+            OutboxEmail.objects.filter(
+                id__in=pending_emails(now).values('id')[:batch_size], next_attempt_at__lte=now).update(**claimed)
+    return list(OutboxEmail.objects.filter(claim=claim))
+
+
+def purge_emails(retention):
+    """
+    Delete the emails sent or given up on more than `retention` seconds ago
+    """
+    cutoff = timezone.now() - timedelta(seconds=retention)
+    deleted, _ = OutboxEmail.objects.filter(Q(sent_at__lt=cutoff) | Q(failed_at__lt=cutoff)).delete()
+    return deleted
+
+
+class Command(BaseCommand):
+    help = ('Sends the emails queued in the outbox, in batches, retrying failures with exponential backoff, '
+            'and deletes old sent and failed emails')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=EMAIL_OUTBOX_CONFIG.get('BATCH_SIZE', 100))
+        parser.add_argument('--poll-interval', type=float, default=EMAIL_OUTBOX_CONFIG.get('POLL_INTERVAL', 1),
+                            help='Seconds to wait when the outbox is empty')
+        parser.add_argument('--once', action='store_true', help='Exit once no email is due')
+
+    def backoff(self, attempts):
+        base = EMAIL_OUTBOX_CONFIG.get('BACKOFF_BASE', 30)
+        delay = min(base * 2 ** (attempts - 1), EMAIL_OUTBOX_CONFIG.get('BACKOFF_MAX', 3600))
+        return timedelta(seconds=delay * random.uniform(0.8, 1.2))
+
+    def send_batch(self, mail_connection, emails):
+        max_attempts = EMAIL_OUTBOX_CONFIG.get('MAX_ATTEMPTS', 8)
+        sent = []
+        for email in emails:
+            try:
+                message = Email.build_html_email(
+                    email.template, {'to': email.to, 'subject': email.subject, 'context': email.context})
+                mail_connection.open()
+                mail_connection.send_messages([message])
+            except Exception as e:
+                # start over on a fresh connection for the next email
+                mail_connection.close()
+                now = timezone.now()
+                email.last_error = str(e)
+                if email.attempts >= max_attempts:
+                    email.failed_at = now
+                    email.context = {}
+                    self.stderr.write(f'Giving up on email {email.id} after {email.attempts} attempts: {e}')
+                else:
+                    email.next_attempt_at = now + self.backoff(email.attempts)
+                email.save(update_fields=['last_error', 'failed_at', 'next_attempt_at', 'context'])
+            else:
+                sent.append(email.id)
+        # the context holds the verification and reset links, which are not kept once sent
+        OutboxEmail.objects.filter(id__in=sent).update(sent_at=timezone.now(), claim=None, context={})
+        return len(sent)
+
+    def handle(self, *args, **options):
+        lease = EMAIL_OUTBOX_CONFIG.get('LEASE', 300)
+        retention = EMAIL_OUTBOX_CONFIG.get('RETENTION', 7 * 24 * 3600)
+        purge_interval = EMAIL_OUTBOX_CONFIG.get('PURGE_INTERVAL', 3600)
+        stopping = []
+        signal.signal(signal.SIGTERM, lambda *_: stopping.append(True))
+
+        mail_connection = get_connection()
+        total = 0
+        busy = 0
+        purged_at = None
+        try:
+            while not stopping:
+                if purged_at is None or time.monotonic() - purged_at >= purge_interval:
+                    purged = purge_emails(retention)
+                    purged_at = time.monotonic()
+                    if purged:
+                        self.stdout.write(f'Deleted {purged} emails older than {retention}s')
+                start = time.perf_counter()
+                emails = claim_batch(options['batch_size'], lease)
+                if emails:
+                    total += self.send_batch(mail_connection, emails)
+                    busy += time.perf_counter() - start
+                    continue
+                if options['once']:
+                    break
+                mail_connection.close()
+                time.sleep(options['poll_interval'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            mail_connection.close()
+
+        # time spent waiting on an empty outbox is left out of the rate
+        self.stdout.write(f'Sent {total} emails in {busy:.1f}s ({total / busy if busy else 0:.1f}/s)')
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from rest_framework_simplejwt.utils import aware_utcnow
+
+from user.models import RefreshTokenFamily
+
+
+class Command(BaseCommand):
+    help = 'Flushes expired or revoked refresh token families'
+
+    def handle(self, *args, **kwargs):
+        deleted, _ = RefreshTokenFamily.objects.filter(
+            Q(expires_at__lte=aware_utcnow()) | Q(revoked_at__isnull=False)
+        ).delete()
+        self.stdout.write(f'Deleted {deleted} refresh token families')
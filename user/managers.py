@@ -15,6 +15,21 @@ class CustomUserManager(BaseUserManager):
         user.save()
         return user
 
+    def create_social_user(self, username, email, auth_provider, **extra_fields):
+        """
+        Create a verified user whose identity comes from a social provider.
+        Social users have no phone and an unusable password.
+        """
+        if not username:
+            raise ValueError(_('The username must be set'))
+        if not email:
+            raise ValueError(_('The email must be set'))
+        extra_fields.setdefault('is_verified', True)
+        user = self.model(username=username, email=email, auth_provider=auth_provider, **extra_fields)
+        user.set_unusable_password()
+        user.save(force_insert=True)
+        return user
+
     def create_superuser(self,  username, email, phone, password, **extra_fields):
         extra_fields['is_staff'] = True
         extra_fields['is_superuser'] = True
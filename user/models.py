@@ -5,7 +5,7 @@ from django.contrib.auth.models import PermissionsMixin
 from django.contrib.auth.validators import UnicodeUsernameValidator
 from django.utils.translation import gettext_lazy as _
 
-from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+from rest_framework_simplejwt.tokens import AccessToken
 
 from .managers import CustomUserManager
 from utils.common_models import TimeStampedUUIDModel
@@ -40,6 +40,8 @@ class User(AbstractBaseUser, PermissionsMixin, TimeStampedUUIDModel):
                               )
     phone = models.CharField(max_length=15,
                              unique=True,
+                             null=True,
+                             blank=True,
                              validators=[
                                  MinLengthValidator(10, message='Phone number must be at least 10 digits')
                              ],
@@ -58,8 +60,10 @@ class User(AbstractBaseUser, PermissionsMixin, TimeStampedUUIDModel):
     objects = CustomUserManager()
 
     def tokens(self):
+        from .tokens import FamilyRefreshToken
+
         access_token = AccessToken.for_user(self)
-        refresh_token = RefreshToken.for_user(self)
+        refresh_token = FamilyRefreshToken.for_user(self)
         return {
             'access': access_token,
             'refresh': refresh_token,
@@ -67,3 +71,52 @@ class User(AbstractBaseUser, PermissionsMixin, TimeStampedUUIDModel):
 
     def __str__(self):
         return self.username
+
+
+class RefreshTokenFamily(TimeStampedUUIDModel):
+    """
+    One row per login session.
+    Every refresh token rotated from the session carries the family id and the
+    generation it was issued at, so reuse of an already rotated token is
+    detected without keeping a row per issued token.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='refresh_token_families')
+    generation = models.PositiveIntegerField(default=0)
+    expires_at = models.DateTimeField()
+    revoked_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name_plural = 'refresh token families'
+
+    def __str__(self):
+        return f'Refresh token family for {self.user} (generation {self.generation})'
+
+
+class OutboxEmail(TimeStampedUUIDModel):
+    """
+    An email waiting to be sent by the `dispatchemails` command.
+    Rows are written in the same transaction as the change that triggers
+    them, so an email is neither lost on restart nor sent for a rolled back
+    change. The context, which holds verification and reset links, is
+    cleared once the email is sent or given up on, and those rows are
+    deleted after EMAIL_OUTBOX["RETENTION"].
+    """
+    template = models.CharField(max_length=255)
+    subject = models.CharField(max_length=255)
+    to = models.JSONField()
+    context = models.JSONField(default=dict)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(auto_now_add=True)
+    claim = models.UUIDField(null=True, blank=True, editable=False)
+    last_error = models.TextField(blank=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    failed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['next_attempt_at'], name='outbox_pending_idx',
+                         condition=models.Q(sent_at__isnull=True, failed_at__isnull=True)),
+        ]
+
+    def __str__(self):
+        return f'{self.subject} to {", ".join(self.to)}'
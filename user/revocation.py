@@ -0,0 +1,124 @@
+import hashlib
+import logging
+import math
+import time
+from threading import Lock
+
+from django.conf import settings
+
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+
+logger = logging.getLogger(__name__)
+
+REVOCATION_INDEX_CONFIG = getattr(settings, 'TOKEN_REVOCATION_INDEX', {})
+
+
+class BloomFilter:
+    """
+    Fixed size bloom filter using double hashing over a single blake2b digest
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class RevocationIndex:
+    """
+    In-memory index of blacklisted refresh token jtis.
+
+    A bloom filter sits in front of the exact jti set so that the common case
+    (a token that was never blacklisted) is answered without touching the set
+    or the database. The index is loaded from BlacklistedToken on first use and
+    then, at most once every SYNC_INTERVAL seconds, pulls the rows from
+    `rescan_rows` ids behind the highest one it has seen: ids are handed out
+    at insert but rows become visible at commit, so a row may show up after
+    rows with higher ids. Tokens blacklisted by this process are added
+    immediately.
+
+    Rows blacklisted by other processes may be missed until the next sync, so
+    callers that need a hard guarantee must still rely on the database write
+    (see `user.tokens.IndexedRefreshToken`).
+    """
+
+    def __init__(self, capacity=1000000, error_rate=0.001, sync_interval=30, rescan_rows=1000):
+        self.error_rate = error_rate
+        self.sync_interval = sync_interval
+        self.rescan_rows = rescan_rows
+        self._bloom = BloomFilter(capacity, error_rate)
+        self._jtis = set()
+        self._last_id = 0
+        self._last_sync = None
+        self._lock = Lock()
+
+    def _add(self, jti):
+        if jti in self._jtis:
+            return
+        self._jtis.add(jti)
+        if len(self._jtis) > self._bloom.capacity:
+            # grow and rebuild so the false positive rate stays bounded, readers keep
+            # the old filter (which has every jti but this one) until the new one is full
+            bloom = BloomFilter(self._bloom.capacity * 2, self.error_rate)
+            for known_jti in self._jtis:
+                bloom.add(known_jti)
+            self._bloom = bloom
+        else:
+            self._bloom.add(jti)
+
+    def sync(self):
+        """
+        Pull blacklisted tokens created since the last sync, and those of the
+        last `rescan_rows` ids again in case they committed late
+        """
+        with self._lock:
+            start_id = max(self._last_id - self.rescan_rows, 0)
+            rows = BlacklistedToken.objects.filter(id__gt=start_id).order_by('id') \
+                .values_list('id', 'token__jti')
+            count = len(self._jtis)
+            for row_id, jti in rows.iterator(chunk_size=10000):
+                self._add(jti)
+                self._last_id = max(self._last_id, row_id)
+            count = len(self._jtis) - count
+            self._last_sync = time.monotonic()
+        if count:
+            logger.debug('Revocation index synced %s blacklisted tokens', count)
+
+    def _sync_if_stale(self):
+        if self._last_sync is None or time.monotonic() - self._last_sync >= self.sync_interval:
+            self.sync()
+
+    def add(self, jti):
+        with self._lock:
+            self._add(jti)
+
+    def __contains__(self, jti):
+        self._sync_if_stale()
+        if jti not in self._bloom:
+            return False
+        return jti in self._jtis
+
+    def __len__(self):
+        return len(self._jtis)
+
+
+revocation_index = RevocationIndex(
+    capacity=REVOCATION_INDEX_CONFIG.get('CAPACITY', 1000000),
+    error_rate=REVOCATION_INDEX_CONFIG.get('ERROR_RATE', 0.001),
+    sync_interval=REVOCATION_INDEX_CONFIG.get('SYNC_INTERVAL', 30),
+    rescan_rows=REVOCATION_INDEX_CONFIG.get('RESCAN_ROWS', 1000),
+)
@@ -1,7 +1,8 @@
 import logging
 
+from django.db import transaction
 from django.urls import reverse
-from django.contrib.auth import get_user_model, authenticate
+from django.contrib.auth import authenticate, get_user_model
 from django.contrib.sites.shortcuts import get_current_site
 from django.utils.encoding import force_str
 from django.utils.http import urlsafe_base64_decode
@@ -9,8 +10,11 @@ from django.contrib.auth.tokens import PasswordResetTokenGenerator
 
 from rest_framework import serializers, status
 from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.settings import api_settings
 
-from utils.email import Email
+from .tokens import FamilyRefreshToken
+from utils.email import Email, email_coalescer, PASSWORD_RESET_EMAIL, VERIFICATION_EMAIL
+from utils.hashing import password_hashing, PasswordHashingUnavailable
 from utils.token import get_access_token
 from utils.password import validate_password
 
@@ -60,18 +64,20 @@ class UserRegistrationRequestSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError('Phone is required')
         return attrs
 
+    @transaction.atomic
     def create(self, validated_data):
         password = validated_data.pop('password')
         user = User(**validated_data)
-        user.set_password(password)
+        user.password = password_hashing.make_password(password)
         user.is_active = True
         user.save()
 
-        # generate verification token
-        token = get_access_token(user)
+        # generate verification token, the claim keeps logins right after registering from sending another one
+        email_coalescer.claim(user, VERIFICATION_EMAIL)
+        token = str(get_access_token(user))
         current_site = get_current_site(self.context['request']).domain
         relativelink = reverse('user:email-verify')
-        absurl = 'http://{0}{1}?token={2}'.format(current_site, relativelink, str(token))
+        absurl = 'http://{0}{1}?token={2}'.format(current_site, relativelink, token)
 
         #  send verification email to user
         # Email.sendgrid_email({
@@ -80,8 +86,8 @@ class UserRegistrationRequestSerializer(serializers.ModelSerializer):
         #     'body': 'Your verification link is {0}'.format(absurl)
         # })
 
-        # send verification email with template to user
-        Email.send_html_email("email/user_verification.html", {
+        # queue verification email with template to user, committed together with the user
+        Email.outbox_html_email("email/user_verification.html", {
             'to': [user.email],
             'subject': 'Verify your account',
             'context': {
@@ -106,25 +112,27 @@ class UserLoginRequestSerializer(serializers.Serializer):
         attrs = super().validate(attrs)
         email = attrs.get('email')
         password = attrs.get('password')
-        user = authenticate(email=email, password=password)
+        # user.backends.PooledModelBackend checks the password on the hashing pool
+        user = authenticate(self.context.get('request'), email=email, password=password)
         if not user:
             raise serializers.ValidationError({'message': 'Invalid credentials'})
         elif user and not user.is_verified:
-            # generate verification token
-            token = get_access_token(user)
-            current_site = get_current_site(self.context['request']).domain
-            relativelink = reverse('user:email-verify')
-            absurl = 'http://{0}{1}?token={2}'.format(current_site, relativelink, str(token))
-            # send verification email with template to user
-            Email.send_html_email("email/user_verification.html", {
-                'to': [user.email],
-                'subject': 'Verify your account',
-                'context': {
-                    'absurl': absurl,
-                    'full_name': user.full_name,
-                }
-            })
-            return AuthenticationFailed({'message': 'Please verify email to continue'})
+            # generate verification token, unless one was sent recently
+            if email_coalescer.claim(user, VERIFICATION_EMAIL):
+                token = str(get_access_token(user))
+                current_site = get_current_site(self.context['request']).domain
+                relativelink = reverse('user:email-verify')
+                absurl = 'http://{0}{1}?token={2}'.format(current_site, relativelink, token)
+                # queue verification email with template to user
+                Email.outbox_html_email("email/user_verification.html", {
+                    'to': [user.email],
+                    'subject': 'Verify your account',
+                    'context': {
+                        'absurl': absurl,
+                        'full_name': user.full_name,
+                    }
+                })
+            raise AuthenticationFailed({'message': 'Please verify email to continue'})
         elif user.auth_provider != 'email':
             raise AuthenticationFailed({'message': f'Please continue your login using {user.auth_provider}'})
         attrs['user'] = user
@@ -154,8 +162,9 @@ class UserPasswordChangeRequestSerializer(serializers.Serializer):
                 'message': 'New password and confirm password does not match'
             })
         request = self.context.get('request')
-        user = authenticate(password=attrs['old_password'], email=request.user.email)
-        if not user:
+        # the principal is loaded without its password, fetch only the hash
+        encoded = User.objects.filter(pk=request.user.pk).values_list('password', flat=True).get()
+        if not password_hashing.check_password(attrs['old_password'], encoded):
             raise serializers.ValidationError({
                 'message': 'Invalid credentials'
             })
@@ -205,8 +214,31 @@ class SetNewPasswordSerializer(serializers.Serializer):
             user = User.objects.get(pk=uid)
             if not PasswordResetTokenGenerator().check_token(user, token):
                 raise AuthenticationFailed('The reset link is invalid', status.HTTP_401_UNAUTHORIZED)
-            user.set_password(password)
+            user.password = password_hashing.make_password(password)
             user.save()
+            email_coalescer.reset(user, PASSWORD_RESET_EMAIL)
             return attrs
+        except PasswordHashingUnavailable:
+            raise
         except Exception as e:
             raise AuthenticationFailed('The reset link is invalid', status.HTTP_401_UNAUTHORIZED)
+
+
+class TokenRefreshRequestSerializer(serializers.Serializer):
+    """
+    Serializer for refresh token rotation backed by refresh token families
+    """
+    refresh = serializers.CharField()
+    access = serializers.CharField(read_only=True)
+
+    def validate(self, attrs):
+        refresh = FamilyRefreshToken(attrs['refresh'])
+        data = {'access': str(refresh.access_token)}
+
+        if api_settings.ROTATE_REFRESH_TOKENS:
+            refresh.rotate()
+            data['refresh'] = str(refresh)
+        else:
+            refresh.check_family()
+
+        return data
@@ -1,3 +1,473 @@
-from django.test import TestCase
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from django.contrib.auth.signals import user_login_failed
+from django.core import mail
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from user.authentication import user_cache_key, user_generation_key
+from user.last_login import LastLoginBuffer
+from user.models import OutboxEmail, RefreshTokenFamily, User
+from user.revocation import BloomFilter, RevocationIndex
+from user.tokens import FAMILY_CLAIM, GENERATION_CLAIM, FamilyRefreshToken
+from user.views import user_etag
+from utils.token import get_access_token
+from utils.email import Email
+from utils.tests import TEST_CACHES
+
+
+@override_settings(CACHES=TEST_CACHES)
+class JWTUserCacheTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='john', email='john@example.com', full_name='John Doe')
+        self.user.set_password('Str0ng#password')
+        self.user.save()
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Token {get_access_token(self.user)}'
+
+    def test_principal_is_cached(self):
+        self.assertEqual(self.client.get('/user/current/').status_code, 200)
+        self.assertIsNotNone(cache.get(user_cache_key(self.user.pk)))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/user/current/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(queries), 0)
+
+    def test_saving_the_user_drops_the_entry(self):
+        self.client.get('/user/current/')
+        self.user.full_name = 'Jane Doe'
+        self.user.save()
+        self.assertIsNone(cache.get(user_cache_key(self.user.pk)))
+        self.assertEqual(self.client.get('/user/current/').json()['full_name'], 'Jane Doe')
+
+    def test_inactive_user_is_rejected(self):
+        self.client.get('/user/current/')
+        self.user.is_active = False
+        self.user.save()
+        response = self.client.get('/user/current/')
+        # 403 rather than 401, SessionAuthentication comes first and has no WWW-Authenticate challenge
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.json()['code'], 'user_inactive')
+
+    def test_password_change_does_not_write_back_the_cached_principal(self):
+        self.client.get('/user/current/')
+        # changed by another process whose invalidation has not reached this one's cache yet
+        User.objects.filter(pk=self.user.pk).update(full_name='Jane Doe')
+        response = self.client.post('/user/password-change/', {
+            'old_password': 'Str0ng#password', 'new_password': 'N3w#password', 'confirm_password': 'N3w#password'})
+        self.assertEqual(response.status_code, 200)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.full_name, 'Jane Doe')
+        self.assertTrue(self.user.check_password('N3w#password'))
+
+    def test_principal_loaded_before_an_invalidation_is_not_served(self):
+        stale_key = user_cache_key(self.user.pk)
+        self.user.full_name = 'Jane Doe'
+        self.user.save()
+        # written back by a request that loaded the user before the save
+        cache.set(stale_key, User(pk=self.user.pk, email='john@example.com', full_name='John Doe'))
+        self.assertEqual(self.client.get('/user/current/').json()['full_name'], 'Jane Doe')
+
+    def test_generation_expires(self):
+        self.user.save()
+        shared = caches['shared']
+        expires_at = shared._expire_info[shared.make_key(user_generation_key(self.user.pk))]
+        self.assertIsNotNone(expires_at)
+        # no sooner than the access tokens issued under it
+        self.assertGreater(expires_at, time.time() + api_settings.ACCESS_TOKEN_LIFETIME.total_seconds())
+
+
+class RevocationIndexTestCase(TestCase):
+
+    def setUp(self):
+        self.index = RevocationIndex(capacity=4, sync_interval=0, rescan_rows=10)
+
+    @staticmethod
+    def blacklist(jti, **kwargs):
+        token = OutstandingToken.objects.create(jti=jti, token='', expires_at=timezone.now())
+        return BlacklistedToken.objects.create(token=token, **kwargs)
+
+    def test_blacklisted_tokens_are_found(self):
+        self.blacklist('revoked')
+        self.assertIn('revoked', self.index)
+        self.assertNotIn('valid', self.index)
+        self.blacklist('revoked-later')
+        self.assertIn('revoked-later', self.index)
+
+    def test_row_committed_behind_the_last_id_is_found(self):
+        late_id = self.blacklist('first').id + 1
+        self.blacklist('third', id=late_id + 1)
+        self.assertIn('third', self.index)
+        # the row that got the lower id commits after the index moved past it
+        self.blacklist('second', id=late_id)
+        self.assertIn('second', self.index)
+        self.assertEqual(len(self.index), 3)
+
+    def test_readers_never_see_a_partially_filled_filter(self):
+        add = BloomFilter.add
+        added = []
+
+        def checked_add(bloom, key):
+            # everything added before the jti being added now must stay visible
+            missing = [jti for jti in added[:-1] if jti not in self.index._bloom]
+            self.assertEqual(missing, [])
+            add(bloom, key)
+
+        with mock.patch.object(BloomFilter, 'add', checked_add):
+            for i in range(20):
+                added.append(f'jti-{i}')
+                self.index.add(f'jti-{i}')
+        self.assertGreaterEqual(self.index._bloom.capacity, 20)
+        self.assertTrue(all(f'jti-{i}' in self.index for i in range(20)))
+
+
+@override_settings(CACHES=TEST_CACHES)
+class RefreshTokenFamilyTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='john', email='john@example.com', full_name='John Doe')
+
+    def refresh(self, token):
+        return self.client.post('/user/token/refresh/', {'refresh': str(token)})
+
+    def test_rotation_bumps_the_generation(self):
+        token = FamilyRefreshToken.for_user(self.user)
+        response = self.refresh(token)
+        self.assertEqual(response.status_code, 200)
+        rotated = FamilyRefreshToken(response.json()['refresh'])
+        self.assertEqual(rotated[FAMILY_CLAIM], token[FAMILY_CLAIM])
+        self.assertEqual(rotated[GENERATION_CLAIM], 1)
+        self.assertEqual(RefreshTokenFamily.objects.get().generation, 1)
+        self.assertEqual(self.refresh(rotated).status_code, 200)
+
+    def test_reuse_revokes_the_family(self):
+        token = FamilyRefreshToken.for_user(self.user)
+        rotated = self.refresh(token).json()['refresh']
+        self.assertEqual(self.refresh(token).status_code, 401)
+        self.assertIsNotNone(RefreshTokenFamily.objects.get().revoked_at)
+        # the legitimate holder is logged out too
+        self.assertEqual(self.refresh(rotated).status_code, 401)
+
+    def test_only_one_of_two_concurrent_rotations_succeeds(self):
+        encoded = str(FamilyRefreshToken.for_user(self.user))
+        # both requests decoded the same token before either updated the family
+        first, second = FamilyRefreshToken(encoded), FamilyRefreshToken(encoded)
+        first.rotate()
+        with self.assertRaises(TokenError):
+            second.rotate()
+        self.assertIsNotNone(RefreshTokenFamily.objects.get().revoked_at)
+
+    def test_legacy_token_starts_a_family(self):
+        legacy = RefreshToken.for_user(self.user)
+        response = self.refresh(legacy)
+        self.assertEqual(response.status_code, 200)
+        family = RefreshTokenFamily.objects.get()
+        self.assertEqual(FamilyRefreshToken(response.json()['refresh'])[FAMILY_CLAIM], str(family.id))
+        self.assertTrue(BlacklistedToken.objects.filter(token__jti=legacy['jti']).exists())
+        self.assertEqual(self.refresh(legacy).status_code, 401)
+
+    def test_flush_deletes_expired_and_revoked_families(self):
+        now = timezone.now()
+        live = RefreshTokenFamily.objects.create(user=self.user, expires_at=now + timedelta(days=1))
+        RefreshTokenFamily.objects.create(user=self.user, expires_at=now - timedelta(seconds=1))
+        RefreshTokenFamily.objects.create(
+            user=self.user, expires_at=now + timedelta(days=1), revoked_at=now)
+        out = StringIO()
+        call_command('flushexpiredtokenfamilies', stdout=out)
+        self.assertEqual(list(RefreshTokenFamily.objects.all()), [live])
+        self.assertIn('Deleted 2', out.getvalue())
+
+
+@override_settings(CACHES=TEST_CACHES)
+class UserLoginTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(
+            username='john', email='john@example.com', full_name='John Doe', is_verified=True)
+        self.user.set_password('Str0ng#password')
+        self.user.save()
+
+    def login(self, password):
+        return self.client.post('/user/token/', {'email': 'john@example.com', 'password': password})
+
+    def test_login_goes_through_the_authentication_backends(self):
+        with mock.patch('user.backends.password_hashing') as password_hashing:
+            password_hashing.check_password.return_value = True
+            response = self.login('Str0ng#password')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.json()), {'access', 'refresh'})
+        password_hashing.check_password.assert_called_once_with('Str0ng#password', self.user.password)
+
+    def test_failed_login_sends_the_signal(self):
+        failures = []
+
+        def handler(sender, credentials, **kwargs):
+            failures.append(credentials)
+
+        user_login_failed.connect(handler)
+        self.addCleanup(user_login_failed.disconnect, handler)
+        self.assertEqual(self.login('Wr0ng#password').status_code, 400)
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(failures[0]['email'], 'john@example.com')
+        self.assertNotEqual(failures[0]['password'], 'Wr0ng#password')
+
+    def test_inactive_user_cannot_log_in(self):
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.login('Str0ng#password').status_code, 400)
+
+    def test_password_change_checks_the_stored_hash(self):
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Token {get_access_token(self.user)}'
+        response = self.client.post('/user/password-change/', {
+            'old_password': 'Wr0ng#password', 'new_password': 'N3w#password', 'confirm_password': 'N3w#password'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post('/user/password-change/', {
+            'old_password': 'Str0ng#password', 'new_password': 'N3w#password', 'confirm_password': 'N3w#password'})
+        self.assertEqual(response.status_code, 200)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.check_password('N3w#password'))
+
+
+@override_settings(CACHES=TEST_CACHES)
+# the flushing thread would write through its own connection, outside the test transaction
+@mock.patch.object(LastLoginBuffer, '_ensure_started')
+class LastLoginBufferTestCase(TestCase):
+
+    def setUp(self):
+        self.buffer = LastLoginBuffer(max_size=2)
+        self.john = User.objects.create(username='john', email='john@example.com', full_name='John Doe')
+        self.jane = User.objects.create(username='jane', email='jane@example.com', full_name='Jane Doe')
+
+    def test_flush_writes_the_latest_login_of_each_user_at_once(self, ensure_started):
+        first, second = timezone.now() - timedelta(minutes=1), timezone.now()
+        self.buffer.record(self.john, first)
+        self.buffer.record(self.john, second)
+        self.buffer.record(self.jane, first)
+        self.assertIsNone(User.objects.get(pk=self.john.pk).last_login)
+        with CaptureQueriesContext(connection) as queries:
+            self.buffer.flush()
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(User.objects.get(pk=self.john.pk).last_login, second)
+        self.assertEqual(User.objects.get(pk=self.jane.pk).last_login, first)
+
+    def test_flush_without_logins_does_not_query(self, ensure_started):
+        self.buffer.record(self.john)
+        self.buffer.flush()
+        with CaptureQueriesContext(connection) as queries:
+            self.buffer.flush()
+        self.assertEqual(len(queries), 0)
+
+    def test_full_buffer_wakes_the_flushing_thread(self, ensure_started):
+        self.buffer.record(self.john)
+        self.buffer.record(self.john)
+        self.assertFalse(self.buffer._wakeup.is_set())
+        self.buffer.record(self.jane)
+        self.assertTrue(self.buffer._wakeup.is_set())
+
+    def test_login_is_recorded_not_written(self, ensure_started):
+        self.john.set_password('Str0ng#password')
+        self.john.is_verified = True
+        self.john.save()
+        with mock.patch('user.views.last_login_buffer', self.buffer):
+            response = self.client.post('/user/token/', {'email': 'john@example.com', 'password': 'Str0ng#password'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(User.objects.get(pk=self.john.pk).last_login)
+        self.buffer.flush()
+        self.assertIsNotNone(User.objects.get(pk=self.john.pk).last_login)
+
+
+class OutboxDispatchTestCase(TestCase):
+
+    def queue_email(self, i):
+        return Email.outbox_html_email('email/password-reset.html', {
+            'to': [f'user{i}@example.com'],
+            'subject': 'Reset password',
+            'context': {'absurl': f'http://testserver/reset/{i}'},
+        })
+
+    def dispatch(self, **options):
+        call_command('dispatchemails', once=True, stdout=StringIO(), stderr=StringIO(), **options)
+
+    def test_sends_in_batches(self):
+        for i in range(5):
+            self.queue_email(i)
+        # purge; per batch: SAVEPOINT, claiming UPDATE, RELEASE, fetch claimed rows, mark sent; then an empty claim
+        with self.assertNumQueries(1 + 3 * 5 + 4):
+            self.dispatch(batch_size=2)
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertIn('http://testserver/reset/3', mail.outbox[3].alternatives[0][0])
+        self.assertFalse(OutboxEmail.objects.filter(sent_at__isnull=True).exists())
+        self.dispatch()
+        self.assertEqual(len(mail.outbox), 5)
+
+    def test_links_are_not_kept(self):
+        sent, failed = self.queue_email(1), self.queue_email(2)
+        self.assertIn('absurl', sent.context)
+
+        def send_messages(messages):
+            if messages[0].to == failed.to:
+                raise OSError('down')
+            return 1
+
+        with mock.patch('user.management.commands.dispatchemails.EMAIL_OUTBOX_CONFIG', {'MAX_ATTEMPTS': 1}), \
+                mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=send_messages):
+            self.dispatch()
+        sent.refresh_from_db()
+        failed.refresh_from_db()
+        self.assertIsNotNone(sent.sent_at)
+        self.assertIsNotNone(failed.failed_at)
+        self.assertEqual(sent.context, {})
+        self.assertEqual(failed.context, {})
+
+    def test_old_emails_are_deleted(self):
+        now = timezone.now()
+        old = now - timedelta(days=8)
+        kept = [
+            self.queue_email(1),
+            OutboxEmail.objects.create(template='t', subject='s', to=[], sent_at=now - timedelta(days=6)),
+        ]
+        OutboxEmail.objects.create(template='t', subject='s', to=[], sent_at=old)
+        OutboxEmail.objects.create(template='t', subject='s', to=[], failed_at=old)
+        # queued long ago but not sent yet
+        OutboxEmail.objects.filter(id=kept[0].id).update(created_at=old)
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=OSError('down')):
+            self.dispatch()
+        self.assertEqual(set(OutboxEmail.objects.values_list('id', flat=True)), {email.id for email in kept})
+
+    def test_failures_back_off(self):
+        email = self.queue_email(1)
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=OSError('down')):
+            self.dispatch()
+        email.refresh_from_db()
+        self.assertEqual(email.attempts, 1)
+        self.assertEqual(email.last_error, 'down')
+        self.assertIsNone(email.sent_at)
+        self.assertGreater(email.next_attempt_at, timezone.now())
+
+        # not due yet
+        self.dispatch()
+        self.assertEqual(len(mail.outbox), 0)
+
+        OutboxEmail.objects.update(next_attempt_at=timezone.now())
+        self.dispatch()
+        email.refresh_from_db()
+        self.assertIsNotNone(email.sent_at)
+        self.assertEqual(email.attempts, 2)
+
+    def test_gives_up_after_max_attempts(self):
+        email = self.queue_email(1)
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=OSError('down')), \
+                mock.patch('user.management.commands.dispatchemails.EMAIL_OUTBOX_CONFIG', {'MAX_ATTEMPTS': 1}):
+            self.dispatch()
+        email.refresh_from_db()
+        self.assertIsNotNone(email.failed_at)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class EmailCoalescingTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User(username='john', email='john@example.com', full_name='John Doe', is_verified=False)
+        self.user.set_password('Str0ng#password')
+        self.user.save()
+
+    def test_verification_email_is_sent_once(self):
+        for _ in range(3):
+            response = self.client.post('/user/token/', {'email': 'john@example.com', 'password': 'Str0ng#password'})
+            self.assertEqual(response.status_code, 403)
+        self.assertEqual(OutboxEmail.objects.count(), 1)
+
+        response = self.client.get('/user/email-verify/', {'token': self.absurl_token()})
+        self.assertEqual(response.status_code, 200)
+
+    def test_password_reset_email_is_sent_once(self):
+        for _ in range(3):
+            response = self.client.post('/user/request-reset-email/',
+                                        {'email': 'john@example.com', 'redirect_url': 'http://frontend/reset'})
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(OutboxEmail.objects.count(), 1)
+
+    def test_only_a_marker_is_cached(self):
+        self.client.post('/user/token/', {'email': 'john@example.com', 'password': 'Str0ng#password'})
+        self.assertIs(cache.get(f'email-coalescing:verification:{self.user.pk}'), True)
+
+    def test_window_ends_on_use(self):
+        self.client.post('/user/token/', {'email': 'john@example.com', 'password': 'Str0ng#password'})
+        self.client.get('/user/email-verify/', {'token': self.absurl_token()})
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.is_verified)
+        self.assertIsNone(cache.get(f'email-coalescing:verification:{self.user.pk}'))
+
+    @staticmethod
+    def absurl_token():
+        return OutboxEmail.objects.get().context['absurl'].split('token=')[1]
+
+
+@override_settings(CACHES=TEST_CACHES)
+class CurrentUserConditionalRequestTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='john', email='john@example.com', full_name='John Doe')
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Token {get_access_token(self.user)}'
+
+    def test_not_modified_without_queries(self):
+        response = self.client.get('/user/current/')
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/user/current/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(len(queries), 0)
+
+        response = self.client.get('/user/current/', HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_changes_produce_a_new_etag(self):
+        etag = self.client.get('/user/current/')['ETag']
+        response = self.client.patch('/user/current/', {'full_name': 'Jane Doe'},
+                                     content_type='application/json', HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+        response = self.client.get('/user/current/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['full_name'], 'Jane Doe')
+        self.assertEqual(self.client.get('/user/current/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_stale_if_match_is_rejected(self):
+        etag = self.client.get('/user/current/')['ETag']
+        self.client.patch('/user/current/', {'full_name': 'Jane Doe'}, content_type='application/json')
+        response = self.client.patch('/user/current/', {'full_name': 'Jim Doe'},
+                                     content_type='application/json', HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 412)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.full_name, 'Jane Doe')
+
+    def test_update_does_not_write_back_the_cached_principal(self):
+        self.client.get('/user/current/')
+        # changed by another process whose invalidation has not reached this one's cache yet
+        User.objects.filter(pk=self.user.pk).update(phone='9800000000', is_active=False)
+        etag = user_etag(mock.Mock(accepted_media_type='application/json'), User.objects.get(pk=self.user.pk))
+
+        response = self.client.patch('/user/current/', {'full_name': 'Jane Doe'},
+                                     content_type='application/json', HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.user.refresh_from_db()
+        self.assertEqual((self.user.full_name, self.user.phone, self.user.is_active), ('Jane Doe', '9800000000', False))
@@ -0,0 +1,124 @@
+from django.utils import timezone
+from django.db.models import F
+from django.utils.translation import gettext_lazy as _
+
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import BlacklistMixin, RefreshToken
+from rest_framework_simplejwt.utils import datetime_from_epoch
+
+from .models import RefreshTokenFamily
+from .revocation import revocation_index
+
+FAMILY_CLAIM = 'family'
+GENERATION_CLAIM = 'generation'
+
+
+class IndexedRefreshToken(RefreshToken):
+    """
+    Refresh token that checks the in-memory revocation index instead of
+    querying BlacklistedToken on every verification
+    """
+
+    def check_blacklist(self):
+        if self.payload[api_settings.JTI_CLAIM] in revocation_index:
+            raise TokenError(_('Token is blacklisted'))
+
+    def blacklist(self):
+        """
+        Blacklist this token and raise `TokenError` if another process
+        already did so since the last index sync
+        """
+        blacklisted_token, created = super().blacklist()
+        revocation_index.add(self.payload[api_settings.JTI_CLAIM])
+        if not created:
+            raise TokenError(_('Token is blacklisted'))
+        return blacklisted_token, created
+
+
+class FamilyRefreshToken(IndexedRefreshToken):
+    """
+    Refresh token that belongs to a RefreshTokenFamily instead of having its
+    own OutstandingToken row.
+
+    Rotation bumps the family generation with a conditional UPDATE. Presenting
+    a token whose generation is behind the family means it was already rotated,
+    so the whole family is revoked, which is the same reuse detection the
+    blacklist gives with one row per session instead of one per refresh.
+
+    Tokens issued before families existed carry no family claim; they are
+    still checked against the blacklist and start a new family the first time
+    they are rotated.
+    """
+    no_copy_claims = RefreshToken.no_copy_claims + (FAMILY_CLAIM, GENERATION_CLAIM)
+
+    @classmethod
+    def for_user(cls, user):
+        # skip BlacklistMixin.for_user so no OutstandingToken row is created
+        token = super(BlacklistMixin, cls).for_user(user)
+        token.start_family()
+        return token
+
+    def start_family(self):
+        family = RefreshTokenFamily.objects.create(
+            user_id=self.payload[api_settings.USER_ID_CLAIM],
+            expires_at=datetime_from_epoch(self.payload['exp']),
+        )
+        self.payload[FAMILY_CLAIM] = str(family.id)
+        self.payload[GENERATION_CLAIM] = family.generation
+
+    def check_blacklist(self):
+        if FAMILY_CLAIM in self.payload:
+            # family tokens are checked by `check_family`/`rotate`
+            return
+        super().check_blacklist()
+
+    def revoke_family(self):
+        RefreshTokenFamily.objects.filter(id=self.payload[FAMILY_CLAIM], revoked_at__isnull=True) \
+            .update(revoked_at=timezone.now())
+
+    def check_family(self):
+        """
+        Raise `TokenError` if this token is not the latest of a live family
+        """
+        if FAMILY_CLAIM not in self.payload:
+            return
+        is_current = RefreshTokenFamily.objects.filter(
+            id=self.payload[FAMILY_CLAIM],
+            generation=self.payload[GENERATION_CLAIM],
+            revoked_at__isnull=True,
+        ).exists()
+        if not is_current:
+            self.revoke_family()
+            raise TokenError(_('Token is blacklisted'))
+
+    def _renew(self):
+        self.set_jti()
+        self.set_exp()
+        self.set_iat()
+
+    def rotate(self):
+        """
+        Turn this token into the next token of its family
+        """
+        if FAMILY_CLAIM not in self.payload:
+            self.blacklist()
+            self._renew()
+            self.start_family()
+            return
+
+        self._renew()
+        generation = self.payload[GENERATION_CLAIM]
+        updated = RefreshTokenFamily.objects.filter(
+            id=self.payload[FAMILY_CLAIM],
+            generation=generation,
+            revoked_at__isnull=True,
+        ).update(
+            generation=F('generation') + 1,
+            expires_at=datetime_from_epoch(self.payload['exp']),
+            modified_at=timezone.now(),
+        )
+        if not updated:
+            self.revoke_family()
+            raise TokenError(_('Token is blacklisted'))
+        self.payload[GENERATION_CLAIM] = generation + 1
@@ -1,11 +1,9 @@
 import logging
 from django.urls import path
 
-from rest_framework_simplejwt.views import TokenRefreshView
-
 from .views import (UserRegistrationRequestCreateAPIView, UserLoginRequestAPIView, UserViewSet,
                     UserPasswordChangeRequestAPIView, EmailVerify, RequestPasswordResetEmail, PasswordTokenCheckAPI,
-                    SetNewPasswordAPIView)
+                    SetNewPasswordAPIView, TokenRefreshRequestAPIView)
 
 # Get an instance of a logger
 logger = logging.getLogger(__name__)
@@ -17,7 +15,7 @@ urlpatterns = [
          name='current-user'),
     path('register/', UserRegistrationRequestCreateAPIView.as_view(), name='token_obtain_pair'),
     path('token/', UserLoginRequestAPIView.as_view(), name="token"),
-    path('token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
+    path('token/refresh/', TokenRefreshRequestAPIView.as_view(), name='token_refresh'),
     path('password-change/', UserPasswordChangeRequestAPIView.as_view(), name='password-change'),
     path('email-verify/', EmailVerify.as_view(), name='email-verify'),
     path('request-reset-email/', RequestPasswordResetEmail.as_view(), name='request-reset-email'),
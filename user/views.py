@@ -1,3 +1,4 @@
+import hashlib
 import os
 
 import jwt
@@ -11,6 +12,10 @@ from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
 from django.contrib.auth.tokens import PasswordResetTokenGenerator
 from django.contrib.sites.shortcuts import get_current_site
 from django.http import HttpResponsePermanentRedirect
+from django.db import transaction
+from django.utils.cache import get_conditional_response
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 
 from rest_framework import status
 from rest_framework.request import Request
@@ -21,11 +26,16 @@ from rest_framework.generics import GenericAPIView
 from rest_framework.viewsets import ModelViewSet
 from rest_framework.generics import CreateAPIView
 
-from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+from rest_framework_simplejwt.tokens import AccessToken
+from rest_framework_simplejwt.views import TokenRefreshView
 
 from .serializers import UserRegistrationRequestSerializer, UserLoginRequestSerializer, UserSerializer, \
-    UserPasswordChangeRequestSerializer, ResetPasswordEmailRequestSerializer, SetNewPasswordSerializer
-from utils.email import Email
+    UserPasswordChangeRequestSerializer, ResetPasswordEmailRequestSerializer, SetNewPasswordSerializer, \
+    TokenRefreshRequestSerializer
+from .tokens import FamilyRefreshToken
+from .last_login import last_login_buffer
+from utils.email import Email, email_coalescer, PASSWORD_RESET_EMAIL, VERIFICATION_EMAIL
+from utils.hashing import password_hashing
 
 User = get_user_model()
 load_dotenv()
@@ -35,9 +45,31 @@ class CustomRedirect(HttpResponsePermanentRedirect):
     allowed_schemes = [os.getenv('APP_SCHEME'), 'http', 'https']
 
 
+def user_etag(request, user):
+    """
+    Strong ETag of the user representation, derived from (id, modified_at)
+    and the negotiated media type
+    """
+    key = f'{user.pk}:{user.modified_at.isoformat()}:{request.accepted_media_type}'
+    return '"%s"' % hashlib.sha1(key.encode()).hexdigest()
+
+
+def current_user_etag(request, *args, **kwargs):
+    # the authenticated principal usually comes from the JWT user cache, so no query is made here
+    return user_etag(request, request.user)
+
+
+def current_user_last_modified(request, *args, **kwargs):
+    return request.user.modified_at
+
+
 class UserViewSet(ModelViewSet):
     """
     API endpoint that allows users to be viewed or edited.
+
+    Reads answer If-None-Match/If-Modified-Since with 304 before
+    serializing, updates honour If-Match with 412. Reads use the
+    authenticated principal, updates the locked row.
     """
 
     serializer_class = UserSerializer
@@ -46,6 +78,25 @@ class UserViewSet(ModelViewSet):
     def get_object(self):
         return self.request.user
 
+    @method_decorator(condition(etag_func=current_user_etag, last_modified_func=current_user_last_modified))
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
+    @transaction.atomic
+    def update(self, request, *args, **kwargs):
+        partial = kwargs.pop('partial', False)
+        # the principal may be a stale cached copy, the update starts from the row, locked until saved
+        instance = User.objects.select_for_update().get(pk=request.user.pk)
+        response = get_conditional_response(request, etag=user_etag(request, instance))
+        if response is not None:
+            return response
+        serializer = self.get_serializer(instance, data=request.data, partial=partial)
+        serializer.is_valid(raise_exception=True)
+        self.perform_update(serializer)
+        response = Response(serializer.data)
+        response['ETag'] = user_etag(request, serializer.instance)
+        return response
+
 
 class UserRegistrationRequestCreateAPIView(CreateAPIView):
     """User create"""
@@ -60,17 +111,23 @@ class UserLoginRequestAPIView(APIView):
 
     @staticmethod
     def post(request: Request):
-        serializer = UserLoginRequestSerializer(data=request.data)
+        serializer = UserLoginRequestSerializer(data=request.data, context={'request': request})
         serializer.is_valid(raise_exception=True)
         user = serializer.validated_data['user']
         access_token = AccessToken.for_user(user)
-        refresh_token = RefreshToken.for_user(user)
+        refresh_token = FamilyRefreshToken.for_user(user)
+        last_login_buffer.record(user)
         return Response({
             "access": str(access_token),
             "refresh": str(refresh_token),
         })
 
 
+class TokenRefreshRequestAPIView(TokenRefreshView):
+    """Refresh token rotation within a refresh token family"""
+    serializer_class = TokenRefreshRequestSerializer
+
+
 class UserPasswordChangeRequestAPIView(APIView):
     """User password change"""
     serializer_class = UserPasswordChangeRequestSerializer
@@ -81,8 +138,9 @@ class UserPasswordChangeRequestAPIView(APIView):
         serializer = UserPasswordChangeRequestSerializer(data=request.data, context={'request': request})
         serializer.is_valid(raise_exception=True)
         user = request.user
-        user.set_password(serializer.validated_data['new_password'])
-        user.save()
+        user.password = password_hashing.make_password(serializer.validated_data['new_password'])
+        # request.user may be a cached copy, only the password is written
+        user.save(update_fields=['password', 'modified_at'])
         return Response({'message': 'Password changed successfully'}, status=status.HTTP_200_OK)
 
 
@@ -103,6 +161,7 @@ class EmailVerify(APIView):
             else:
                 user.is_verified = True
                 user.save()
+                email_coalescer.reset(user, VERIFICATION_EMAIL)
                 return Response({'message': 'Account successfully activated'}, status=status.HTTP_200_OK)
         except jwt.ExpiredSignatureError:
             return Response({'message': 'Activation token expired. Please request new one.'},
@@ -120,8 +179,11 @@ class RequestPasswordResetEmail(GenericAPIView):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         user = serializer.validated_data['user']
-        uidb64 = urlsafe_base64_encode(smart_bytes(user.pk))
+        if not email_coalescer.claim(user, PASSWORD_RESET_EMAIL):
+            # a reset link was sent recently, do not send another one
+            return Response({"message": "Password reset link sent to your email"}, status=status.HTTP_200_OK)
         token = PasswordResetTokenGenerator().make_token(user)
+        uidb64 = urlsafe_base64_encode(smart_bytes(user.pk))
         current_site = get_current_site(request).domain
         relativelink = reverse('user:password-reset-confirm', kwargs={'uidb64': uidb64, 'token': token})
         redirect_url = serializer.validated_data['redirect_url']
@@ -134,8 +196,8 @@ class RequestPasswordResetEmail(GenericAPIView):
         #     'body': 'Your password reset link is {0}'.format(absurl)
         # })
 
-        # send email with template
-        Email.send_html_email("email/password-reset.html", {
+        # queue email with template
+        Email.outbox_html_email("email/password-reset.html", {
             'to': [user.email],
             'subject': 'Reset password',
             'context': {
@@ -188,4 +250,4 @@ class SetNewPasswordAPIView(APIView):
 
 
 def error_404(request, exception):
-    return render(request, 'error_404.html')
+    return render(request, 'error_404.html', status=404)
@@ -0,0 +1,233 @@
+import time
+from threading import Lock
+
+from cachetools import LRUCache
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+MISSING = object()
+
+# Django creates a backend instance per thread, the in-process tier is shared per LOCATION like locmem's
+_stores = {}
+_stores_lock = Lock()
+
+
+class _Store:
+    def __init__(self, maxsize):
+        self.l1 = LRUCache(maxsize=maxsize)
+        self.lock = Lock()
+        # key -> [lock, waiting threads, set or deleted during the computation]
+        self.flights = {}
+        self.counters = dict.fromkeys(('l1_hits', 'l2_hits', 'misses', 'sets', 'computations', 'coalesced'), 0)
+
+
+class TieredCache(BaseCache):
+    """
+    Cache backend with a bounded in-process LRU (L1) in front of another
+    configured cache (L2) shared by every process.
+
+    Reads are served from L1 when possible, then from L2 (copying the value
+    into L1). Writes and deletes go to both. An L1 entry lives at most
+    `L1_TTL` seconds, so changes made by other processes show up after that
+    long at the latest. `add()` is decided by L2, so it is a cross-process
+    claim exactly when L2's `add()` is atomic: it is for the database,
+    memcached and redis backends, but FileBasedCache checks and writes in
+    two steps. Without an L2 the backend is a plain LRU with TTLs.
+
+    `get_or_set()` is single-flight: concurrent misses for the same key in a
+    process wait for one computation instead of all running it. A value
+    whose key was set or deleted in this process while it was computed is
+    returned but not stored. Invalidations from other processes are not
+    seen, callers that need that put a generation in the key.
+
+    L1 hands out the stored objects themselves rather than unpickled copies,
+    so callers must not mutate cached values.
+
+    Every TieredCache needs its own LOCATION, which names its in-process tier.
+
+    CACHES = {
+        'default': {
+            'BACKEND': 'utils.cache.TieredCache',
+            'LOCATION': 'default',
+            'OPTIONS': {'L2': 'shared', 'L1_MAXSIZE': 10000, 'L1_TTL': 5},
+        },
+        'shared': {...},
+    }
+    """
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self.l2_alias = options.get('L2')
+        self.l1_ttl = options.get('L1_TTL', 5)
+        with _stores_lock:
+            store = _stores.setdefault(location, _Store(options.get('L1_MAXSIZE', 10000)))
+        self._l1 = store.l1
+        self._lock = store.lock
+        self._flights = store.flights
+        self._counters = store.counters
+
+    @property
+    def l2(self):
+        return caches[self.l2_alias] if self.l2_alias else None
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def _timeout(self, timeout):
+        return self.default_timeout if timeout is DEFAULT_TIMEOUT else timeout
+
+    def _l1_set(self, key, value, timeout):
+        ttl = self.l1_ttl if self.l2_alias else None
+        if timeout is not None:
+            ttl = timeout if ttl is None else min(ttl, timeout)
+        with self._lock:
+            if ttl is not None and ttl <= 0:
+                self._l1.pop(key, None)
+            else:
+                self._l1[key] = (None if ttl is None else time.monotonic() + ttl, value)
+
+    def _l1_get(self, key):
+        with self._lock:
+            entry = self._l1.get(key)
+            if entry is None:
+                return MISSING
+            expires_at, value = entry
+            if expires_at is not None and time.monotonic() >= expires_at:
+                del self._l1[key]
+                return MISSING
+            return value
+
+    def _l1_delete(self, key):
+        with self._lock:
+            return self._l1.pop(key, MISSING) is not MISSING
+
+    def _flight_invalidated(self, flight):
+        with self._lock:
+            return flight[2]
+
+    def _invalidate_flight(self, key):
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight[2] = True
+
+    def get(self, key, default=None, version=None):
+        made_key = self.make_key(key, version=version)
+        self.validate_key(made_key)
+        value = self._l1_get(made_key)
+        if value is not MISSING:
+            self._count('l1_hits')
+            return value
+        if self.l2_alias:
+            value = self.l2.get(key, MISSING, version=version)
+            if value is not MISSING:
+                self._count('l2_hits')
+                self._l1_set(made_key, value, None)
+                return value
+        self._count('misses')
+        return default
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        made_key = self.make_key(key, version=version)
+        self.validate_key(made_key)
+        timeout = self._timeout(timeout)
+        self._invalidate_flight(made_key)
+        self._set(key, made_key, value, timeout, version)
+
+    def _set(self, key, made_key, value, timeout, version):
+        if self.l2_alias:
+            self.l2.set(key, value, timeout, version=version)
+        self._l1_set(made_key, value, timeout)
+        self._count('sets')
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        made_key = self.make_key(key, version=version)
+        self.validate_key(made_key)
+        timeout = self._timeout(timeout)
+        if self.l2_alias:
+            if not self.l2.add(key, value, timeout, version=version):
+                return False
+        elif self._l1_get(made_key) is not MISSING:
+            return False
+        self._l1_set(made_key, value, timeout)
+        self._count('sets')
+        return True
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        made_key = self.make_key(key, version=version)
+        self.validate_key(made_key)
+        timeout = self._timeout(timeout)
+        if self.l2_alias:
+            self._l1_delete(made_key)
+            return self.l2.touch(key, timeout, version=version)
+        value = self._l1_get(made_key)
+        if value is MISSING:
+            return False
+        self._l1_set(made_key, value, timeout)
+        return True
+
+    def delete(self, key, version=None):
+        made_key = self.make_key(key, version=version)
+        self.validate_key(made_key)
+        self._invalidate_flight(made_key)
+        deleted = self._l1_delete(made_key)
+        if self.l2_alias:
+            deleted = self.l2.delete(key, version=version) or deleted
+        return deleted
+
+    def incr(self, key, delta=1, version=None):
+        if not self.l2_alias:
+            return super().incr(key, delta, version)
+        self._l1_delete(self.make_key(key, version=version))
+        return self.l2.incr(key, delta, version=version)
+
+    def get_or_set(self, key, default, timeout=DEFAULT_TIMEOUT, version=None):
+        value = self.get(key, MISSING, version=version)
+        if value is not MISSING:
+            return value
+
+        made_key = self.make_key(key, version=version)
+        with self._lock:
+            flight = self._flights.setdefault(made_key, [Lock(), 0, False])
+            flight[1] += 1
+        try:
+            with flight[0]:
+                # whoever held the lock before may have computed it already
+                value = self.get(key, MISSING, version=version)
+                if value is not MISSING:
+                    self._count('coalesced')
+                    return value
+                with self._lock:
+                    flight[2] = False
+                value = default() if callable(default) else default
+                self._count('computations')
+                if value is None or self._flight_invalidated(flight):
+                    # the value may predate the change that set or deleted the key meanwhile
+                    return value
+                self._set(key, made_key, value, self._timeout(timeout), version)
+                if self._flight_invalidated(flight):
+                    # and so may a change made while it was being stored
+                    self._l1_delete(made_key)
+                    if self.l2_alias:
+                        self.l2.delete(key, version=version)
+                return value
+        finally:
+            with self._lock:
+                flight[1] -= 1
+                if not flight[1]:
+                    del self._flights[made_key]
+
+    def clear(self):
+        with self._lock:
+            self._l1.clear()
+        if self.l2_alias:
+            self.l2.clear()
+
+    def stats(self):
+        """
+        Return the hit/miss counters of this process
+        """
+        with self._lock:
+            return {**self._counters, 'l1_size': len(self._l1)}
@@ -0,0 +1,189 @@
+import logging
+import time
+from threading import BoundedSemaphore, Lock
+
+import requests
+from django.conf import settings
+
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from utils.metrics import PROVIDER_CALL_DURATION, PROVIDER_CALLS_REJECTED
+
+logger = logging.getLogger(__name__)
+
+CIRCUIT_BREAKERS_CONFIG = getattr(settings, 'CIRCUIT_BREAKERS', {})
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class ProviderUnavailable(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'The login provider is unavailable, please try again shortly.'
+    default_code = 'provider_unavailable'
+
+
+def is_transient_error(exc):
+    """
+    Return whether the exception means the provider is unhealthy rather than
+    that it rejected the request: connection errors, timeouts and 5xx responses
+    """
+    if not isinstance(exc, requests.RequestException):
+        return False
+    response = getattr(exc, 'response', None)
+    return response is None or response.status_code >= 500
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker and bulkhead for calls to one outbound provider.
+
+    After `failure_threshold` consecutive failures (transient errors, or calls
+    slower than `slow_call_threshold` seconds) the breaker opens and every call
+    fails fast with `ProviderUnavailable` (HTTP 503). After `recovery_timeout`
+    seconds it lets `half_open_max_calls` trial calls through: a success closes
+    it again, a failure re-opens it.
+
+    At most `max_concurrent` calls run at a time, so a slow provider can only
+    tie up that many worker threads. Calls beyond that are rejected right away
+    instead of queueing.
+    """
+
+    def __init__(self, name, failure_threshold=5, recovery_timeout=30, max_concurrent=20,
+                 half_open_max_calls=1, slow_call_threshold=None, is_failure=is_transient_error):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.max_concurrent = max_concurrent
+        self.half_open_max_calls = half_open_max_calls
+        self.slow_call_threshold = slow_call_threshold
+        self.is_failure = is_failure
+        self._slots = BoundedSemaphore(max_concurrent)
+        self._lock = Lock()
+        self._state = CLOSED
+        self._opened_at = None
+        self._consecutive_failures = 0
+        self._trial_calls = 0
+        self._in_flight = 0
+        self._counters = dict.fromkeys(
+            ('calls', 'successes', 'failures', 'slow_calls', 'short_circuited', 'bulkhead_rejected', 'opened'), 0)
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    def _current_state(self, now):
+        if self._state == OPEN and now - self._opened_at >= self.recovery_timeout:
+            self._transition(HALF_OPEN)
+        return self._state
+
+    def _transition(self, state):
+        if state == self._state:
+            return
+        logger.warning(f'Circuit breaker {self.name}: {self._state} -> {state}')
+        self._state = state
+        self._trial_calls = 0
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+            self._counters['opened'] += 1
+        elif state == CLOSED:
+            self._consecutive_failures = 0
+
+    def _acquire(self):
+        with self._lock:
+            state = self._current_state(time.monotonic())
+            if state == OPEN or (state == HALF_OPEN and self._trial_calls >= self.half_open_max_calls):
+                self._counters['short_circuited'] += 1
+                raise ProviderUnavailable()
+            if not self._slots.acquire(blocking=False):
+                self._counters['bulkhead_rejected'] += 1
+                logger.warning(f'Circuit breaker {self.name}: {self.max_concurrent} calls already in flight')
+                raise ProviderUnavailable()
+            if state == HALF_OPEN:
+                self._trial_calls += 1
+            self._in_flight += 1
+            self._counters['calls'] += 1
+
+    def _release(self, failed, slow=False):
+        with self._lock:
+            self._in_flight -= 1
+            self._slots.release()
+            if slow:
+                self._counters['slow_calls'] += 1
+            if failed or slow:
+                self._counters['failures'] += 1
+                self._consecutive_failures += 1
+                if self._state == HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+                    self._transition(OPEN)
+            else:
+                self._counters['successes'] += 1
+                self._consecutive_failures = 0
+                if self._state == HALF_OPEN:
+                    self._transition(CLOSED)
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Call `fn` through the breaker. Transient failures are raised as
+        `ProviderUnavailable`, any other exception is re-raised unchanged.
+        """
+        try:
+            self._acquire()
+        except ProviderUnavailable:
+            PROVIDER_CALLS_REJECTED.labels(self.name).inc()
+            raise
+        start = time.monotonic()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            failed = self.is_failure(e)
+            self._release(failed)
+            PROVIDER_CALL_DURATION.labels(self.name, 'unavailable' if failed else 'error').observe(
+                time.monotonic() - start)
+            if failed:
+                raise ProviderUnavailable() from e
+            raise
+        elapsed = time.monotonic() - start
+        self._release(False, slow=self.slow_call_threshold is not None and elapsed > self.slow_call_threshold)
+        PROVIDER_CALL_DURATION.labels(self.name, 'ok').observe(elapsed)
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._transition(CLOSED)
+
+    def metrics(self):
+        """
+        Return the current state and counters of the breaker
+        """
+        with self._lock:
+            return {
+                'state': self._current_state(time.monotonic()),
+                'in_flight': self._in_flight,
+                'consecutive_failures': self._consecutive_failures,
+                **self._counters,
+            }
+
+
+circuit_breakers = {}
+
+
+def get_circuit_breaker(name, **kwargs):
+    """
+    Return the process-wide breaker for the given provider, configured from
+    CIRCUIT_BREAKERS[name] on top of CIRCUIT_BREAKERS['DEFAULT']
+    """
+    if name not in circuit_breakers:
+        config = {**CIRCUIT_BREAKERS_CONFIG.get('DEFAULT', {}), **CIRCUIT_BREAKERS_CONFIG.get(name, {})}
+        circuit_breakers[name] = CircuitBreaker(
+            name,
+            failure_threshold=config.get('FAILURE_THRESHOLD', 5),
+            recovery_timeout=config.get('RECOVERY_TIMEOUT', 30),
+            max_concurrent=config.get('MAX_CONCURRENT', 20),
+            half_open_max_calls=config.get('HALF_OPEN_MAX_CALLS', 1),
+            slow_call_threshold=config.get('SLOW_CALL_THRESHOLD'),
+            **kwargs,
+        )
+    return circuit_breakers[name]
@@ -1,45 +1,431 @@
+import atexit
 import logging
-from threading import Thread
+import queue
+import re
+from collections import namedtuple
+from threading import Lock, Thread
+
+import requests
 
 from django.conf import settings
+from django.core.cache import caches
 from django.core.mail import EmailMessage
 from django.core.mail import EmailMultiAlternatives
-from django.template.loader import render_to_string
-from django.utils.html import strip_tags
+from django.core.mail import get_connection
+from django.dispatch import receiver
+from django.template import TemplateDoesNotExist
+from django.template.loader import get_template
+from django.utils.autoreload import file_changed
+from django.utils.html import escape, strip_tags
+
+from rest_framework import status
+from rest_framework.exceptions import APIException
 
-from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
+from sendgrid.helpers.mail import Personalization
+from sendgrid.helpers.mail import Substitution
 from sendgrid.helpers.mail import To
 
+from utils.metrics import EMAIL_QUEUE_DEPTH
+
 # Get an instance of a logger
 logger = logging.getLogger(__name__)
 
+EMAIL_QUEUE_CONFIG = getattr(settings, 'EMAIL_QUEUE', {})
+EMAIL_COALESCING_CONFIG = getattr(settings, 'EMAIL_COALESCING', {})
+SENDGRID_API_CONFIG = getattr(settings, 'SENDGRID_API', {})
+
+SMTP = 'smtp'
+SENDGRID = 'sendgrid'
+
+# the `field` of a mail/send error about one personalization, e.g. personalizations.3.to.0.email
+PERSONALIZATION_FIELD = re.compile(r'^personalizations\.(\d+)\b')
+
+VERIFICATION_EMAIL = 'verification'
+PASSWORD_RESET_EMAIL = 'password_reset'
+
+# html_content is shared by every recipient of a batch, substitutions are per recipient
+SendGridMessage = namedtuple('SendGridMessage', ['subject', 'html_content', 'to', 'substitutions'])
+
+
+def substitution_tag(name):
+    return f'-{name}-'
+
+
+class EmailTemplateCache:
+    """
+    Compiled email templates and their plain text parts.
+
+    Each template is loaded and compiled once per process. The text part of
+    `email/foo.html` is rendered from `email/foo.txt` when that exists.
+    Otherwise the html is rendered once with a marker in place of each
+    context variable and tag-stripped, and every send only puts the values
+    into that text skeleton. Template logic that depends on the values,
+    like {% if %} or filters, is therefore not reflected in such text parts.
+    """
+
+    MARKER = '\x1e'
+
+    def __init__(self):
+        self._templates = {}
+        self._skeletons = {}
+        self._lock = Lock()
+
+    def _marker(self, name):
+        return f'{self.MARKER}{name}{self.MARKER}'
+
+    def get(self, path):
+        """
+        Return the compiled template, or None if it does not exist
+        """
+        try:
+            return self._templates[path]
+        except KeyError:
+            pass
+        try:
+            template = get_template(path)
+        except TemplateDoesNotExist:
+            template = None
+        with self._lock:
+            self._templates[path] = template
+        return template
+
+    def skeleton(self, path, names):
+        """
+        Return the html template rendered with a marker or substitution tag
+        in place of each of the context variable names, tag-stripped for the
+        text part and as-is for SendGrid
+        """
+        key = (path, names)
+        try:
+            return self._skeletons[key]
+        except KeyError:
+            pass
+        html = self.get(path).render({name: self._marker(name) for name in names})
+        sendgrid_html = html
+        for name in names:
+            sendgrid_html = sendgrid_html.replace(self._marker(name), substitution_tag(name))
+        skeleton = (strip_tags(html), sendgrid_html)
+        with self._lock:
+            self._skeletons[key] = skeleton
+        return skeleton
+
+    def render(self, path, context):
+        """
+        Return the html and plain text parts of an html email template
+        """
+        html = self.get(path).render(context)
+        text_template = self.get(path.rsplit('.', 1)[0] + '.txt')
+        if text_template is not None:
+            return html, text_template.render(context)
+        text, _ = self.skeleton(path, tuple(sorted(context)))
+        for name, value in context.items():
+            text = text.replace(self._marker(name), str(value))
+        return html, text
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+            self._skeletons.clear()
+
+
+email_templates = EmailTemplateCache()
 
-class EmailThread(Thread):
-    def __init__(self, email):
-        self.email = email
-        Thread.__init__(self)
 
-    def run(self):
-        self.email.send()
-        logger.info("Email successfully sent")
+@receiver(file_changed, dispatch_uid='clear_email_templates')
+def clear_email_templates(sender, file_path, **kwargs):
+    # runserver reloads changed templates without restarting the process
+    email_templates.clear()
 
 
-class SendGridEmailThread(Thread):
-    def __init__(self, message):
-        self.message = message
-        Thread.__init__(self)
+class SendGridClient:
+    """
+    Sends SendGridMessages through the v3 mail/send API over one keep-alive session.
 
-    def run(self):
+    Messages with the same subject and html content are sent with a single
+    API call carrying one personalization per message, up to
+    `max_personalizations` each. When SendGrid rejects a call with a 400
+    whose errors all name personalizations (e.g. a malformed address), the
+    messages of those personalizations fail and the rest are sent again in
+    one call. Any other 400 (sender, content, payload shape) fails the
+    whole batch without further calls.
+    """
+
+    def __init__(self, url, api_key, from_email, max_personalizations=1000, timeout=(3, 10)):
+        self.url = url
+        self.api_key = api_key
+        self.from_email = from_email
+        self.max_personalizations = max_personalizations
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def batches(self, messages):
+        groups = {}
+        for message in messages:
+            groups.setdefault((message.subject, message.html_content), []).append(message)
+        for group in groups.values():
+            for start in range(0, len(group), self.max_personalizations):
+                yield group[start:start + self.max_personalizations]
+
+    def payload(self, batch):
+        mail = Mail(from_email=self.from_email, subject=batch[0].subject, html_content=batch[0].html_content)
+        for message in batch:
+            personalization = Personalization()
+            for email in message.to:
+                personalization.add_to(To(email))
+            for key, value in message.substitutions.items():
+                personalization.add_substitution(Substitution(key, value))
+            mail.add_personalization(personalization)
+        return mail.get()
+
+    @staticmethod
+    def rejected_personalizations(response):
+        """
+        Return the indexes of the personalizations the errors of a 400 name,
+        or None when an error is about the payload as a whole
+        """
         try:
-            sg = SendGridAPIClient(settings.SENDGRID_API_KEY)
-            response = sg.send(self.message)
-            logger.info(response.status_code)
-            logger.info(response.body)
-            logger.info(response.headers)
+            errors = response.json().get('errors') or []
+        except (ValueError, AttributeError):
+            return None
+        indexes = set()
+        for error in errors:
+            match = PERSONALIZATION_FIELD.match(str(error.get('field') or ''))
+            if not match:
+                return None
+            indexes.add(int(match.group(1)))
+        return indexes or None
+
+    def _send_batch(self, batch):
+        response = self.session.post(f'{self.url}/v3/mail/send', json=self.payload(batch), timeout=self.timeout,
+                                     headers={'Authorization': f'Bearer {self.api_key}'})
+        if response.status_code == status.HTTP_400_BAD_REQUEST:
+            indexes = self.rejected_personalizations(response)
+            rejected = [message for i, message in enumerate(batch) if i in (indexes or ())]
+            if not rejected:
+                logger.error(f'SendGrid rejected a batch of {len(batch)} emails: {response.text}')
+                return batch
+            for message in rejected:
+                logger.error(f'SendGrid rejected the email to {", ".join(message.to)}: {response.text}')
+            # every round drops at least one message
+            remaining = [message for i, message in enumerate(batch) if i not in indexes]
+            return rejected + (self._send_batch(remaining) if remaining else [])
+        response.raise_for_status()
+        logger.info(f'{len(batch)} emails successfully sent with SendGrid')
+        return []
+
+    def send(self, messages):
+        """
+        Send the messages and return those SendGrid rejected
+        """
+        rejected = []
+        for batch in self.batches(messages):
+            rejected += self._send_batch(batch)
+        return rejected
+
+
+class EmailQueueFull(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Server is busy, please try again shortly.'
+    default_code = 'email_queue_full'
+
+
+class EmailQueue:
+    """
+    Bounded queue of outgoing emails drained by a fixed pool of worker threads.
+
+    Each worker takes whatever is queued, up to `batch_size` messages, at
+    once. It keeps its own SMTP connection open between messages and sends
+    the SMTP messages `smtp_batch_size` at a time per `send_messages()` call.
+    A connection idle for `idle_timeout` seconds is closed and reopened on
+    the next message. SendGrid messages taken off the queue together are
+    handed to `sendgrid_client` as one batch.
+
+    When `max_size` messages are waiting, `enqueue()` blocks for up to
+    `put_timeout` seconds and then fails with `EmailQueueFull` (HTTP 503).
+    Queued messages are still sent when the process exits. With `workers=0`
+    messages are sent on the calling thread.
+    """
+
+    def __init__(self, workers=2, max_size=1000, batch_size=1000, smtp_batch_size=100, put_timeout=2,
+                 idle_timeout=30):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.smtp_batch_size = smtp_batch_size
+        self.put_timeout = put_timeout
+        self.idle_timeout = idle_timeout
+        self._queue = queue.Queue(max_size)
+        self._threads = []
+        self._lock = Lock()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = Thread(target=self._run, name=f'email-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            atexit.register(self.shutdown)
+
+    def enqueue(self, kind, message):
+        """
+        Queue a message for sending, `kind` is SMTP or SENDGRID
+        """
+        if not self.workers:
+            self._send(kind, [message])
+            return
+        self._ensure_started()
+        try:
+            self._queue.put((kind, message), timeout=self.put_timeout)
+        except queue.Full:
+            logger.warning('Email queue is full')
+            raise EmailQueueFull()
+        EMAIL_QUEUE_DEPTH.set(self._queue.qsize())
+
+    def _next_batch(self, first):
+        batch = [first]
+        stop = False
+        while len(batch) < self.batch_size:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                stop = True
+                break
+            batch.append(item)
+        return batch, stop
+
+    def _run(self):
+        connection = get_connection()
+        stop = False
+        while not stop:
+            try:
+                first = self._queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                connection.close()
+                continue
+            if first is None:
+                self._queue.task_done()
+                break
+            batch, stop = self._next_batch(first)
+            EMAIL_QUEUE_DEPTH.set(self._queue.qsize())
+            smtp = [message for kind, message in batch if kind == SMTP]
+            for start in range(0, len(smtp), self.smtp_batch_size):
+                self._send(SMTP, smtp[start:start + self.smtp_batch_size], connection)
+            sendgrid = [message for kind, message in batch if kind == SENDGRID]
+            if sendgrid:
+                self._send(SENDGRID, sendgrid)
+            for _ in range(len(batch) + stop):
+                self._queue.task_done()
+        connection.close()
+
+    def _send(self, kind, messages, connection=None):
+        try:
+            if kind == SMTP:
+                self._send_smtp(messages, connection)
+            else:
+                sendgrid_client.send(messages)
+        except Exception as e:
+            logger.error(f'Could not send {len(messages)} {kind} emails: {e}')
+
+    @staticmethod
+    def _send_smtp(messages, connection):
+        if connection is None:
+            sent = get_connection().send_messages(messages)
+            logger.info(f'{sent} emails successfully sent')
+            return
+        # opened here, send_messages() leaves the connection open for the next batch
+        try:
+            connection.open()
+            sent = connection.send_messages(messages)
         except Exception as e:
-            logger.info(e.message)
-        logger.info("Email successfully sent")
+            # the server may have dropped the kept-alive connection, retry once on a new one
+            logger.info(f'Reopening SMTP connection after: {e}')
+            connection.close()
+            connection.open()
+            sent = connection.send_messages(messages)
+        logger.info(f'{sent} emails successfully sent')
+
+    def join(self):
+        """
+        Block until every queued message was handled
+        """
+        self._queue.join()
+
+    def shutdown(self, timeout=None):
+        """
+        Send what is queued and stop the workers
+        """
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join(timeout)
+
+
+sendgrid_client = SendGridClient(
+    url=SENDGRID_API_CONFIG.get('URL', 'https://api.sendgrid.com'),
+    api_key=settings.SENDGRID_API_KEY,
+    from_email=settings.SENDGRID_HOST_USER,
+    max_personalizations=SENDGRID_API_CONFIG.get('MAX_PERSONALIZATIONS', 1000),
+    timeout=(SENDGRID_API_CONFIG.get('CONNECT_TIMEOUT', 3), SENDGRID_API_CONFIG.get('READ_TIMEOUT', 10)),
+)
+
+email_queue = EmailQueue(
+    workers=EMAIL_QUEUE_CONFIG.get('WORKERS', 2),
+    max_size=EMAIL_QUEUE_CONFIG.get('MAX_SIZE', 1000),
+    batch_size=EMAIL_QUEUE_CONFIG.get('BATCH_SIZE', 1000),
+    smtp_batch_size=EMAIL_QUEUE_CONFIG.get('SMTP_BATCH_SIZE', 100),
+    put_timeout=EMAIL_QUEUE_CONFIG.get('PUT_TIMEOUT', 2),
+    idle_timeout=EMAIL_QUEUE_CONFIG.get('IDLE_TIMEOUT', 30),
+)
+
+
+class EmailCoalescer:
+    """
+    Suppresses repeats of the same kind of email to the same user.
+
+    The first `claim()` for a (user, kind) pair puts a marker in the cache
+    for `window` seconds and lets the email through. Later claims within
+    the window are told not to send, so retry storms cost neither a token,
+    a render nor an email. Every process sharing the cache shares the
+    window. Only the marker is cached, never the token the email carries.
+    """
+
+    def __init__(self, window=300, cache_alias='default'):
+        self.window = window
+        self.cache_alias = cache_alias
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    @staticmethod
+    def _key(user, kind):
+        return f'email-coalescing:{kind}:{user.pk}'
+
+    def claim(self, user, kind):
+        """
+        Return whether the email should be sent, i.e. none was sent within the window
+        """
+        if not self.window:
+            return True
+        return self.cache.add(self._key(user, kind), True, self.window)
+
+    def reset(self, user, kind):
+        """
+        End the window, e.g. once the emailed token was used
+        """
+        self.cache.delete(self._key(user, kind))
+
+
+email_coalescer = EmailCoalescer(
+    window=EMAIL_COALESCING_CONFIG.get('WINDOW', 300),
+    cache_alias=EMAIL_COALESCING_CONFIG.get('CACHE', 'default'),
+)
 
 
 class Email:
@@ -53,7 +439,7 @@ class Email:
             subject=data['subject'],
             body=data['body'],
         )
-        EmailThread(email).start()
+        email_queue.enqueue(SMTP, email)
 
     @staticmethod
     def send_html_email(path_to_html_template, data):
@@ -67,8 +453,14 @@ class Email:
             'context': {},
         }
         """
-        html_content = render_to_string(path_to_html_template, data['context'])
-        text_content = strip_tags(html_content)
+        email_queue.enqueue(SMTP, Email.build_html_email(path_to_html_template, data))
+
+    @staticmethod
+    def build_html_email(path_to_html_template, data):
+        """
+        Render an html template into a message with a plain text alternative
+        """
+        html_content, text_content = email_templates.render(path_to_html_template, data['context'])
         email = EmailMultiAlternatives(
             subject=data['subject'],
             body=text_content,
@@ -76,17 +468,27 @@ class Email:
             to=data['to'],
         )
         email.attach_alternative(html_content, "text/html")
-        EmailThread(email).start()
+        return email
+
+    @staticmethod
+    def outbox_html_email(path_to_html_template, data):
+        """
+        Store an email with html template in the outbox, to be sent by the
+        `dispatchemails` command once the current transaction commits.
+        Takes the same `data` as send_html_email, the context must be JSON serializable.
+        """
+        from user.models import OutboxEmail
+
+        return OutboxEmail.objects.create(
+            template=path_to_html_template, subject=data['subject'], to=data['to'], context=data['context'])
 
     @staticmethod
     def sendgrid_email(data):
         """
         Send an email with SendGrid
         """
-        message = Mail(
-            subject=data['subject'], html_content=data['body'], to_emails=To(data['to']),
-            from_email=settings.SENDGRID_HOST_USER, )
-        SendGridEmailThread(message).start()
+        to = [data['to']] if isinstance(data['to'], str) else data['to']
+        email_queue.enqueue(SENDGRID, SendGridMessage(data['subject'], data['body'], to, {}))
 
     @staticmethod
     def sendgrid_html_email(path_to_html_template, data):
@@ -99,9 +501,14 @@ class Email:
             'subject': '',
             'context': {},
         }
+
+        The template is rendered once per set of context variables with a
+        substitution tag for each of them, SendGrid fills in the (escaped)
+        values per recipient. Template logic that depends on the values,
+        like {% if %} or filters, is not supported.
         """
-        message = Mail(
-            subject=data['subject'], html_content=render_to_string(path_to_html_template, data['context']),
-            to_emails=To(data['to']),
-            from_email=settings.SENDGRID_HOST_USER, )
-        SendGridEmailThread(message).start()
+        context = data['context']
+        to = [data['to']] if isinstance(data['to'], str) else data['to']
+        _, html_content = email_templates.skeleton(path_to_html_template, tuple(sorted(context)))
+        substitutions = {substitution_tag(name): escape(value) for name, value in context.items()}
+        email_queue.enqueue(SENDGRID, SendGridMessage(data['subject'], html_content, to, substitutions))
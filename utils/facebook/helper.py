@@ -1,19 +1,84 @@
+import hashlib
+import logging
+from threading import Lock
+
 import facebook
+import requests
+from asgiref.sync import sync_to_async
+from cachetools import TTLCache
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from utils.circuit_breaker import get_circuit_breaker, is_transient_error
+
+logger = logging.getLogger(__name__)
+
+FACEBOOK_GRAPH_CONFIG = getattr(settings, 'FACEBOOK_GRAPH', {})
+
+# https://developers.facebook.com/docs/graph-api/guides/error-handling
+TRANSIENT_ERROR_CODES = (1, 2)
+
+
+def is_graph_outage(exc):
+    """
+    Return whether the exception means the Graph API is unhealthy, as opposed to the token being bad
+    """
+    if isinstance(exc, facebook.GraphAPIError):
+        # non JSON bodies (usually an HTML error page) leave the raw message in `result`
+        return exc.code in TRANSIENT_ERROR_CODES or isinstance(exc.result, str)
+    return is_transient_error(exc)
+
+
+def build_session(pool_size):
+    """
+    Return a requests session that keeps up to `pool_size` connections alive per host
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
 
 
 class Facebook:
     """
     Facebook class to fetch the user info and return it
     """
+    session = build_session(FACEBOOK_GRAPH_CONFIG.get('POOL_SIZE', 10))
+    timeout = (FACEBOOK_GRAPH_CONFIG.get('CONNECT_TIMEOUT', 3), FACEBOOK_GRAPH_CONFIG.get('READ_TIMEOUT', 5))
+    # short lived so client retries with the same token do not hit the Graph API again
+    _profiles = TTLCache(maxsize=FACEBOOK_GRAPH_CONFIG.get('PROFILE_CACHE_SIZE', 10000),
+                         ttl=FACEBOOK_GRAPH_CONFIG.get('PROFILE_CACHE_TTL', 60))
+    _profiles_lock = Lock()
+    breaker = get_circuit_breaker('facebook', is_failure=is_graph_outage)
 
-    @staticmethod
-    def validate(auth_token):
+    @classmethod
+    def validate(cls, auth_token):
         """
-        Validate method Queries the facebook GraphAPI to fetch the user info
+        Validate method Queries the facebook GraphAPI to fetch the user info.
+        Returns None if the token is invalid or expired and raises
+        ProviderUnavailable if the Graph API is down or its breaker is open.
         """
-        try:
-            graph = facebook.GraphAPI(access_token=auth_token)
-            profile = graph.request('/me?fields=name,email')
+        key = hashlib.sha256(auth_token.encode()).hexdigest()
+        with cls._profiles_lock:
+            profile = cls._profiles.get(key)
+        if profile is not None:
             return profile
-        except:
-            return "The token is invalid or expired."
+
+        try:
+            graph = facebook.GraphAPI(access_token=auth_token, timeout=cls.timeout, session=cls.session)
+            profile = cls.breaker.call(graph.request, '/me?fields=name,email')
+        except (facebook.GraphAPIError, requests.RequestException) as e:
+            logger.info(f'Facebook token validation failed: {e}')
+            return None
+
+        with cls._profiles_lock:
+            cls._profiles[key] = profile
+        return profile
+
+    @classmethod
+    async def avalidate(cls, auth_token):
+        """
+        Async variant of validate that runs the Graph API call on a worker thread
+        """
+        return await sync_to_async(cls.validate, thread_sensitive=False)(auth_token)
@@ -0,0 +1,147 @@
+import logging
+import re
+import time
+from threading import Lock, Thread
+
+import requests
+from django.conf import settings
+from django.core.cache import caches
+
+from utils.circuit_breaker import get_circuit_breaker
+
+logger = logging.getLogger(__name__)
+
+GOOGLE_CERTS_CONFIG = getattr(settings, 'GOOGLE_CERTS', {})
+
+MAX_AGE_RE = re.compile(r'max-age=(\d+)')
+
+
+class CertStore:
+    """
+    Process-wide cache of a JWKS/PEM certificate endpoint.
+
+    Certificates are kept for the `max-age` the endpoint sends in its
+    Cache-Control header and refreshed in a background thread once they are
+    within `refresh_ahead` seconds of expiring, so requests only wait on the
+    network for the very first fetch or after a long idle period. All fetches
+    share one keep-alive `requests.Session` and go through `breaker` if given.
+
+    With `cache` (a CACHES alias) fetched certificates are also shared with
+    the other processes for their max-age, so only one of them downloads
+    them per refresh.
+
+    `refetch` forces a download when a token names an unknown key, at most
+    once every `min_refetch_interval` seconds, so tokens signed with made up
+    key ids cannot make every request wait on the endpoint.
+    """
+
+    def __init__(self, url, refresh_ahead=300, default_max_age=3600, timeout=5, breaker=None, cache=None,
+                 min_refetch_interval=60):
+        self.url = url
+        self.breaker = breaker
+        self.cache = cache
+        self.refresh_ahead = refresh_ahead
+        self.default_max_age = default_max_age
+        self.timeout = timeout
+        self.min_refetch_interval = min_refetch_interval
+        self.session = requests.Session()
+        self._certs = None
+        self._expires_at = 0
+        self._fetch_lock = Lock()
+        self._refreshing = False
+        self._last_refetch = None
+        self._refetch_lock = Lock()
+
+    def _max_age(self, response):
+        match = MAX_AGE_RE.search(response.headers.get('Cache-Control', ''))
+        return int(match.group(1)) if match else self.default_max_age
+
+    def _get(self):
+        response = self.session.get(self.url, timeout=self.timeout)
+        response.raise_for_status()
+        return response
+
+    @property
+    def _cache_key(self):
+        return f'cert-store:{self.url}'
+
+    def _shared(self):
+        """
+        Return (certs, seconds left) from the shared cache if another process
+        fetched them and they are not due for a refresh yet
+        """
+        if self.cache is None:
+            return None
+        entry = caches[self.cache].get(self._cache_key)
+        if entry is None:
+            return None
+        certs, expires_at = entry
+        remaining = expires_at - time.time()
+        return (certs, remaining) if remaining > self.refresh_ahead else None
+
+    def fetch(self, shared=True):
+        """
+        Fetch the certificates now, unless another thread just did.
+        With `shared=False` the shared cache is bypassed as well.
+        """
+        expires_at = self._expires_at
+        with self._fetch_lock:
+            if self._certs is not None and self._expires_at != expires_at:
+                return self._certs
+            entry = self._shared() if shared else None
+            if entry is not None:
+                self._certs, max_age = entry
+            else:
+                response = self.breaker.call(self._get) if self.breaker else self._get()
+                self._certs, max_age = response.json(), self._max_age(response)
+                if self.cache is not None:
+                    caches[self.cache].set(self._cache_key, (self._certs, time.time() + max_age), max_age)
+            self._expires_at = time.monotonic() + max_age
+            return self._certs
+
+    def refetch(self):
+        """
+        Fetch the certificates bypassing the shared cache, or return None if
+        this process already did within `min_refetch_interval` seconds
+        """
+        now = time.monotonic()
+        with self._refetch_lock:
+            if self._last_refetch is not None and now - self._last_refetch < self.min_refetch_interval:
+                return None
+            self._last_refetch = now
+        return self.fetch(shared=False)
+
+    def _refresh(self):
+        try:
+            self.fetch()
+        except Exception as e:
+            logger.warning(f'Could not refresh certificates from {self.url}: {e}')
+        finally:
+            self._refreshing = False
+
+    def get(self):
+        """
+        Return the cached certificates, fetching them if they expired
+        """
+        now = time.monotonic()
+        if self._certs is None or now >= self._expires_at:
+            return self.fetch()
+        if now >= self._expires_at - self.refresh_ahead and not self._refreshing:
+            self._refreshing = True
+            Thread(target=self._refresh, name='cert-store-refresh', daemon=True).start()
+        return self._certs
+
+    def clear(self):
+        self._certs = None
+        self._expires_at = 0
+
+
+google_certs = CertStore(
+    url=GOOGLE_CERTS_CONFIG.get('URL', 'https://www.googleapis.com/oauth2/v1/certs'),
+    refresh_ahead=GOOGLE_CERTS_CONFIG.get('REFRESH_AHEAD', 300),
+    default_max_age=GOOGLE_CERTS_CONFIG.get('DEFAULT_MAX_AGE', 3600),
+    timeout=GOOGLE_CERTS_CONFIG.get('TIMEOUT', 5),
+    breaker=get_circuit_breaker('google'),
+    cache=GOOGLE_CERTS_CONFIG.get('CACHE'),
+    min_refetch_interval=GOOGLE_CERTS_CONFIG.get('MIN_REFETCH_INTERVAL', 60),
+)
@@ -1,5 +1,50 @@
-from google.auth.transport import requests
-from google.oauth2 import id_token
+import hashlib
+import time
+from threading import Lock
+
+from asgiref.sync import sync_to_async
+from cachetools import LRUCache
+from django.conf import settings
+from google.auth import jwt
+
+from utils.circuit_breaker import ProviderUnavailable
+
+from .certs import google_certs
+
+GOOGLE_ISSUERS = ('accounts.google.com', 'https://accounts.google.com')
+
+_verified_tokens = LRUCache(maxsize=getattr(settings, 'GOOGLE_CERTS', {}).get('VERIFIED_TOKEN_CACHE_SIZE', 10000))
+_verified_tokens_lock = Lock()
+
+
+def verify_id_token(auth_token):
+    """
+    Verify a Google ID token against the cached signing certificates.
+    Tokens that were already verified are served from memory until they expire.
+    """
+    key = hashlib.sha256(auth_token.encode()).hexdigest()
+    with _verified_tokens_lock:
+        id_info = _verified_tokens.get(key)
+    if id_info is not None and id_info['exp'] > time.time():
+        return id_info
+
+    try:
+        id_info = jwt.decode(auth_token, certs=google_certs.get())
+    except ValueError as e:
+        if 'Certificate for key id' not in str(e):
+            raise
+        # signing keys were rotated before our copy expired, or the key id is made up
+        certs = google_certs.refetch()
+        if certs is None:
+            raise
+        id_info = jwt.decode(auth_token, certs=certs)
+
+    if id_info['iss'] not in GOOGLE_ISSUERS:
+        raise ValueError('Wrong issuer. \'iss\' should be one of {0}.'.format(GOOGLE_ISSUERS))
+
+    with _verified_tokens_lock:
+        _verified_tokens[key] = id_info
+    return id_info
 
 
 class Google:
@@ -10,11 +55,21 @@ class Google:
     @staticmethod
     def validate(auth_token):
         """
-        Validate method Queries the Google oAUTH2 api to fetch the user info
+        Validate method verifies the Google ID token and returns the user info.
+        Raises ProviderUnavailable if the signing certificates cannot be fetched.
         """
         try:
-            id_info = id_token.verify_oauth2_token(auth_token, requests.Request())
+            id_info = verify_id_token(auth_token)
             if 'accounts.google.com' in id_info['iss']:
                 return id_info
+        except ProviderUnavailable:
+            raise
         except:
             return "The token is either invalid or has expired"
+
+    @staticmethod
+    async def avalidate(auth_token):
+        """
+        Async variant of validate that verifies the token on a worker thread
+        """
+        return await sync_to_async(Google.validate, thread_sensitive=False)(auth_token)
@@ -0,0 +1,121 @@
+import base64
+import hashlib
+import json
+import os
+from functools import lru_cache
+
+from django.conf import settings
+from django.contrib.auth.hashers import (Argon2PasswordHasher, BasePasswordHasher, PBKDF2PasswordHasher,
+                                         mask_hash, must_update_salt)
+from django.utils.crypto import constant_time_compare
+from django.utils.translation import gettext_noop as _
+
+PASSWORD_HASHER_CALIBRATION = getattr(settings, 'PASSWORD_HASHER_CALIBRATION', {})
+
+
+@lru_cache(maxsize=None)
+def load_calibration():
+    """
+    Load hasher parameters written by `manage.py calibratepasswordhashers`
+    """
+    path = PASSWORD_HASHER_CALIBRATION.get('FILE')
+    if PASSWORD_HASHER_CALIBRATION.get('MODE') != 'calibrated' or not path or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def calibrated(algorithm, param, default):
+    return load_calibration().get(algorithm, {}).get(param, default)
+
+
+class CalibratedPBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    """
+    PBKDF2-SHA256 with the iteration count picked by calibration
+    """
+    iterations = calibrated('pbkdf2_sha256', 'iterations', PBKDF2PasswordHasher.iterations)
+
+
+class CalibratedArgon2PasswordHasher(Argon2PasswordHasher):
+    """
+    Argon2 with the time cost picked by calibration
+    """
+    time_cost = calibrated('argon2', 'time_cost', Argon2PasswordHasher.time_cost)
+
+
+class ScryptPasswordHasher(BasePasswordHasher):
+    """
+    Secure password hashing using the scrypt algorithm.
+    Backport of the hasher that ships with Django 4.0, with `maxmem` derived
+    from the parameters so calibrated work factors do not hit OpenSSL's limit.
+    """
+    algorithm = 'scrypt'
+    block_size = 8
+    maxmem = 0
+    parallelism = 1
+    work_factor = 2 ** 14
+
+    def encode(self, password, salt, n=None, r=None, p=None):
+        assert password is not None
+        assert salt and '$' not in salt
+        n = n or self.work_factor
+        r = r or self.block_size
+        p = p or self.parallelism
+        # scrypt needs 128 * n * r * p bytes, above OpenSSL's 32 MiB default once n > 2 ** 14
+        maxmem = self.maxmem or 2 * 128 * n * r * p
+        hash_ = hashlib.scrypt(
+            password.encode(), salt=salt.encode(), n=n, r=r, p=p, maxmem=maxmem, dklen=64,
+        )
+        hash_ = base64.b64encode(hash_).decode('ascii').strip()
+        return '%s$%d$%s$%d$%d$%s' % (self.algorithm, n, salt, r, p, hash_)
+
+    def decode(self, encoded):
+        algorithm, work_factor, salt, block_size, parallelism, hash_ = encoded.split('$', 6)
+        assert algorithm == self.algorithm
+        return {
+            'algorithm': algorithm,
+            'work_factor': int(work_factor),
+            'salt': salt,
+            'block_size': int(block_size),
+            'parallelism': int(parallelism),
+            'hash': hash_,
+        }
+
+    def verify(self, password, encoded):
+        decoded = self.decode(encoded)
+        encoded_2 = self.encode(
+            password, decoded['salt'], decoded['work_factor'], decoded['block_size'], decoded['parallelism'],
+        )
+        return constant_time_compare(encoded, encoded_2)
+
+    def safe_summary(self, encoded):
+        decoded = self.decode(encoded)
+        return {
+            _('algorithm'): decoded['algorithm'],
+            _('work factor'): decoded['work_factor'],
+            _('block size'): decoded['block_size'],
+            _('parallelism'): decoded['parallelism'],
+            _('salt'): mask_hash(decoded['salt']),
+            _('hash'): mask_hash(decoded['hash']),
+        }
+
+    def must_update(self, encoded):
+        decoded = self.decode(encoded)
+        return (
+            decoded['work_factor'] != self.work_factor or
+            decoded['block_size'] != self.block_size or
+            decoded['parallelism'] != self.parallelism or
+            must_update_salt(decoded['salt'], self.salt_entropy)
+        )
+
+    def harden_runtime(self, password, encoded):
+        # The runtime for Scrypt is too complicated to implement a sensible
+        # hardening algorithm.
+        pass
+
+
+class CalibratedScryptPasswordHasher(ScryptPasswordHasher):
+    """
+    Scrypt with the work factor picked by calibration
+    """
+    work_factor = calibrated('scrypt', 'work_factor', ScryptPasswordHasher.work_factor)
@@ -0,0 +1,110 @@
+import logging
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from threading import BoundedSemaphore, Lock
+
+import django
+from django.conf import settings
+from django.contrib.auth import hashers
+
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+logger = logging.getLogger(__name__)
+
+PASSWORD_HASHING_CONFIG = getattr(settings, 'PASSWORD_HASHING_POOL', {})
+
+
+class PasswordHashingUnavailable(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Server is busy, please try again shortly.'
+    default_code = 'password_hashing_unavailable'
+
+
+def password_needs_rehash(encoded):
+    """
+    Return whether the encoded hash was made by a hasher or with parameters
+    other than the preferred ones
+    """
+    preferred = hashers.get_hasher('default')
+    try:
+        hasher = hashers.identify_hasher(encoded)
+    except ValueError:
+        return False
+    return hasher.algorithm != preferred.algorithm or preferred.must_update(encoded)
+
+
+def _init_worker():
+    # workers started with the spawn method need their own app registry
+    django.setup()
+
+
+class PasswordHashingService:
+    """
+    Runs password hashing on a fixed-size process pool so that PBKDF2 does not
+    hold the request thread.
+
+    At most `workers + max_pending` hashes are accepted at a time; anything
+    beyond that fails fast with `PasswordHashingUnavailable` (HTTP 503)
+    instead of queueing behind a login storm. With `workers=0` hashing runs
+    inline on the calling thread.
+    """
+
+    def __init__(self, workers=2, max_pending=64, timeout=5):
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = BoundedSemaphore(workers + max_pending)
+        self._executor = None
+        self._executor_lock = Lock()
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+            return self._executor
+
+    def _submit(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            logger.warning('Password hashing pool is saturated')
+            raise PasswordHashingUnavailable()
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def _result(self, future):
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise PasswordHashingUnavailable()
+
+    def make_password(self, password):
+        """
+        Return the encoded hash of the given raw password
+        """
+        if not self.workers:
+            return hashers.make_password(password)
+        return self._result(self._submit(hashers.make_password, password))
+
+    def check_password(self, password, encoded):
+        """
+        Return whether the raw password matches the encoded hash
+        """
+        if not self.workers:
+            return hashers.check_password(password, encoded)
+        return self._result(self._submit(hashers.check_password, password, encoded))
+
+    def shutdown(self):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+
+password_hashing = PasswordHashingService(
+    workers=PASSWORD_HASHING_CONFIG.get('WORKERS', 2),
+    max_pending=PASSWORD_HASHING_CONFIG.get('MAX_PENDING', 64),
+    timeout=PASSWORD_HASHING_CONFIG.get('TIMEOUT', 5),
+)
@@ -0,0 +1,152 @@
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import random
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+# attributes every LogRecord has, anything else was passed with `extra=`
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats records as one JSON object per line, `extra=` fields included
+    """
+
+    def format(self, record):
+        data = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'process': record.process,
+            'thread': record.threadName,
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exc_info'] = record.exc_text
+        if record.stack_info:
+            data['stack_info'] = self.formatStack(record.stack_info)
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and key not in data:
+                data[key] = value
+        return json.dumps(data, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps only a fraction of the records below WARNING of the given
+    loggers (and their children), e.g. {'django.db.backends': 0.01}
+    """
+
+    def __init__(self, rates=None):
+        super().__init__()
+        self.rates = rates or {}
+        self._rate_by_name = {}
+
+    def rate(self, name):
+        rate = self._rate_by_name.get(name)
+        if rate is None:
+            rate = 1
+            # the most specific configured ancestor wins
+            for prefix in sorted(self.rates, key=len, reverse=True):
+                if name == prefix or name.startswith(f'{prefix}.'):
+                    rate = self.rates[prefix]
+                    break
+            self._rate_by_name[name] = rate
+        return rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rate(record.name)
+        return rate >= 1 or random.random() < rate
+
+
+class QueueListenerHandler(QueueHandler):
+    """
+    Hands records to a bounded queue, a background thread passes them on
+    to `handlers`. The logging thread only pays for merging the message
+    arguments and formatting a traceback, never for I/O.
+
+    Records that do not fit in the queue are dropped and counted in
+    `dropped` rather than blocking the caller.
+
+    `handlers` are handler objects or, configured from LOGGING, the names
+    of other handlers there. Names are looked up when the first record
+    arrives, by which time dictConfig has configured every handler
+    whatever its name.
+
+    A process forked after the listener started (gunicorn --preload, or a
+    record logged at import) has no listener thread, so the first record
+    it logs starts one of its own on a fresh queue.
+    """
+
+    def __init__(self, handlers, maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        self.maxsize = maxsize
+        self.targets = list(handlers)
+        # dictConfig replaces each handler's config with the handler once configured, the
+        # reference also keeps alive the handlers that no logger holds on to
+        configurator = getattr(handlers, 'configurator', None)
+        self._configured_handlers = configurator.config['handlers'] if configurator else {}
+        self.dropped = 0
+        self.listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        atexit.register(self.close)
+
+    def resolve(self, target):
+        if isinstance(target, logging.Handler):
+            return target
+        handler = self._configured_handlers.get(target)
+        if not isinstance(handler, logging.Handler):
+            raise ValueError(f'No handler named {target!r} is configured')
+        return handler
+
+    def start(self):
+        with self._start_lock:
+            if self.listener is None:
+                handlers = [self.resolve(target) for target in self.targets]
+                self.listener = QueueListener(self.queue, *handlers, respect_handler_level=True)
+                self.listener.start()
+                self._pid = os.getpid()
+        return self.listener
+
+    def _after_fork(self):
+        # the parent's listener thread may have held the queue's lock at the fork, its records are the parent's
+        self.queue = queue.Queue(self.maxsize)
+        self._start_lock = threading.Lock()
+        self.listener = None
+
+    def prepare(self, record):
+        # unlike QueueHandler.prepare, leaves the formatting to the target handlers' formatters
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self.listener is not None and self._pid != os.getpid():
+            self._after_fork()
+        if self.listener is None:
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        if self.listener is not None and self._pid == os.getpid() and self.listener._thread is not None:
+            # writes out what is still queued
+            self.listener.stop()
+        super().close()
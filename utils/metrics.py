@@ -0,0 +1,153 @@
+import asyncio
+import os
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.http import HttpResponse
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, \
+    generate_latest
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.multiprocess import MultiProcessCollector
+
+try:
+    from asgiref.sync import markcoroutinefunction
+except ImportError:
+    # asgiref < 3.6, the marker asyncio.iscoroutinefunction looks for before python 3.12
+    def markcoroutinefunction(func):
+        func._is_coroutine = asyncio.coroutines._is_coroutine
+        return func
+
+METRICS_CONFIG = getattr(settings, 'METRICS', {})
+
+# prometheus_client switches to file backed values in this directory when the variable is set at import
+MULTIPROCESS = bool(os.environ.get('PROMETHEUS_MULTIPROC_DIR') or os.environ.get('prometheus_multiproc_dir'))
+
+UNRESOLVED = 'unresolved'
+
+REQUEST_DURATION = Histogram(
+    'http_request_duration_seconds', 'Request latency by URL name', ['view', 'method', 'status'])
+REQUEST_EXCEPTIONS = Counter(
+    'http_request_exceptions_total', 'Unhandled exceptions raised by views', ['view', 'exception'])
+REQUEST_QUERIES = Histogram(
+    'http_request_db_queries', 'Database queries made per request', ['view'],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100, float('inf')))
+REQUEST_QUERY_DURATION = Histogram(
+    'http_request_db_duration_seconds', 'Time spent in database queries per request', ['view'])
+PROVIDER_CALL_DURATION = Histogram(
+    'provider_call_duration_seconds', 'Calls to login providers through their circuit breaker',
+    ['provider', 'outcome'])
+PROVIDER_CALLS_REJECTED = Counter(
+    'provider_calls_rejected_total', 'Provider calls refused by an open circuit or a full bulkhead', ['provider'])
+EMAIL_QUEUE_DEPTH = Gauge(
+    'email_queue_depth', 'Messages waiting in the in-process email queue', multiprocess_mode='livesum')
+
+
+class QueryRecorder:
+    """
+    `connection.execute_wrapper` that counts and times the queries it sees
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += time.perf_counter() - start
+
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match and match.view_name else UNRESOLVED
+
+
+class MetricsMiddleware:
+    """
+    Records latency, query count and query time of every request, and the
+    exceptions raised by views, labeled by the resolved URL name
+    (e.g. `user:token`). Goes first in MIDDLEWARE so the whole stack is
+    timed. Queries made on other threads (the async social views run
+    their provider calls in a thread pool) are not counted.
+
+    Under ASGI it runs as a coroutine, so Django does not funnel every
+    request through one thread to adapt it. Async requests make their
+    queries in sync_to_async threads, so only their latency is recorded.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        queries = QueryRecorder()
+        start = time.perf_counter()
+        with connection.execute_wrapper(queries):
+            response = self.get_response(request)
+        duration = time.perf_counter() - start
+
+        view = view_name(request)
+        REQUEST_DURATION.labels(view, request.method, response.status_code).observe(duration)
+        REQUEST_QUERIES.labels(view).observe(queries.count)
+        REQUEST_QUERY_DURATION.labels(view).observe(queries.duration)
+        return response
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        duration = time.perf_counter() - start
+        REQUEST_DURATION.labels(view_name(request), request.method, response.status_code).observe(duration)
+        return response
+
+    @staticmethod
+    def process_exception(request, exception):
+        REQUEST_EXCEPTIONS.labels(view_name(request), type(exception).__name__).inc()
+
+
+class OutboxCollector:
+    """
+    Emails waiting in the outbox, counted at scrape time
+    """
+
+    @staticmethod
+    def collect():
+        from user.models import OutboxEmail
+
+        pending = OutboxEmail.objects.filter(sent_at__isnull=True, failed_at__isnull=True)
+        yield GaugeMetricFamily('email_outbox_pending', 'Emails in the outbox not sent yet', value=pending.count())
+        yield GaugeMetricFamily(
+            'email_outbox_due', 'Emails in the outbox due for sending',
+            value=pending.filter(next_attempt_at__lte=timezone.now()).count())
+
+
+def metrics_view(request):
+    """
+    Prometheus text exposition of the metrics of all worker processes.
+    With METRICS["TOKEN"] set, requests need `Authorization: Bearer <token>`.
+    Without one, every request is refused unless METRICS["PUBLIC"] is set.
+    """
+    token = METRICS_CONFIG.get('TOKEN')
+    if token:
+        if not constant_time_compare(request.META.get('HTTP_AUTHORIZATION', ''), f'Bearer {token}'):
+            return HttpResponse(status=401)
+    elif not METRICS_CONFIG.get('PUBLIC'):
+        return HttpResponse(status=403)
+
+    registry = CollectorRegistry()
+    if MULTIPROCESS:
+        MultiProcessCollector(registry)
+    else:
+        registry.register(REGISTRY)
+    registry.register(OutboxCollector())
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
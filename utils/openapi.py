@@ -0,0 +1,258 @@
+import gzip
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+from collections import namedtuple
+from pathlib import Path
+from threading import Lock
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags
+from django.views import View
+from django.views.generic import TemplateView
+from rest_framework import VERSION as REST_FRAMEWORK_VERSION
+from rest_framework.renderers import JSONOpenAPIRenderer, OpenAPIRenderer
+from rest_framework.schemas.openapi import SchemaGenerator
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+OPENAPI_SCHEMA_CONFIG = getattr(settings, 'OPENAPI_SCHEMA', {})
+
+# directories under BASE_DIR that never hold deployed code
+SKIPPED_DIRS = {'static', 'media', 'logs', 'templates', 'node_modules', 'venv', 'env', '__pycache__'}
+
+SchemaFile = namedtuple('SchemaFile', ['media_type', 'etag', 'identity', 'gzip', 'br'])
+
+RENDERERS = {
+    'openapi': OpenAPIRenderer,
+    'openapi-json': JSONOpenAPIRenderer,
+}
+
+
+def code_version():
+    """
+    Fingerprint of the deployed code: OPENAPI_SCHEMA["VERSION"] when set,
+    otherwise a hash of the size and mtime of every python file under
+    BASE_DIR and the DRF version
+    """
+    if OPENAPI_SCHEMA_CONFIG.get('VERSION'):
+        return OPENAPI_SCHEMA_CONFIG['VERSION']
+    digest = hashlib.sha1(REST_FRAMEWORK_VERSION.encode())
+    for root, dirs, files in os.walk(settings.BASE_DIR):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.') and d not in SKIPPED_DIRS)
+        for name in sorted(files):
+            if name.endswith('.py'):
+                stat = os.stat(os.path.join(root, name))
+                digest.update(f'{os.path.join(root, name)}:{stat.st_size}:{stat.st_mtime_ns}\n'.encode())
+    return digest.hexdigest()
+
+
+def compress(content):
+    return gzip.compress(content, 9, mtime=0), brotli.compress(content) if brotli else None
+
+
+class PrecomputedSchema:
+    """
+    OpenAPI schema generated once per deployed code version, rendered in
+    every format and stored with its gzip (and brotli, when installed)
+    variants.
+
+    The rendered files are kept in memory. With a `path` they are written
+    to disk as well, in a directory named after `code_version()`, so other
+    processes and restarts of the same code load them instead of generating
+    the schema again. A version's directory is filled under a temporary
+    name and renamed into place, so processes running different code never
+    see each other's files or a half written set. The `buildschema` command
+    fills the directory ahead of time and removes those of other versions.
+    """
+
+    def __init__(self, title=None, description=None, version=None, path=None):
+        self.generator = SchemaGenerator(title=title, description=description, version=version)
+        self.path = Path(path) if path else None
+        self._files = None
+        self._lock = Lock()
+
+    def generate(self):
+        schema = self.generator.get_schema(request=None, public=True)
+        files = {}
+        for schema_format, renderer_class in RENDERERS.items():
+            content = renderer_class().render(schema)
+            etag = '"%s"' % hashlib.sha1(content).hexdigest()
+            files[schema_format] = SchemaFile(renderer_class.media_type, etag, content, *compress(content))
+        return files
+
+    def version_dir(self, version):
+        return self.path / re.sub(r'[^\w.-]', '_', version)
+
+    @staticmethod
+    def _file_name(directory, schema_format, encoding=None):
+        return directory / (f'{schema_format}.{encoding}' if encoding else schema_format)
+
+    def load(self, version):
+        if not self.path or not self.version_dir(version).is_dir():
+            return None
+        directory = self.version_dir(version)
+        try:
+            files = {}
+            for schema_format, renderer_class in RENDERERS.items():
+                content = self._file_name(directory, schema_format).read_bytes()
+                br_file = self._file_name(directory, schema_format, 'br')
+                files[schema_format] = SchemaFile(
+                    renderer_class.media_type, '"%s"' % hashlib.sha1(content).hexdigest(), content,
+                    self._file_name(directory, schema_format, 'gz').read_bytes(),
+                    br_file.read_bytes() if brotli and br_file.exists() else None,
+                )
+            return files
+        except OSError as e:
+            logger.warning(f'Could not load the precomputed schema from {directory}: {e}')
+            return None
+
+    def write(self, files, version):
+        self.path.mkdir(parents=True, exist_ok=True)
+        target = self.version_dir(version)
+        tmp = Path(tempfile.mkdtemp(prefix='.tmp-', dir=self.path))
+        try:
+            # mkdtemp makes it private to this user, web processes may run as another
+            tmp.chmod(0o755)
+            for schema_format, schema_file in files.items():
+                for encoding, content in (
+                        (None, schema_file.identity), ('gz', schema_file.gzip), ('br', schema_file.br)):
+                    if content is not None:
+                        self._file_name(tmp, schema_format, encoding).write_bytes(content)
+            if target.exists():
+                # rename() does not replace a non-empty directory, the old one is moved aside first
+                old = Path(tempfile.mkdtemp(prefix='.old-', dir=self.path))
+                os.replace(target, old)
+                shutil.rmtree(old, ignore_errors=True)
+            try:
+                os.rename(tmp, target)
+            except OSError:
+                # another process put the same version in place meanwhile
+                if not target.is_dir():
+                    raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def prune(self, version):
+        """
+        Remove the directories of all versions but `version`
+        """
+        keep = self.version_dir(version)
+        for directory in self.path.iterdir():
+            # dot names are other processes' writes in progress
+            if directory.is_dir() and directory != keep and not directory.name.startswith('.'):
+                shutil.rmtree(directory, ignore_errors=True)
+
+    def build(self):
+        """
+        Generate the schema and write it to disk, regardless of what is there
+        """
+        files = self.generate()
+        if self.path:
+            version = code_version()
+            self.write(files, version)
+            self.prune(version)
+        with self._lock:
+            self._files = files
+        return files
+
+    def files(self):
+        if self._files is None:
+            with self._lock:
+                if self._files is None:
+                    version = code_version()
+                    files = self.load(version)
+                    if files is None:
+                        files = self.generate()
+                        if self.path:
+                            try:
+                                self.write(files, version)
+                            except OSError as e:
+                                logger.warning(f'Could not write the precomputed schema to {self.path}: {e}')
+                    self._files = files
+        return self._files
+
+    def get(self, schema_format='openapi'):
+        return self.files()[schema_format]
+
+    def version(self):
+        """
+        Version of the schema content, shared by all its formats
+        """
+        return self.get().etag.strip('"')
+
+
+openapi_schema = PrecomputedSchema(
+    title='Drf Starter', description='DRF STARTER', version='1.0.0', path=OPENAPI_SCHEMA_CONFIG.get('PATH'))
+
+
+class PrecomputedSchemaView(View):
+    """
+    Serves the precomputed schema bytes. `?format=openapi-json` or an
+    Accept header asking for JSON selects the JSON rendering, the
+    encoding follows Accept-Encoding.
+
+    Requests for `?v=<version>` (as linked from the docs pages) are
+    cached as immutable, the bare URL is revalidated with its ETag.
+    """
+    schema = openapi_schema
+
+    def get_format(self, request):
+        if request.GET.get('format') in RENDERERS:
+            return request.GET['format']
+        return 'openapi-json' if 'json' in request.META.get('HTTP_ACCEPT', '') else 'openapi'
+
+    @staticmethod
+    def get_encoding(request, schema_file):
+        accepted = {
+            encoding.split(';')[0].strip()
+            for encoding in request.META.get('HTTP_ACCEPT_ENCODING', '').split(',')
+        }
+        if schema_file.br is not None and 'br' in accepted:
+            return 'br', schema_file.br
+        if 'gzip' in accepted:
+            return 'gzip', schema_file.gzip
+        return None, schema_file.identity
+
+    def get(self, request, *args, **kwargs):
+        schema_file = self.schema.get(self.get_format(request))
+        encoding, content = self.get_encoding(request, schema_file)
+        # one tag per encoding, the bytes differ
+        etag = f'{schema_file.etag[:-1]}-{encoding}"' if encoding else schema_file.etag
+
+        if_none_match = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+        if etag in if_none_match or if_none_match == ['*']:
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(content, content_type=schema_file.media_type)
+            if encoding:
+                response['Content-Encoding'] = encoding
+        response['ETag'] = etag
+        if request.GET.get('v') == self.schema.version():
+            response['Cache-Control'] = 'public, max-age=31536000, immutable'
+        else:
+            response['Cache-Control'] = f'public, max-age={OPENAPI_SCHEMA_CONFIG.get("MAX_AGE", 300)}'
+        patch_vary_headers(response, ('Accept', 'Accept-Encoding'))
+        return response
+
+
+class SchemaDocView(TemplateView):
+    """
+    API docs page linking the schema by version, so browsers keep it until
+    the code changes
+    """
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['schema_version'] = openapi_schema.version()
+        return context
@@ -1,50 +1,71 @@
-import os
+import re
 
-from django.contrib.auth import authenticate, get_user_model
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, transaction
+from django.db.models.functions import Length
 
 from rest_framework.exceptions import AuthenticationFailed
-from dotenv import load_dotenv
 
 User = get_user_model()
-load_dotenv()
+
+# leave room for the numeric suffix within User.username's max_length
+USERNAME_BASE_MAX_LENGTH = 140
+USERNAME_ATTEMPTS = 5
 
 
 def generate_username(name):
-    username = "".join(name.split(' ')).lower()
-    counter = 1
-    while User.objects.filter(username=username):
-        username = username + str(counter)
-        counter += 1
-    return username
+    """
+    Return the username derived from the given name, followed by the next free
+    numeric suffix if it is taken ("john", "john1", "john2", ...).
+    The highest taken suffix is found with a single indexed prefix query.
+    """
+    base = "".join(name.split(' ')).lower()[:USERNAME_BASE_MAX_LENGTH] or 'user'
+    taken = User.objects.filter(
+        username__startswith=base,
+        username__regex=r'^{0}([1-9][0-9]*)?$'.format(re.escape(base)),
+    ).order_by(Length('username').desc(), '-username').values_list('username', flat=True).first()
+    if taken is None:
+        return base
+    return '{0}{1}'.format(base, int(taken[len(base):] or 0) + 1)
+
+
+def create_social_user(provider, email, full_name):
+    """
+    Create a user with a generated username, allocating a new one when a
+    concurrent signup took it first.
+    Returns None if a concurrent signup created a user with the same email.
+    """
+    for attempt in range(USERNAME_ATTEMPTS):
+        username = generate_username(full_name)
+        try:
+            with transaction.atomic():
+                return User.objects.create_social_user(
+                    username=username, email=email, auth_provider=provider, full_name=full_name)
+        except IntegrityError:
+            if User.objects.filter(email=email).exists():
+                return None
+            if attempt == USERNAME_ATTEMPTS - 1 or not User.objects.filter(username=username).exists():
+                raise
 
 
 def register_social_user(provider, email, full_name):
-    filtered_user_by_email = User.objects.filter(email=email)
-
-    if filtered_user_by_email.exists():
-
-        if provider == filtered_user_by_email[0].auth_provider:
-
-            user = authenticate(
-                email=email, password=os.getenv('SOCIAL_SECRET'))
-            return user
-
-        else:
-            raise AuthenticationFailed(
-                detail='Please continue your login using ' + filtered_user_by_email[0].auth_provider)
-
-    else:
-        user = {
-            'full_name': full_name,
-            'username': generate_username(full_name),
-            'email': email,
-            'phone': '1800009990',
-            'password': os.getenv('SOCIAL_SECRET')}
-        user = User.objects.create_user(**user)
-        user.is_verified = True
-        user.auth_provider = provider
-        user.save()
-
-        user = authenticate(
-            email=email, password=os.environ.get('SOCIAL_SECRET'))
-        return user
+    """
+    Return the user for the given provider identity, creating it on first login.
+    Returning users cost a single query, new users one more for the username
+    and the INSERT.
+    """
+    user = User.objects.filter(email=email).first()
+    if user is None:
+        user = create_social_user(provider, email, full_name) or User.objects.get(email=email)
+
+    if user.auth_provider != provider:
+        raise AuthenticationFailed(
+            detail='Please continue your login using ' + user.auth_provider)
+    if not user.is_active:
+        raise AuthenticationFailed(detail='User is inactive')
+
+    if user.has_usable_password():
+        # accounts created with the shared social secret
+        user.set_unusable_password()
+        user.save(update_fields=['password'])
+    return user
@@ -0,0 +1,197 @@
+import gzip
+import mimetypes
+import os
+import posixpath
+import re
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, parse_http_date_safe
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_SERVE_CONFIG = getattr(settings, 'STATIC_SERVE', {})
+
+# precompressed variants, in order of preference
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'application/xml', 'image/svg+xml')
+
+# name.<12 hex digits>.ext, as written by ManifestStaticFilesStorage
+HASHED_NAME = re.compile(r'\.[0-9a-f]{12}\.[^/.]+$')
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def is_compressible(name):
+    content_type, encoding = mimetypes.guess_type(name)
+    return encoding is None and content_type is not None and content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def compress_file(path):
+    """
+    Write the .gz (and .br, when brotli is installed) variants of `path`
+    unless they are already up to date
+    """
+    with open(path, 'rb') as f:
+        content = f.read()
+    if len(content) < STATIC_SERVE_CONFIG.get('COMPRESS_MIN_SIZE', 256):
+        return
+    variants = [('.gz', lambda: gzip.compress(content, 9, mtime=0))]
+    if brotli:
+        variants.append(('.br', lambda: brotli.compress(content)))
+    mtime = os.stat(path).st_mtime
+    for suffix, compress in variants:
+        target = f'{path}{suffix}'
+        if os.path.exists(target) and os.stat(target).st_mtime >= mtime:
+            continue
+        compressed = compress()
+        # a variant that saves nothing would only cost a header
+        if len(compressed) < len(content):
+            with open(target, 'wb') as f:
+                f.write(compressed)
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """
+    Manifest storage (content hashed file names) that also writes
+    precompressed variants of text files during collectstatic
+    """
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+        # the manifest holds the final names, post_process also yields those of intermediate passes
+        for name in {*paths, *self.hashed_files.values()}:
+            if is_compressible(name) and self.exists(name):
+                compress_file(self.path(name))
+
+
+class StaticFileResponse(FileResponse):
+    # for servers without sendfile, 4 KiB reads make large files CPU bound
+    block_size = 64 * 1024
+
+
+class FileRange:
+    """
+    File-like view of `length` bytes of `file` starting at `start`
+    """
+
+    def __init__(self, file, start, length):
+        self.file = file
+        self.file.seek(start)
+        self.remaining = length
+
+    def read(self, size=-1):
+        size = self.remaining if size < 0 else min(size, self.remaining)
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def parse_range(header, size):
+    """
+    Return the (start, end) byte positions asked for by a single range
+    Range header, None to serve the whole file or False when unsatisfiable
+    """
+    match = RANGE.match(header.replace(' ', ''))
+    if not match or match.groups() == ('', ''):
+        # malformed and multiple ranges are answered with the whole file
+        return None
+    start, end = match.groups()
+    if start and end and int(end) < int(start):
+        # an invalid range spec makes the header ignorable (RFC 7233 2.1)
+        return None
+    if not start:
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start >= size:
+        return False
+    return start, end
+
+
+def if_range_matches(request, etag, last_modified):
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith('"'):
+        return if_range == etag
+    return parse_http_date_safe(if_range) == last_modified
+
+
+def find_variant(request, fullpath):
+    accepted = {
+        encoding.split(';')[0].strip()
+        for encoding in request.META.get('HTTP_ACCEPT_ENCODING', '').split(',')
+    }
+    for encoding, suffix in ENCODINGS:
+        variant = Path(f'{fullpath}{suffix}')
+        if encoding in accepted and variant.is_file():
+            return encoding, variant
+    return None, fullpath
+
+
+def serve(request, path, document_root=None):
+    """
+    Serve a file below `document_root`, in place of `django.views.static.serve`.
+
+    Precompressed .br/.gz siblings are picked by Accept-Encoding, single
+    range requests get a 206, and ETag/Last-Modified validators answer
+    conditional requests. Whole files go out as a FileResponse, which WSGI
+    servers with a `wsgi.file_wrapper` send with sendfile(). Content
+    hashed names are cached as immutable.
+    """
+    path = posixpath.normpath(path).lstrip('/')
+    fullpath = Path(safe_join(document_root, path))
+    if not fullpath.is_file():
+        raise Http404(f'"{path}" does not exist')
+
+    content_type, encoding = mimetypes.guess_type(str(fullpath))
+    content_type = content_type or 'application/octet-stream'
+    range_header = request.META.get('HTTP_RANGE')
+    # ranges are served from the file itself, their offsets refer to it
+    variant_encoding, variant = (None, fullpath) if encoding or range_header else find_variant(request, fullpath)
+
+    stat = variant.stat()
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}{"-" + variant_encoding if variant_encoding else ""}"'
+    response = get_conditional_response(request, etag=etag, last_modified=int(stat.st_mtime))
+    byte_range = None
+    if response is None:
+        if range_header and if_range_matches(request, etag, int(stat.st_mtime)):
+            byte_range = parse_range(range_header, stat.st_size)
+        if byte_range is False:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{stat.st_size}'
+        else:
+            if byte_range:
+                start, end = byte_range
+                response = StaticFileResponse(FileRange(variant.open('rb'), start, end - start + 1), status=206)
+                response['Content-Length'] = end - start + 1
+                response['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+            else:
+                response = StaticFileResponse(variant.open('rb'), filename=fullpath.name)
+            # FileResponse guesses from the variant's name otherwise
+            response['Content-Type'] = content_type
+            if variant_encoding or encoding:
+                response['Content-Encoding'] = variant_encoding or encoding
+
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    response['Accept-Ranges'] = 'bytes'
+    if HASHED_NAME.search(fullpath.name):
+        response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response['Cache-Control'] = f'public, max-age={STATIC_SERVE_CONFIG.get("MAX_AGE", 3600)}'
+    if is_compressible(fullpath.name):
+        patch_vary_headers(response, ('Accept-Encoding',))
+    return response
@@ -0,0 +1,5 @@
+# keeps the tests out of the repo's .cache directory
+TEST_CACHES = {
+    'default': {'BACKEND': 'utils.cache.TieredCache', 'LOCATION': 'test', 'OPTIONS': {'L2': 'shared'}},
+    'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'test-shared'},
+}
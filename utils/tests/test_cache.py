@@ -0,0 +1,89 @@
+import time
+from threading import Barrier, Thread
+
+from django.test import SimpleTestCase, override_settings
+
+from utils.cache import TieredCache
+
+
+class TieredCacheTestCase(SimpleTestCase):
+
+    def setUp(self):
+        settings = override_settings(CACHES={
+            'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tiered-test'},
+        })
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.cache = self.make_cache()
+        self.cache.clear()
+
+    @staticmethod
+    def make_cache(location='tiered-test', **options):
+        return TieredCache(location, {'OPTIONS': {'L2': 'shared', 'L1_TTL': 5, **options}})
+
+    def test_reads_fill_l1_from_l2(self):
+        self.cache.set('key', 'value')
+        self.assertEqual(self.cache.get('key'), 'value')
+        # another process shares only L2
+        other = self.make_cache(location='tiered-test-other')
+        self.assertEqual(other.get('key'), 'value')
+        self.assertEqual(other.get('key'), 'value')
+        self.assertEqual(other.get('missing'), None)
+        stats = other.stats()
+        self.assertEqual((stats['l1_hits'], stats['l2_hits'], stats['misses']), (1, 1, 1))
+
+    def test_l1_entries_expire(self):
+        cache = self.make_cache(L1_TTL=0.05)
+        cache.set('key', 'value')
+        cache.l2.set('key', 'changed elsewhere')
+        self.assertEqual(cache.get('key'), 'value')
+        time.sleep(0.06)
+        self.assertEqual(cache.get('key'), 'changed elsewhere')
+
+    def test_per_key_ttl(self):
+        self.cache.set('key', 'value', timeout=0.05)
+        time.sleep(0.06)
+        self.assertIsNone(self.cache.get('key'))
+
+    def test_add_and_delete_go_through_l2(self):
+        other = self.make_cache(location='tiered-test-other')
+        self.assertTrue(self.cache.add('claim', 1))
+        self.assertFalse(other.add('claim', 2))
+        other.delete('claim')
+        self.assertIsNone(self.cache.l2.get('claim'))
+
+    def test_get_or_set_is_single_flight(self):
+        workers = 8
+        barrier = Barrier(workers)
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.05)
+            return 'value'
+
+        def worker():
+            barrier.wait()
+            results.append(self.cache.get_or_set('key', compute))
+
+        results = []
+        # the counters belong to the process, not to the test
+        computations = self.cache.stats()['computations']
+        threads = [Thread(target=worker) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['value'] * workers)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.cache.stats()['computations'], computations + 1)
+
+    def test_get_or_set_does_not_store_a_value_deleted_meanwhile(self):
+        def compute():
+            # the source changed while the value was being computed
+            self.cache.delete('key')
+            return 'stale'
+
+        self.assertEqual(self.cache.get_or_set('key', compute), 'stale')
+        self.assertIsNone(self.cache.get('key'))
+        self.assertIsNone(self.cache.l2.get('key'))
@@ -0,0 +1,53 @@
+from unittest import mock
+
+import requests
+from django.test import SimpleTestCase
+
+from utils.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, ProviderUnavailable
+
+
+class CircuitBreakerTestCase(SimpleTestCase):
+
+    @staticmethod
+    def fail():
+        raise requests.ConnectionError()
+
+    def test_opens_after_consecutive_failures(self):
+        breaker = CircuitBreaker('test', failure_threshold=2, recovery_timeout=60)
+        for _ in range(2):
+            with self.assertRaises(ProviderUnavailable):
+                breaker.call(self.fail)
+        self.assertEqual(breaker.state, OPEN)
+        called = mock.Mock()
+        with self.assertRaises(ProviderUnavailable):
+            breaker.call(called)
+        called.assert_not_called()
+        self.assertEqual(breaker.metrics()['short_circuited'], 1)
+
+    def test_half_open_trial_closes_or_reopens(self):
+        breaker = CircuitBreaker('test', failure_threshold=1, recovery_timeout=0)
+        with self.assertRaises(ProviderUnavailable):
+            breaker.call(self.fail)
+        self.assertEqual(breaker.state, HALF_OPEN)
+        with self.assertRaises(ProviderUnavailable):
+            breaker.call(self.fail)
+        self.assertEqual(breaker.metrics()['opened'], 2)
+        self.assertEqual(breaker.call(lambda: 'ok'), 'ok')
+        self.assertEqual(breaker.state, CLOSED)
+
+    def test_client_errors_do_not_count(self):
+        breaker = CircuitBreaker('test', failure_threshold=1)
+        with self.assertRaises(ValueError):
+            breaker.call(mock.Mock(side_effect=ValueError))
+        self.assertEqual(breaker.state, CLOSED)
+
+    def test_bulkhead_rejects_excess_calls(self):
+        breaker = CircuitBreaker('test', max_concurrent=1)
+
+        def nested():
+            return breaker.call(lambda: 'inner')
+
+        with self.assertRaises(ProviderUnavailable):
+            breaker.call(nested)
+        self.assertEqual(breaker.metrics()['bulkhead_rejected'], 1)
+        self.assertEqual(breaker.metrics()['in_flight'], 0)
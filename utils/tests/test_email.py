@@ -0,0 +1,237 @@
+import json
+import socketserver
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
+from unittest import mock
+
+from django.core.mail import EmailMessage
+from django.template import engines
+from django.template.backends.django import Template
+from django.template.loader import get_template, render_to_string
+from django.test import SimpleTestCase, override_settings
+from django.utils.html import strip_tags
+
+from utils.email import SENDGRID, SMTP, Email, EmailQueue, EmailTemplateCache, SendGridClient
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """
+    Just enough SMTP to accept messages and count connections
+    """
+    connections = 0
+    messages = 0
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        type(self).connections += 1
+        self.reply('220 sink')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command in (b'EHLO', b'HELO'):
+                self.reply('250 sink')
+            elif command == b'DATA':
+                self.reply('354 go ahead')
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                type(self).messages += 1
+                self.reply('250 queued')
+            elif command == b'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+
+class EmailQueueTestCase(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SMTPSinkHandler)
+        cls.server.daemon_threads = True
+        Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        SMTPSinkHandler.connections = SMTPSinkHandler.messages = 0
+        settings = override_settings(
+            EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend', EMAIL_HOST='127.0.0.1',
+            EMAIL_PORT=self.server.server_address[1], EMAIL_USE_SSL=False, EMAIL_USE_TLS=False,
+            EMAIL_HOST_USER='', EMAIL_HOST_PASSWORD='')
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def message(self, i):
+        return EmailMessage(subject=f'Message {i}', body='Hello', from_email='from@example.com',
+                            to=[f'user{i}@example.com'])
+
+    def test_workers_reuse_connections(self):
+        email_queue = EmailQueue(workers=2, batch_size=10)
+        for i in range(50):
+            email_queue.enqueue(SMTP, self.message(i))
+        email_queue.shutdown()
+        self.assertEqual(SMTPSinkHandler.messages, 50)
+        self.assertLessEqual(SMTPSinkHandler.connections, 2)
+
+    def test_smtp_messages_are_sent_in_smaller_batches(self):
+        email_queue = EmailQueue(workers=1, batch_size=100, smtp_batch_size=4)
+        with mock.patch('django.core.mail.backends.smtp.EmailBackend.send_messages',
+                        side_effect=lambda messages: len(messages)) as send_messages:
+            # queued before the worker starts so they are taken off the queue together
+            with mock.patch.object(email_queue, '_ensure_started'):
+                for i in range(10):
+                    email_queue.enqueue(SMTP, self.message(i))
+            email_queue._ensure_started()
+            email_queue.shutdown()
+        self.assertEqual([len(call.args[0]) for call in send_messages.call_args_list], [4, 4, 2])
+
+    def test_inline_sending(self):
+        email_queue = EmailQueue(workers=0)
+        email_queue.enqueue(SMTP, self.message(1))
+        self.assertEqual(SMTPSinkHandler.messages, 1)
+
+
+class SendGridHandler(BaseHTTPRequestHandler):
+    """
+    Records the JSON payloads posted to /v3/mail/send and rejects invalid
+    senders and recipients the way SendGrid does
+    """
+    payloads = []
+    calls = 0
+
+    def do_POST(self):
+        type(self).calls += 1
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        payload = json.loads(body)
+        errors = [{'message': 'Invalid from email', 'field': 'from.email'}] \
+            if payload['from']['email'].startswith('invalid') else [
+                {'message': 'Invalid email', 'field': f'personalizations.{i}.to.{j}.email'}
+                for i, p in enumerate(payload['personalizations'])
+                for j, to in enumerate(p['to']) if to['email'].startswith('invalid')]
+        if errors:
+            content = json.dumps({'errors': errors}).encode()
+            self.send_response(400)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+            return
+        type(self).payloads.append((self.path, self.headers['Authorization'], payload))
+        self.send_response(202)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class SendGridBatchTestCase(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = HTTPServer(('127.0.0.1', 0), SendGridHandler)
+        Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        SendGridHandler.payloads = []
+        SendGridHandler.calls = 0
+        self.client = SendGridClient(f'http://127.0.0.1:{self.server.server_port}', 'key', 'from@example.com',
+                                     max_personalizations=3)
+
+    def queued_messages(self, count, template='email/password-reset.html'):
+        with mock.patch('utils.email.email_queue') as email_queue:
+            for i in range(count):
+                Email.sendgrid_html_email(template, {
+                    'to': [f'user{i}@example.com'],
+                    'subject': 'Verify' if 'verification' in template else 'Reset password',
+                    'context': {'absurl': f'http://testserver/{i}?a=1&b=2', 'full_name': f'User {i}'},
+                })
+        self.assertTrue(all(call.args[0] == SENDGRID for call in email_queue.enqueue.call_args_list))
+        return [call.args[1] for call in email_queue.enqueue.call_args_list]
+
+    def test_messages_sharing_a_template_are_batched(self):
+        messages = self.queued_messages(7) + self.queued_messages(2, 'email/user_verification.html')
+        self.client.send(messages)
+
+        self.assertEqual([len(p['personalizations']) for _, _, p in SendGridHandler.payloads], [3, 3, 1, 2])
+        path, authorization, payload = SendGridHandler.payloads[0]
+        self.assertEqual(path, '/v3/mail/send')
+        self.assertEqual(authorization, 'Bearer key')
+        self.assertEqual(payload['from'], {'email': 'from@example.com'})
+        self.assertIn('href="-absurl-"', payload['content'][0]['value'])
+        personalizations = sorted(payload['personalizations'], key=lambda p: p['to'][0]['email'])
+        self.assertEqual(personalizations[0], {
+            'to': [{'email': 'user0@example.com'}],
+            'substitutions': {'-absurl-': 'http://testserver/0?a=1&amp;b=2', '-full_name-': 'User 0'},
+        })
+
+    def test_rejected_recipient_only_fails_its_message(self):
+        messages = self.queued_messages(7)
+        messages[4] = messages[4]._replace(to=['invalid@example'])
+        with self.assertLogs('utils.email', 'ERROR'):
+            rejected = self.client.send(messages)
+        self.assertEqual(rejected, [messages[4]])
+        sent = [to['email'] for _, _, p in SendGridHandler.payloads for pz in p['personalizations'] for to in pz['to']]
+        self.assertEqual(sorted(sent), [f'user{i}@example.com' for i in (0, 1, 2, 3, 5, 6)])
+        # three batches, the middle one sent again without the rejected message
+        self.assertEqual(SendGridHandler.calls, 4)
+
+    def test_payload_wide_rejection_makes_one_call(self):
+        messages = self.queued_messages(3)
+        self.client.from_email = 'invalid@example'
+        with self.assertLogs('utils.email', 'ERROR') as logs:
+            rejected = self.client.send(messages)
+        self.assertEqual(rejected, messages)
+        self.assertEqual(SendGridHandler.calls, 1)
+        self.assertEqual(len(logs.records), 1)
+
+    def test_template_is_rendered_once(self):
+        email_templates = EmailTemplateCache()
+        with mock.patch('utils.email.email_templates', email_templates), \
+                mock.patch.object(Template, 'render', autospec=True, side_effect=Template.render) as render:
+            self.queued_messages(5)
+        self.assertEqual(render.call_count, 1)
+
+
+class EmailTemplateCacheTestCase(SimpleTestCase):
+    context = {'absurl': 'http://testserver/verify?token=abc', 'full_name': 'John Doe'}
+
+    def test_matches_full_render(self):
+        email_templates = EmailTemplateCache()
+        for template in ('email/user_verification.html', 'email/password-reset.html'):
+            with self.subTest(template=template):
+                html, text = email_templates.render(template, self.context)
+                self.assertEqual(html, render_to_string(template, self.context))
+                self.assertEqual(text, strip_tags(html))
+
+    def test_compiles_once(self):
+        email_templates = EmailTemplateCache()
+        with mock.patch('utils.email.get_template', side_effect=get_template) as load:
+            for _ in range(3):
+                email_templates.render('email/user_verification.html', self.context)
+        # the html template and the missing .txt alternative
+        self.assertEqual(load.call_count, 2)
+
+    def test_text_template_is_preferred(self):
+        email_templates = EmailTemplateCache()
+        email_templates._templates['email/user_verification.txt'] = engines['django'].from_string(
+            'Hi {{ full_name }}, verify at {{ absurl }}')
+        _, text = email_templates.render('email/user_verification.html', self.context)
+        self.assertEqual(text, 'Hi John Doe, verify at http://testserver/verify?token=abc')
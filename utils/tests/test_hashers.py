@@ -0,0 +1,83 @@
+import json
+import tempfile
+from pathlib import Path
+from unittest import mock
+
+from django.contrib.auth.hashers import PBKDF2PasswordHasher, PBKDF2SHA1PasswordHasher, make_password
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from user.management.commands.calibratepasswordhashers import Command
+from user.models import User
+from utils import hashers
+from utils.hashing import PasswordHashingService, password_needs_rehash
+from utils.tests import TEST_CACHES
+
+CALIBRATED_HASHERS = [
+    'utils.hashers.CalibratedPBKDF2PasswordHasher',
+    'utils.hashers.CalibratedScryptPasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+]
+
+
+class CalibrationTestCase(SimpleTestCase):
+    options = {'target_ms': 50, 'allow_weaker': False}
+
+    def calibrate(self, param, scaling, value, floor, **options):
+        # one microsecond per unit of work
+        with mock.patch.object(Command, 'measure', lambda self, pool, path, param, value, options: value / 10 ** 6):
+            picked, _ = Command().calibrate(None, '', param, scaling, value, floor, {**self.options, **options})
+        return picked
+
+    def test_linear_parameter_meets_the_target(self):
+        self.assertEqual(self.calibrate('iterations', 'linear', 260000, 260000, allow_weaker=True), 50000)
+
+    def test_defaults_are_a_floor(self):
+        self.assertEqual(self.calibrate('iterations', 'linear', 260000, 260000), 260000)
+        self.assertEqual(self.calibrate('iterations', 'linear', 260000, 260000, target_ms=520), 520000)
+
+    def test_power_of_two_parameter(self):
+        self.assertEqual(self.calibrate('work_factor', 'power_of_two', 2 ** 14, 2 ** 14, target_ms=100), 2 ** 16)
+
+    def test_calibration_file_is_read(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / 'password_hashers.json'
+            path.write_text(json.dumps({'pbkdf2_sha256': {'iterations': 400000}}))
+            hashers.load_calibration.cache_clear()
+            self.addCleanup(hashers.load_calibration.cache_clear)
+            with mock.patch.dict(hashers.PASSWORD_HASHER_CALIBRATION, {'MODE': 'calibrated', 'FILE': path}):
+                self.assertEqual(hashers.calibrated('pbkdf2_sha256', 'iterations', 1), 400000)
+                self.assertEqual(hashers.calibrated('scrypt', 'work_factor', 2 ** 14), 2 ** 14)
+            hashers.load_calibration.cache_clear()
+            with mock.patch.dict(hashers.PASSWORD_HASHER_CALIBRATION, {'MODE': 'default', 'FILE': path}):
+                self.assertEqual(hashers.calibrated('pbkdf2_sha256', 'iterations', 1), 1)
+
+
+@override_settings(PASSWORD_HASHERS=CALIBRATED_HASHERS, CACHES=TEST_CACHES)
+class PasswordRehashTestCase(TestCase):
+
+    def test_hashes_of_other_hashers_or_parameters_need_rehash(self):
+        self.assertFalse(password_needs_rehash(make_password('Str0ng#password')))
+        self.assertTrue(password_needs_rehash(PBKDF2SHA1PasswordHasher().encode('Str0ng#password', 'salt1234')))
+        weaker = PBKDF2PasswordHasher().encode('Str0ng#password', 'salt1234', iterations=1000)
+        self.assertTrue(password_needs_rehash(weaker))
+        self.assertFalse(password_needs_rehash('unknown$hash'))
+
+    def test_selected_hasher_hashes_new_passwords(self):
+        with override_settings(PASSWORD_HASHERS=CALIBRATED_HASHERS[1:2] + CALIBRATED_HASHERS[:1]):
+            encoded = make_password('Str0ng#password')
+            self.assertTrue(encoded.startswith('scrypt$'))
+            self.assertTrue(password_needs_rehash(PBKDF2PasswordHasher().encode('Str0ng#password', 'salt1234')))
+        self.assertTrue(password_needs_rehash(encoded))
+
+    def test_login_upgrades_the_hash(self):
+        user = User.objects.create(
+            username='john', email='john@example.com', full_name='John Doe', is_verified=True,
+            password=PBKDF2SHA1PasswordHasher().encode('Str0ng#password', 'salt1234'))
+        # pool workers keep the PASSWORD_HASHERS they were started with
+        with mock.patch('user.backends.password_hashing', PasswordHashingService(workers=0)):
+            response = self.client.post('/user/token/', {'email': 'john@example.com', 'password': 'Str0ng#password'})
+        self.assertEqual(response.status_code, 200)
+        user.refresh_from_db()
+        self.assertTrue(user.password.startswith('pbkdf2_sha256$'))
+        self.assertFalse(password_needs_rehash(user.password))
+        self.assertTrue(user.check_password('Str0ng#password'))
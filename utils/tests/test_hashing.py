@@ -0,0 +1,54 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from user.models import User
+from utils.hashing import PasswordHashingService, PasswordHashingUnavailable
+from utils.tests import TEST_CACHES
+
+
+def saturated_service():
+    service = PasswordHashingService(workers=1, max_pending=1)
+    # every hash the pool accepts is in flight
+    for _ in range(2):
+        service._slots.acquire(blocking=False)
+    return service
+
+
+class PasswordHashingServiceTestCase(SimpleTestCase):
+
+    def test_saturated_pool_fails_fast(self):
+        service = saturated_service()
+        start = time.perf_counter()
+        with self.assertRaises(PasswordHashingUnavailable):
+            service.check_password('Str0ng#password', 'pbkdf2_sha256$1$salt$hash')
+        with self.assertRaises(PasswordHashingUnavailable):
+            service.make_password('Str0ng#password')
+        self.assertLess(time.perf_counter() - start, 0.5)
+        # nothing was handed to a worker process
+        self.assertIsNone(service._executor)
+
+    def test_slots_are_released(self):
+        service = PasswordHashingService(workers=1, max_pending=0)
+        service._executor = ThreadPoolExecutor(1)
+        self.addCleanup(service.shutdown)
+        # one slot, taken and given back by every hash
+        for _ in range(2):
+            self.assertTrue(service.check_password('secret', service.make_password('secret')))
+
+
+@override_settings(CACHES=TEST_CACHES)
+class SaturatedLoginTestCase(TestCase):
+
+    def test_login_answers_503_without_blocking(self):
+        user = User(username='john', email='john@example.com', full_name='John Doe')
+        user.set_password('Str0ng#password')
+        user.save()
+        start = time.perf_counter()
+        with mock.patch('user.backends.password_hashing', saturated_service()):
+            response = self.client.post('/user/token/', {'email': 'john@example.com', 'password': 'Str0ng#password'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json(), {'detail': 'Server is busy, please try again shortly.'})
+        self.assertLess(time.perf_counter() - start, 0.5)
@@ -0,0 +1,88 @@
+import json
+import logging
+import logging.config
+import os
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from utils.log import QueueListenerHandler, SamplingFilter
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class LoggingPipelineTestCase(SimpleTestCase):
+
+    def test_queue_handler_from_dict_config(self):
+        logging.config.dictConfig({
+            'version': 1,
+            'disable_existing_loggers': False,
+            'handlers': {
+                'queue': {'()': 'utils.log.QueueListenerHandler', 'handlers': ['zmemory']},
+                # configured after the queue handler, dictConfig goes by name
+                'zmemory': {'()': ListHandler, 'level': 'INFO', 'formatter': 'json'},
+            },
+            'formatters': {'json': {'()': 'utils.log.JSONFormatter'}},
+            'loggers': {'pipeline-test': {'handlers': ['queue'], 'level': 'DEBUG', 'propagate': False}},
+        })
+        logger = logging.getLogger('pipeline-test')
+        queue_handler = logger.handlers[0]
+        self.addCleanup(queue_handler.close)
+        logger.debug('dropped by the target handler level')
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            logger.exception('failed for %s', 'john', extra={'status_code': 500})
+        queue_handler.listener.stop()
+
+        memory = queue_handler.listener.handlers[0]
+        self.assertEqual(len(memory.records), 1)
+        data = json.loads(memory.format(memory.records[0]))
+        self.assertEqual(data['message'], 'failed for john')
+        self.assertEqual(data['status_code'], 500)
+        self.assertIn('ValueError: boom', data['exc_info'])
+
+    def test_full_queue_drops_records(self):
+        handler = QueueListenerHandler([ListHandler()], maxsize=1)
+        handler.start().stop()
+        self.addCleanup(handler.close)
+        for _ in range(3):
+            handler.handle(logging.makeLogRecord({'msg': 'message'}))
+        self.assertEqual(handler.dropped, 2)
+
+    def test_forked_process_starts_its_own_listener(self):
+        memory = ListHandler()
+        handler = QueueListenerHandler([memory])
+        self.addCleanup(handler.close)
+        handler.handle(logging.makeLogRecord({'msg': 'parent', 'levelno': logging.INFO}))
+        parent_listener, parent_queue = handler.listener, handler.queue
+
+        with mock.patch('utils.log.os.getpid', return_value=os.getpid() + 1):
+            handler.handle(logging.makeLogRecord({'msg': 'child', 'levelno': logging.INFO}))
+            self.assertIsNot(handler.listener, parent_listener)
+            self.assertIsNot(handler.queue, parent_queue)
+            handler.close()
+        parent_listener.stop()
+        self.assertEqual(sorted(record.msg for record in memory.records), ['child', 'parent'])
+
+    def test_unknown_target_is_reported(self):
+        handler = QueueListenerHandler(['missing'])
+        self.addCleanup(handler.close)
+        with self.assertRaisesMessage(ValueError, "No handler named 'missing' is configured"):
+            handler.start()
+
+    def test_sampling(self):
+        sampling = SamplingFilter({'django.db.backends': 0, 'django.db': 1})
+        record = logging.makeLogRecord
+        self.assertFalse(sampling.filter(record({'name': 'django.db.backends.schema', 'levelno': logging.DEBUG})))
+        self.assertTrue(sampling.filter(record({'name': 'django.db.backends', 'levelno': logging.WARNING})))
+        self.assertTrue(sampling.filter(record({'name': 'django.db.models', 'levelno': logging.DEBUG})))
+        self.assertTrue(sampling.filter(record({'name': 'django.db.backendsx', 'levelno': logging.DEBUG})))
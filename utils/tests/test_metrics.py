@@ -0,0 +1,100 @@
+import asyncio
+import time
+from unittest import mock
+
+import requests
+from prometheus_client import REGISTRY
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import path
+
+from social_auth.views import facebook_social_auth
+from user.models import OutboxEmail, User
+from utils.circuit_breaker import CircuitBreaker
+from utils.tests import TEST_CACHES
+from utils.token import get_access_token
+
+# the async social views, whatever SOCIAL_AUTH_ASYNC_VIEWS is
+urlpatterns = [
+    path('social/facebook/', facebook_social_auth, name='facebook'),
+]
+
+
+@override_settings(CACHES=TEST_CACHES)
+class MetricsTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='john', email='john@example.com', full_name='John Doe')
+
+    @staticmethod
+    def sample(name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_requests_are_labeled_by_url_name(self):
+        labels = {'view': 'user:current-user', 'method': 'GET', 'status': '200'}
+        requests_before = self.sample('http_request_duration_seconds_count', **labels)
+        queries_before = self.sample('http_request_db_queries_sum', view='user:current-user')
+
+        response = self.client.get('/user/current/', HTTP_AUTHORIZATION=f'Token {get_access_token(self.user)}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.sample('http_request_duration_seconds_count', **labels), requests_before + 1)
+        # the user row, the JWT user cache is empty
+        self.assertEqual(self.sample('http_request_db_queries_sum', view='user:current-user'), queries_before + 1)
+
+        self.client.get('/user/missing/')
+        self.assertGreater(self.sample('http_request_duration_seconds_count',
+                                       view='unresolved', method='GET', status='404'), 0)
+
+    def test_provider_calls(self):
+        breaker = CircuitBreaker('metrics-test', failure_threshold=1)
+        breaker.call(lambda: None)
+        with self.assertRaises(Exception):
+            breaker.call(mock.Mock(side_effect=requests.ConnectionError))
+        with self.assertRaises(Exception):
+            breaker.call(lambda: None)
+        self.assertEqual(self.sample('provider_call_duration_seconds_count', provider='metrics-test', outcome='ok'), 1)
+        self.assertEqual(
+            self.sample('provider_call_duration_seconds_count', provider='metrics-test', outcome='unavailable'), 1)
+        self.assertEqual(self.sample('provider_calls_rejected_total', provider='metrics-test'), 1)
+
+    def test_metrics_endpoint(self):
+        OutboxEmail.objects.create(template='email/user_verification.html', subject='Verify', to=['john@example.com'])
+        self.client.get('/user/missing/')
+        with mock.patch.dict('utils.metrics.METRICS_CONFIG', {'PUBLIC': True}):
+            response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'email_outbox_pending 1.0', response.content)
+        self.assertIn(b'http_request_duration_seconds_bucket{le="0.005",method="GET",status="404",view="unresolved"}',
+                      response.content)
+
+        with mock.patch.dict('utils.metrics.METRICS_CONFIG', {'TOKEN': 'secret'}):
+            self.assertEqual(self.client.get('/metrics').status_code, 401)
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+
+    def test_metrics_endpoint_is_closed_by_default(self):
+        with mock.patch.dict('utils.metrics.METRICS_CONFIG', {'TOKEN': '', 'PUBLIC': False}):
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+
+
+@override_settings(ROOT_URLCONF='utils.tests.test_metrics')
+class AsyncMetricsMiddlewareTestCase(SimpleTestCase):
+
+    async def test_concurrent_social_logins_overlap(self):
+        async def validate(auth_token):
+            # provider latency
+            await asyncio.sleep(0.5)
+
+        labels = {'view': 'facebook', 'method': 'POST', 'status': '400'}
+        before = REGISTRY.get_sample_value('http_request_duration_seconds_count', labels) or 0
+        with mock.patch('social_auth.views.Facebook.avalidate', side_effect=validate):
+            start = time.perf_counter()
+            responses = await asyncio.gather(*(
+                self.async_client.post('/social/facebook/', {'auth_token': 'token'}, content_type='application/json')
+                for _ in range(5)))
+            elapsed = time.perf_counter() - start
+        self.assertEqual([response.status_code for response in responses], [400] * 5)
+        # one after the other would take 2.5 s
+        self.assertLess(elapsed, 1.5)
+        self.assertEqual(REGISTRY.get_sample_value('http_request_duration_seconds_count', labels), before + 5)
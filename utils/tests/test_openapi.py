@@ -0,0 +1,69 @@
+import gzip
+import tempfile
+from pathlib import Path
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from utils.openapi import PrecomputedSchema, openapi_schema
+
+
+class PrecomputedSchemaTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.path = tempfile.TemporaryDirectory()
+        self.addCleanup(self.path.cleanup)
+        patcher = mock.patch.multiple(openapi_schema, path=Path(self.path.name), _files=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_serves_compressed_schema(self):
+        response = self.client.get('/openapi', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('/user/current/', gzip.decompress(response.content).decode())
+
+        response = self.client.get('/openapi', HTTP_IF_NONE_MATCH=response['ETag'], HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get('/openapi', {'format': 'openapi-json'})
+        self.assertEqual(response['Content-Type'], 'application/vnd.oai.openapi+json')
+        self.assertIn('/user/current/', response.json()['paths'])
+
+    def test_versioned_url_is_immutable(self):
+        response = self.client.get('/docs/')
+        self.assertContains(response, f'/openapi?v={openapi_schema.version()}')
+        response = self.client.get('/openapi', {'v': openapi_schema.version()})
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertNotIn('immutable', self.client.get('/openapi')['Cache-Control'])
+
+    def test_generated_once_per_code_version(self):
+        files = openapi_schema.files()
+        schema = PrecomputedSchema(path=self.path.name)
+        with mock.patch.object(schema.generator, 'get_schema') as get_schema:
+            self.assertEqual(schema.files(), files)
+        get_schema.assert_not_called()
+
+        schema = PrecomputedSchema(path=self.path.name)
+        with mock.patch('utils.openapi.code_version', return_value='changed'):
+            with mock.patch.object(schema.generator, 'get_schema', return_value={}) as get_schema:
+                schema.files()
+        get_schema.assert_called_once()
+
+    def test_each_code_version_has_its_own_directory(self):
+        schema = PrecomputedSchema(path=self.path.name)
+        files = openapi_schema.files()
+        schema.write(files, 'v1')
+        schema.write({**files, 'openapi': files['openapi']._replace(identity=b'v2')}, 'v2')
+        self.assertEqual(schema.load('v1'), files)
+        self.assertEqual(schema.load('v2')['openapi'].identity, b'v2')
+        # no temporary directories are left behind
+        self.assertFalse([path for path in Path(self.path.name).iterdir() if path.name.startswith('.')])
+
+    def test_build_removes_other_versions(self):
+        schema = PrecomputedSchema(path=self.path.name)
+        schema.write(openapi_schema.files(), 'old')
+        with mock.patch('utils.openapi.code_version', return_value='new'):
+            schema.build()
+            schema.build()
+        self.assertEqual([path.name for path in Path(self.path.name).iterdir()], ['new'])
@@ -0,0 +1,67 @@
+import gzip
+import tempfile
+from pathlib import Path
+
+from django.core.management import call_command
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from utils.static import serve
+
+
+class StaticServeTestCase(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = Path(directory.name)
+        (self.root / 'app').mkdir()
+        (self.root / 'app' / 'app.css').write_text('body { color: red; }\n' * 100)
+        self.factory = RequestFactory()
+
+    def serve(self, path, **headers):
+        return serve(self.factory.get(f'/static/{path}', **headers), path, document_root=self.root)
+
+    def collectstatic(self):
+        with override_settings(STATIC_ROOT=self.root / 'collected', STATICFILES_DIRS=[self.root / 'app']):
+            call_command('collectstatic', interactive=False, verbosity=0)
+            self.root = self.root / 'collected'
+
+    def test_collectstatic_writes_hashed_and_compressed_files(self):
+        self.collectstatic()
+        hashed = next(self.root.glob('app.*.css')).name
+        self.assertTrue((self.root / f'{hashed}.gz').exists())
+
+        response = self.serve(hashed, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Content-Type'], 'text/css')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), (self.root / hashed).read_bytes())
+
+        response = self.serve('app.css')
+        self.assertNotIn('Content-Encoding', response)
+        self.assertNotIn('immutable', response['Cache-Control'])
+
+    def test_range_requests(self):
+        content = (self.root / 'app' / 'app.css').read_bytes()
+        response = self.serve('app/app.css', HTTP_RANGE='bytes=5-14')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 5-14/{len(content)}')
+        self.assertEqual(b''.join(response.streaming_content), content[5:15])
+
+        response = self.serve('app/app.css', HTTP_RANGE='bytes=-10')
+        self.assertEqual(b''.join(response.streaming_content), content[-10:])
+
+        response = self.serve('app/app.css', HTTP_RANGE=f'bytes={len(content)}-')
+        self.assertEqual(response.status_code, 416)
+
+        # last before first is invalid, the header is ignored
+        response = self.serve('app/app.css', HTTP_RANGE='bytes=5-3')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), content)
+
+        response = self.serve('app/app.css', HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_conditional_requests(self):
+        etag = self.serve('app/app.css')['ETag']
+        self.assertEqual(self.serve('app/app.css', HTTP_IF_NONE_MATCH=etag).status_code, 304)
@@ -0,0 +1,65 @@
+from itertools import count
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from utils.twitter.helper import RequestTokenPool
+
+
+class RequestTokenPoolTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.fetched = count(1)
+        self.fetch = mock.Mock(side_effect=lambda: f'token-{next(self.fetched)}')
+        self.pool = RequestTokenPool(self.fetch, size=2, ttl=300)
+        self.addCleanup(self.pool._executor.shutdown)
+
+    def wait_for_refill(self):
+        # the executor has a single thread, this runs after the pending refill
+        self.pool._executor.submit(lambda: None).result()
+
+    def pooled(self):
+        return [token for _, token in self.pool._tokens]
+
+    def test_empty_pool_fetches_then_refills(self):
+        token = self.pool.get()
+        self.wait_for_refill()
+        self.assertEqual(self.fetch.call_count, 3)
+        self.assertEqual(len(self.pooled()), 2)
+        self.assertNotIn(token, self.pooled())
+
+    def test_pooled_tokens_are_handed_out_once(self):
+        self.pool.prefetch()
+        self.wait_for_refill()
+        self.assertEqual(self.pool.get(), 'token-1')
+        self.wait_for_refill()
+        self.assertEqual(self.pool.get(), 'token-2')
+        self.wait_for_refill()
+        self.assertEqual(self.pooled(), ['token-3', 'token-4'])
+        self.assertEqual(self.pool.get(), 'token-3')
+
+    def test_expired_tokens_are_dropped(self):
+        self.pool.prefetch()
+        self.wait_for_refill()
+        expired_at = self.pool._tokens[-1][0] + 301
+        with mock.patch('utils.twitter.helper.time.monotonic', return_value=expired_at):
+            token = self.pool.get()
+        self.wait_for_refill()
+        self.assertNotIn(token, ('token-1', 'token-2'))
+        self.assertNotIn('token-1', self.pooled())
+        self.assertNotIn('token-2', self.pooled())
+
+    def test_failed_refill_falls_back_to_fetching(self):
+        self.fetch.side_effect = ConnectionError('twitter is down')
+        with self.assertLogs('utils.twitter.helper', 'WARNING'):
+            self.pool.prefetch()
+            self.wait_for_refill()
+        self.assertFalse(self.pool._refilling)
+        self.fetch.side_effect = lambda: 'token'
+        self.assertEqual(self.pool.get(), 'token')
+
+    def test_size_zero_disables_prefetching(self):
+        self.pool.size = 0
+        self.assertEqual(self.pool.get(), 'token-1')
+        self.assertEqual(self.pool.get(), 'token-2')
+        self.assertEqual(self.fetch.call_count, 2)
@@ -1,4 +1,6 @@
-from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+from rest_framework_simplejwt.tokens import AccessToken
+
+from user.tokens import FamilyRefreshToken
 
 
 def get_access_token(user):
@@ -12,7 +14,7 @@ def get_refresh_token(user):
     """
     Generate refresh token for user
     """
-    return RefreshToken.for_user(user)
+    return FamilyRefreshToken.for_user(user)
 
 
 def tokens(user):
@@ -21,5 +23,5 @@ def tokens(user):
     """
     return {
         'access': str(AccessToken.for_user(user)),
-        'refresh': str(RefreshToken.for_user(user))
+        'refresh': str(FamilyRefreshToken.for_user(user))
     }
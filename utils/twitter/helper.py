@@ -1,50 +1,170 @@
 import os
+import time
 import logging
-from requests_oauthlib import OAuth1Session
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 
+import requests
+from asgiref.sync import sync_to_async
+from requests.adapters import HTTPAdapter
+from requests_oauthlib import OAuth1
+
+from django.conf import settings
 from django.utils.http import parse_qsl
 
 from rest_framework import serializers
 
+from utils.circuit_breaker import get_circuit_breaker
+
 from dotenv import load_dotenv
 
 logger = logging.getLogger(__name__)
 load_dotenv()
 
+TWITTER_API_CONFIG = getattr(settings, 'TWITTER_API', {})
+TWITTER_API_URL = TWITTER_API_CONFIG.get('URL', 'https://api.twitter.com')
+
+
+def build_session(pool_size):
+    """
+    Return a requests session that keeps up to `pool_size` connections alive per host
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def oauth(resource_owner_key=None, resource_owner_secret=None):
+    return OAuth1(
+        client_key=os.getenv('TWITTER_API_KEY'),
+        client_secret=os.getenv('TWITTER_API_KEY_SECRET'),
+        resource_owner_key=resource_owner_key,
+        resource_owner_secret=resource_owner_secret,
+    )
+
+
+class RequestTokenPool:
+    """
+    Small pool of pre-fetched OAuth request tokens.
+
+    Request tokens are single use, so each `get()` hands out one that is not
+    older than `ttl` seconds and tops the pool back up in a background thread.
+    When the pool is empty the token is fetched on the calling thread.
+    """
+
+    def __init__(self, fetch, size=5, ttl=300):
+        self.fetch = fetch
+        self.size = size
+        self.ttl = ttl
+        self._tokens = deque()
+        self._lock = Lock()
+        self._refilling = False
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='twitter-request-tokens')
+
+    def _refill(self):
+        try:
+            while True:
+                with self._lock:
+                    if len(self._tokens) >= self.size:
+                        break
+                token = self.fetch()
+                with self._lock:
+                    self._tokens.append((time.monotonic(), token))
+        except Exception as e:
+            logger.warning(f'Could not prefetch Twitter request token: {e}')
+        finally:
+            self._refilling = False
+
+    def prefetch(self):
+        """
+        Top the pool up in the background
+        """
+        with self._lock:
+            if self._refilling or not self.size:
+                return
+            self._refilling = True
+        self._executor.submit(self._refill)
+
+    def get(self):
+        now = time.monotonic()
+        token = None
+        with self._lock:
+            while self._tokens:
+                fetched_at, pooled_token = self._tokens.popleft()
+                if now - fetched_at < self.ttl:
+                    token = pooled_token
+                    break
+        self.prefetch()
+        return token if token is not None else self.fetch()
+
 
 class Twitter:
     """
     class to decode user access_token and user access_token_secret
     tokens will combine the user access_token and access_token_secret
     separated by space
+
+    All calls share one keep-alive connection pool, use explicit
+    (connect, read) timeouts and go through the `twitter` circuit breaker.
+    The `a*` variants run the same calls on a worker thread so async views
+    can overlap them with other work.
     """
+    session = build_session(TWITTER_API_CONFIG.get('POOL_SIZE', 10))
+    timeout = (TWITTER_API_CONFIG.get('CONNECT_TIMEOUT', 3), TWITTER_API_CONFIG.get('READ_TIMEOUT', 5))
+    breaker = get_circuit_breaker('twitter')
+
+    @classmethod
+    def _send(cls, method, url, **kwargs):
+        resp = cls.session.request(method, url, timeout=cls.timeout, **kwargs)
+        if resp.status_code >= 500:
+            resp.raise_for_status()
+        return resp
+
+    @classmethod
+    def request(cls, method, url, **kwargs):
+        """
+        Send a request to the Twitter API through the circuit breaker
+        """
+        return cls.breaker.call(cls._send, method, url, **kwargs)
 
-    @staticmethod
-    def get_access_token(resource_owner_key, resource_owner_secret):
+    @classmethod
+    def fetch_request_token(cls):
+        """
+        Fetch a new request token (oauth_token, oauth_token_secret, oauth_callback_confirmed)
+        """
+        resp = cls.request('POST', f'{TWITTER_API_URL}/oauth/request_token', auth=oauth())
+        resp.raise_for_status()
+        return dict(parse_qsl(resp.text))
+
+    @classmethod
+    def get_request_token(cls):
+        """
+        Return a request token, from the pre-fetched pool when possible
+        """
+        return request_tokens.get()
+
+    @classmethod
+    def get_access_token(cls, resource_owner_key, resource_owner_secret):
         """
         resource_owner_key: oauth_token
         resource_owner_secret: oauth_verifier
         WHERE:
         oauth_token and oauth_verifier are obtained from the previous step
         """
-
-        oauth = OAuth1Session(
-            client_key=os.getenv('TWITTER_API_KEY'),
-            client_secret=os.getenv('TWITTER_API_KEY_SECRET'),
-            resource_owner_key=resource_owner_key,
-            resource_owner_secret=resource_owner_secret,
-        )
         headers = {
             "Content-Type": "application/json",
         }
-        url = f"https://api.twitter.com/oauth/access_token?oauth_verifier={resource_owner_secret}"
+        url = f"{TWITTER_API_URL}/oauth/access_token?oauth_verifier={resource_owner_secret}"
 
-        resp = oauth.post(url, headers=headers)
+        resp = cls.request('POST', url, headers=headers, auth=oauth(resource_owner_key, resource_owner_secret))
         response = dict(parse_qsl(resp.text))
         return response
 
-    @staticmethod
-    def get_user_data(access_token):
+    @classmethod
+    def get_user_data(cls, access_token):
         """
         get_user_data method returns a twitter user profile info
 
@@ -60,20 +180,28 @@ class Twitter:
                 https://developer.twitter.com/en/docs/twitter-api/getting-started/about-twitter-api#v2-access-leve',
                 'code': 453}]}
         """
-        oauth = OAuth1Session(
-            client_key=os.getenv('TWITTER_API_KEY'),
-            client_secret=os.getenv('TWITTER_API_KEY_SECRET'),
-            resource_owner_key=access_token['oauth_token'],
-            resource_owner_secret=access_token['oauth_token_secret'],
-        )
         headers = {
             "Content-Type": "application/json",
         }
         params = {"include_email": 'true'}
-        url = f"https://api.twitter.com/1.1/account/verify_credentials.json"
-        resp = oauth.get(url, headers=headers, params=params)
+        url = f"{TWITTER_API_URL}/1.1/account/verify_credentials.json"
+        resp = cls.request('GET', url, headers=headers, params=params,
+                           auth=oauth(access_token['oauth_token'], access_token['oauth_token_secret']))
         return resp.json()
 
+    @classmethod
+    async def aget_request_token(cls):
+        return await sync_to_async(cls.get_request_token, thread_sensitive=False)()
+
+    @classmethod
+    async def aget_access_token(cls, resource_owner_key, resource_owner_secret):
+        return await sync_to_async(cls.get_access_token, thread_sensitive=False)(
+            resource_owner_key, resource_owner_secret)
+
+    @classmethod
+    async def aget_user_data(cls, access_token):
+        return await sync_to_async(cls.get_user_data, thread_sensitive=False)(access_token)
+
     @staticmethod
     def validate_twitter_auth_tokens(oauth_token, oauth_verifier):
         """
@@ -92,3 +220,10 @@ class Twitter:
         except Exception as identifier:
             raise serializers.ValidationError({
                 "tokens": ["The tokens are invalid or expired"]})
+
+
+request_tokens = RequestTokenPool(
+    fetch=Twitter.fetch_request_token,
+    size=TWITTER_API_CONFIG.get('REQUEST_TOKEN_POOL_SIZE', 5),
+    ttl=TWITTER_API_CONFIG.get('REQUEST_TOKEN_TTL', 300),
+)